@@ -1,46 +1,196 @@
 # Create Trips suggestion, recommendations model and auto created Trips
 
-from dotenv import load_dotenv
-
-load_dotenv()
-
-import re
-import os
+import time
 import numpy as np 
 import pandas as pd 
-from supabase import create_client, Client
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.neighbors import NearestNeighbors
-# search similarities libraries
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
-
-# initialize supabase connection
-url: str = os.environ.get("SUPABASE_URL")
-key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
-
-# fetch places data from database into dataframe
-table_name = "places"
-response = supabase.table(table_name).select("*").execute()
-data = response.data
-places_df = pd.DataFrame(data)
-
-# fetch trips data from database into dataframe
-table_name = "trips"
-response = supabase.table(table_name).select("*").execute()
-data = response.data
-trips_df = pd.DataFrame(data)
-
-# fetch trips steps data from database into dataframe
-table_name = "tripstep"
-response = supabase.table(table_name).select("*").execute()
-data = response.data
-trip_step_df = pd.DataFrame(data)
-
-# merge interactions and bookmarks tables
-interactions_df = trips_df.merge(trip_step_df, on=["trip_id", "trip_id"], how="outer")
 
+# shared data snapshots
+from app.data_snapshot import get_snapshot
+# vectorized distances
+from app.geo import coordinates, distance_matrix, min_distance
+# sparse top-K tag similarity between places
+from app.similarity_index import SimilarityIndex
+# spatial index over place coordinates
+from app.spatial_index import SpatialIndex
+# tag flags of every place
+from app.place_catalog import PlaceCatalog
+# stage timers
+from app.metrics import timed
+
+def update_dataframes():
+    snapshot = get_snapshot()
+    # places, trips and trips steps data from the latest snapshot
+    places_df = snapshot.places
+    trips_df = snapshot.trips
+    trip_step_df = snapshot.tripstep
+
+    # merge trips and trips steps tables
+    interactions_df = trips_df.merge(trip_step_df, on=["trip_id", "trip_id"], how="outer")
+
+    return places_df, trips_df, trip_step_df, interactions_df
+
+
+# -------------------
+# Auto Trip Generation
+# -------------------
+
+# limits of a generated trip
+DEFAULT_STOPS = 5
+MAX_STOPS = 12
+DEFAULT_HOURS = 8
+VISIT_MINUTES = 60
+SPEED_KMH = 20
+# stops are picked within this many km of the seed, the bookmarks or the best theme match
+MAX_RADIUS = 10
+# places kept from the similarity and from the proximity lookup before ranking
+CANDIDATES = 200
+WEIGHT_CONTENT = 0.6
+WEIGHT_PROXIMITY = 0.4
+# time budget of the 2-opt improvement
+ROUTE_SECONDS = 0.05
+
+def theme_scores(similarity, theme):
+    # tf-idf match of every place's tags against a free text theme like "islamic history"
+    if similarity.vectorizer is None:
+        # no place has tags to match against
+        return np.zeros(similarity.tag_matrix.shape[0], dtype=np.float32)
+    query = similarity.vectorizer.transform([theme])
+    return np.asarray((similarity.tag_matrix @ query.T).todense(), dtype=np.float32).ravel()
+
+def route_length(route, distances):
+    return float(distances[route[:-1], route[1:]].sum())
+
+def nearest_neighbour_route(distances, start=0):
+    # greedy open path that always walks to the closest unvisited stop
+    visited = np.zeros(len(distances), dtype=bool)
+    route = [start]
+    visited[start] = True
+    for _ in range(len(distances) - 1):
+        step = np.where(visited, np.inf, distances[route[-1]])
+        route.append(int(np.argmin(step)))
+        visited[route[-1]] = True
+    return np.array(route)
+
+def two_opt(route, distances, time_limit=ROUTE_SECONDS):
+    # reverse route segments while that shortens the open path, the first stop stays first
+    deadline = time.perf_counter() + time_limit
+    route = route.copy()
+    n = len(route)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(1, n - 1):
+            # gain of reversing route[i:j + 1] for every j at once
+            j = np.arange(i + 1, n)
+            a, b, c = route[i - 1], route[i], route[j]
+            has_next = j + 1 < n
+            d = route[np.minimum(j + 1, n - 1)]
+            before = distances[a, b] + np.where(has_next, distances[c, d], 0)
+            after = distances[a, c] + np.where(has_next, distances[b, d], 0)
+            gain = before - after
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-6:
+                route[i:j[best] + 1] = route[i:j[best] + 1][::-1]
+                improved = True
+    return route
+
+def order_stops(lat, lon, start=0):
+    # (route, distances between consecutive stops) over a precomputed haversine matrix
+    distances = distance_matrix(lat, lon, lat, lon)
+    route = two_opt(nearest_neighbour_route(distances, start), distances)
+    return route, distances[route[:-1], route[1:]]
+
+@timed("trip.generate")
+def generate_trip(place_id=None, user_id=None, theme=None, stops=DEFAULT_STOPS, hours=DEFAULT_HOURS):
+    # a trip of up to `stops` places around a seed place, a user's bookmarks and/or a tag theme,
+    # ordered into a short walk that fits in `hours`
+    snapshot = get_snapshot()
+    places_df = snapshot.places
+    if places_df.empty:
+        print("Places dataframe is empty.")
+        return pd.DataFrame()
+    similarity: SimilarityIndex = snapshot.derived("similarity_index")
+    spatial_index: SpatialIndex = snapshot.derived("spatial_index")
+    catalog: PlaceCatalog = snapshot.derived("place_catalog")
+    lat, lon = coordinates(places_df)
+
+    # ------- Content scores ------------
+    content = np.zeros(len(places_df), dtype=np.float32)
+    seed_row = similarity.row_of.get(place_id) if place_id is not None else None
+    if place_id is not None and seed_row is None:
+        print(f"No place found with place_id {place_id}.")
+        return pd.DataFrame()
+    if seed_row is not None:
+        content += similarity.scores([place_id])
+    bookmarked_rows = []
+    if user_id is not None:
+        bookmarks_df = snapshot.bookmarks
+        bookmarked = bookmarks_df[bookmarks_df["user_id"] == user_id]["place_id"].tolist() if "user_id" in bookmarks_df else []
+        bookmarked_rows = [similarity.row_of[place] for place in bookmarked if place in similarity.row_of]
+        content += similarity.scores(bookmarked)
+    if theme:
+        content += theme_scores(similarity, theme)
+    if seed_row is None and not bookmarked_rows and not theme:
+        print(f"No bookmarks found for user {user_id}.")
+        return pd.DataFrame()
+
+    # ------- Anchors ------------
+    # the trip stays around the seed, else around the bookmarks, else around the best theme match
+    if seed_row is not None:
+        anchors = np.array([seed_row])
+    elif bookmarked_rows:
+        anchors = np.array(bookmarked_rows)
+    else:
+        anchors = np.array([int(np.argmax(np.where(np.isnan(lat), -np.inf, content)))])
+    anchors = anchors[~(np.isnan(lat[anchors]) | np.isnan(lon[anchors]))]
+    if not len(anchors):
+        print("No coordinates found to build the trip around.")
+        return pd.DataFrame()
+
+    # ------- Candidates ------------
+    # the best content matches and the closest places, instead of scoring every place
+    limit = min(CANDIDATES, len(content))
+    similar_rows = np.argpartition(-content, limit - 1)[:limit]
+    near_rows, _ = spatial_index.query_knn_multi(lat[anchors], lon[anchors], CANDIDATES)
+    rows = np.union1d(similar_rows, near_rows)
+    excluded = set(bookmarked_rows) | ({seed_row} if seed_row is not None else set())
+    rows = rows[~np.isin(rows, list(excluded))]
+    # places tagged "Not available yet" are never stops
+    rows = rows[~catalog.unavailable[rows]]
+    distance = min_distance(lat[rows], lon[rows], lat[anchors], lon[anchors])
+    within = distance <= MAX_RADIUS
+    rows, distance = rows[within], distance[within]
+    if theme and seed_row is None and not bookmarked_rows:
+        # a theme alone only keeps places that match it
+        matches = content[rows] > 0
+        rows, distance = rows[matches], distance[matches]
+
+    # ------- Ranking ------------
+    top_content = content[rows].max() if len(rows) else 0
+    content_score = content[rows] / top_content if top_content > 0 else np.zeros(len(rows), dtype=np.float32)
+    score = WEIGHT_CONTENT * content_score + WEIGHT_PROXIMITY * (1 - distance / MAX_RADIUS)
+    keep = stops - 1 if seed_row is not None else stops
+    order = np.argsort(-score, kind="stable")[:keep]
+    rows, score = rows[order], score[order]
+    if seed_row is not None:
+        rows, score = np.concatenate([[seed_row], rows]), np.concatenate([[1.0], score])
+    if not len(rows):
+        print("No places found for the trip.")
+        return pd.DataFrame()
 
+    # ------- Route ------------
+    # drop the weakest stop until visits and travel fit in the time limit
+    while True:
+        route, legs = order_stops(lat[rows], lon[rows])
+        minutes = len(rows) * VISIT_MINUTES + legs.sum() / SPEED_KMH * 60
+        if minutes <= hours * 60 or len(rows) <= 1:
+            break
+        weakest = int(np.argmin(score[1:]) + 1) if seed_row is not None else int(np.argmin(score))
+        rows, score = np.delete(rows, weakest), np.delete(score, weakest)
 
+    trip = places_df.iloc[rows[route]].copy()
+    trip["tags"] = trip["tags"].fillna("")
+    trip["step_num"] = np.arange(len(route))
+    trip["trip_score"] = score[route]
+    trip["distance_from_previous"] = np.concatenate([[0.0], legs]).astype(np.float32)
+    return trip
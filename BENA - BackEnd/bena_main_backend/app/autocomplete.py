@@ -0,0 +1,130 @@
+# prefix search over place names and tags for typeahead
+import time
+import numpy as np
+# shared data snapshots
+from app.data_snapshot import register_derived
+# same normalization as the fuzzy search
+from app.search_index import normalize
+
+# name fields whose full value and every word suffix are completed, e.g. "egyptian museum" and "museum"
+NAME_FIELDS = ["name", "arabic_name"]
+# bookmarks count more than other interactions when ranking suggestions
+BOOKMARK_WEIGHT = 2
+INTERACTION_WEIGHT = 1
+# above this share of changed places rebuilding the term list is cheaper than merging into it
+MAX_INCREMENTAL_SHARE = 0.2
+
+
+def place_terms(name_values, tags):
+    terms = set()
+    for value in name_values:
+        words = normalize(value).split(" ")
+        terms.update(" ".join(words[i:]) for i in range(len(words)))
+    for tag in tags.split(","):
+        tag = normalize(tag)
+        if tag:
+            terms.add(tag)
+    terms.discard("")
+    return terms
+
+
+class AutocompleteIndex:
+    # sorted terms with the snapshot row of the place each one belongs to, prefixes are found by binary search
+    def __init__(self, terms, rows, ids, build_seconds):
+        self.terms = terms
+        self.rows = rows
+        # place id of every snapshot row, to renumber the rows when the next snapshot moves them
+        self.ids = ids
+        self.build_seconds = build_seconds
+
+    @staticmethod
+    def _entries(places_df, rows):
+        # (sorted terms, their rows) of the given snapshot rows, places_df holds just those rows
+        columns = [places_df[field].fillna("").astype(str).tolist() if field in places_df else [""] * len(places_df) for field in NAME_FIELDS]
+        tags = places_df["tags"].fillna("").astype(str).tolist() if "tags" in places_df else [""] * len(places_df)
+        entries = []
+        for row, values in zip(rows, zip(*columns, tags)):
+            entries.extend((term, row) for term in place_terms(values[:-1], values[-1]))
+        entries.sort()
+        return np.array([term for term, row in entries], dtype=object), np.array([row for term, row in entries], dtype=np.int32)
+
+    @classmethod
+    def build(cls, places_df):
+        start = time.perf_counter()
+        terms, rows = cls._entries(places_df, range(len(places_df)))
+        return cls(terms, rows, places_df["places_id"].tolist(), time.perf_counter() - start)
+
+    def update(self, places_df, changed):
+        # the index of the next snapshot, the changed places' terms are merged into the sorted arrays,
+        # returns None when a full build is cheaper
+        start = time.perf_counter()
+        ids = places_df["places_id"].tolist()
+        if len(changed) > MAX_INCREMENTAL_SHARE * max(len(ids), 1):
+            return None
+        row_of = {place_id: row for row, place_id in enumerate(ids)}
+        # terms of changed and deleted places go, the others follow their place to its new row
+        new_row = np.array([-1 if place_id in changed else row_of.get(place_id, -1) for place_id in self.ids], dtype=np.int32)
+        rows = new_row[self.rows]
+        keep = rows >= 0
+        terms, rows = self.terms[keep], rows[keep]
+        changed_rows = sorted(row_of[place_id] for place_id in changed if place_id in row_of)
+        added_terms, added_rows = self._entries(places_df.iloc[changed_rows], changed_rows)
+        positions = np.searchsorted(terms, added_terms)
+        return AutocompleteIndex(np.insert(terms, positions, added_terms), np.insert(rows, positions, added_rows), ids,
+                                 self.build_seconds + time.perf_counter() - start)
+
+    def complete(self, prefix, popularity, n=8):
+        # rows of the n most popular places with a term starting with prefix
+        prefix = normalize(prefix)
+        if not prefix:
+            return np.zeros(0, dtype=np.int32)
+        start, end = np.searchsorted(self.terms, np.array([prefix, prefix + "\uffff"], dtype=object))
+        rows = np.unique(self.rows[start:end])
+        if len(rows) > n:
+            rows = rows[np.argpartition(-popularity[rows], n - 1)[:n]]
+        return rows[np.lexsort((rows, -popularity[rows]))]
+
+    def stats(self):
+        return {
+            "terms": len(self.terms),
+            "bytes": int(sum(len(term.encode("utf-8")) for term in self.terms) + self.rows.nbytes),
+            "build_seconds": round(self.build_seconds, 4),
+        }
+
+
+# -------------------
+# Snapshot integration
+# -------------------
+
+def build_popularity(snapshot):
+    # bookmarks and interactions per place, aligned with the snapshot places frame
+    places_df = snapshot.places
+    popularity = np.zeros(len(places_df), dtype=np.float32)
+    for table, weight in (("bookmarks", BOOKMARK_WEIGHT), ("interactions", INTERACTION_WEIGHT)):
+        df = snapshot.tables[table]
+        if "place_id" not in df:
+            continue
+        counts = df["place_id"].value_counts()
+        popularity += weight * places_df["places_id"].map(counts).fillna(0).to_numpy(dtype=np.float32)
+    return popularity
+
+
+def update_popularity(popularity, snapshot):
+    if snapshot.changed("places") or snapshot.changed("bookmarks") or snapshot.changed("interactions"):
+        return None
+    return popularity
+
+
+def build_autocomplete(snapshot):
+    return AutocompleteIndex.build(snapshot.places)
+
+
+def update_autocomplete(index, snapshot):
+    changed = snapshot.changed("places")
+    if not changed:
+        return index
+    return index.update(snapshot.places, changed)
+
+
+register_derived("place_popularity", build_popularity, update_popularity)
+register_derived("autocomplete", build_autocomplete, update_autocomplete)
@@ -0,0 +1,285 @@
+# score recommendations for many users at once and keep the results in a local store
+# usage: python -m app.batch_recommendation [--method hybrid] [--length 10] [--workers 4] [--users id ...]
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import numpy as np
+import scipy.sparse as sp
+from concurrent.futures import ProcessPoolExecutor
+# shared data snapshots
+from app.data_snapshot import DATA_DIR, get_snapshot
+from app.data_snapshot import get_store as get_snapshot_store
+# vectorized distances
+from app.geo import coordinates, min_distance
+# places visited together in trips and bookmark lists
+from app.cooccurrence_index import collaborative_scores
+# users whose stored results went stale
+from app.result_cache import changed_users
+# stage timers
+from app.metrics import timed
+
+METHODS = ["content_based", "near_bookmarks", "hybrid", "collaborative"]
+# users scored together in one sparse product
+BLOCK_SIZE = 256
+# above this many users the job is spread over a process pool
+POOL_THRESHOLD = 2000
+WEIGHT_CONTENT = 0.6
+WEIGHT_PROXIMITY = 0.4
+WEIGHT_COLLABORATIVE = 0.3
+LOW_SCORE = 0.1
+# stored results older than this are not served
+RESULT_TTL = float(os.environ.get("BENA_BATCH_RESULT_TTL", str(24 * 3600)))
+STORE_PATH = os.path.join(DATA_DIR, "recommendations.sqlite")
+
+
+# -------------------
+# Matrix Scoring
+# -------------------
+
+class ScoringData:
+    # the arrays every scoring block needs, small enough to ship to worker processes
+    def __init__(self, snapshot):
+        places_df = snapshot.places
+        similarity = snapshot.derived("similarity_index")
+        self.place_ids = places_df["places_id"].to_numpy(dtype=object)
+        self.similarity = similarity.matrix
+        cooccurrence = snapshot.derived("cooccurrence_index")
+        self.cooccurrence = cooccurrence.matrix
+        self.item_factors = cooccurrence.factors[1] if cooccurrence.factors is not None else None
+        self.lat, self.lon = coordinates(places_df)
+        # places with tags "Not available yet" get a low content score
+        self.unavailable = np.array(snapshot.derived("place_catalog").unavailable)
+
+
+def bookmark_matrix(bookmarks_df, user_ids, row_of):
+    # users x places, 1 where the user bookmarked the place, row_of maps place ids to columns
+    user_row = {user_id: row for row, user_id in enumerate(user_ids)}
+    rows, cols = [], []
+    if "user_id" in bookmarks_df:
+        pairs = bookmarks_df[bookmarks_df["user_id"].isin(user_row)]
+        for user_id, place_id in zip(pairs["user_id"], pairs["place_id"]):
+            if place_id in row_of:
+                rows.append(user_row[user_id])
+                cols.append(row_of[place_id])
+    data = np.ones(len(rows), dtype=np.float32)
+    matrix = sp.csr_matrix((data, (rows, cols)), shape=(len(user_ids), len(row_of)))
+    # duplicate bookmarks count once
+    matrix.data[:] = 1
+    return matrix
+
+
+def score_block(data, bookmarks, method, n, history=None, user_factors=None,
+                weight_content=WEIGHT_CONTENT, weight_proximity=WEIGHT_PROXIMITY, weight_collaborative=WEIGHT_COLLABORATIVE):
+    # top n (rows, scores) per user of a block, bookmarks is the block's users x places matrix,
+    # history (and user_factors) the block's rows of the co-occurrence index
+    results = []
+    content = None
+    collaborative = None
+    if method in ("content_based", "hybrid"):
+        # every user's content score in one sparse product, kept sparse
+        content = (bookmarks @ data.similarity).tocsr()
+        content.eliminate_zeros()
+        unavailable_rows = np.flatnonzero(data.unavailable)
+    if method in ("collaborative", "hybrid"):
+        collaborative = collaborative_scores(history, data.cooccurrence, user_factors, data.item_factors)
+    for user in range(bookmarks.shape[0]):
+        bookmarked = bookmarks.indices[bookmarks.indptr[user]:bookmarks.indptr[user + 1]]
+        if method == "collaborative":
+            visited = history.indices[history.indptr[user]:history.indptr[user + 1]]
+            # places nobody visited together with the user's places are not recommended
+            scores = np.where(collaborative[user] > 0, collaborative[user], np.nan)
+            results.append(top_n(scores, n, exclude=visited))
+            continue
+        if not len(bookmarked):
+            results.append((np.zeros(0, dtype=int), np.zeros(0, dtype=np.float32)))
+            continue
+        if method == "content_based":
+            start, end = content.indptr[user], content.indptr[user + 1]
+            results.append(sparse_top_n(content.indices[start:end], content.data[start:end], unavailable_rows,
+                                        bookmarked, n, len(data.place_ids)))
+            continue
+        distance = min_distance(data.lat, data.lon, data.lat[bookmarked], data.lon[bookmarked])
+        if method == "near_bookmarks":
+            scores, ascending = distance, True
+        else:
+            content_scores = content[user].toarray().ravel()
+            content_scores[data.unavailable] = LOW_SCORE
+            proximity = 1 - distance / np.nanmax(distance)
+            scores = weight_content * content_scores + weight_proximity * proximity + weight_collaborative * collaborative[user]
+            ascending = False
+        results.append(top_n(scores, n, exclude=bookmarked, ascending=ascending))
+    return results
+
+
+def sparse_top_n(columns, values, unavailable_rows, exclude, n, size):
+    # top_n of one sparse content row, unavailable places at LOW_SCORE and every other place at 0,
+    # without densifying the row: only the stored entries and the unavailable places are ranked
+    candidates = np.union1d(columns, unavailable_rows)
+    scores = np.zeros(len(candidates), dtype=np.float32)
+    scores[np.searchsorted(candidates, columns)] = values
+    scores[np.searchsorted(candidates, unavailable_rows)] = LOW_SCORE
+    keep = ~np.isin(candidates, exclude)
+    candidates, scores = candidates[keep], scores[keep]
+    rows, top = top_n(scores, n)
+    rows = candidates[rows]
+    if len(rows) < n:
+        # the rest are zero scores, which top_n ranks by row
+        taken = np.concatenate([candidates, exclude])
+        zeros = np.setdiff1d(np.arange(min(size, n + len(taken))), taken)[:n - len(rows)]
+        rows = np.concatenate([rows, zeros])
+        top = np.concatenate([top, np.zeros(len(zeros), dtype=np.float32)])
+    return rows, top
+
+
+def top_n(scores, n, exclude=None, ascending=False):
+    # best n (rows, scores) without sorting every place, NaN scores always rank last
+    keys = np.where(np.isnan(scores), np.inf, scores if ascending else -scores)
+    if exclude is not None and len(exclude):
+        keys = keys.copy()
+        keys[exclude] = np.inf
+    n = min(n, int(np.isfinite(keys).sum()))
+    if n <= 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=np.float32)
+    rows = np.argpartition(keys, n - 1)[:n]
+    rows = rows[np.lexsort((rows, keys[rows]))]
+    return rows, scores[rows]
+
+
+@timed("batch.score_users")
+def score_users(snapshot, user_ids, method="hybrid", n=10, workers=None):
+    # {user_id: (place ids, scores)} for every user, best first
+    data = ScoringData(snapshot)
+    bookmarks = bookmark_matrix(snapshot.bookmarks, user_ids, snapshot.derived("similarity_index").row_of)
+    history, user_factors = snapshot.derived("cooccurrence_index").user_rows(user_ids)
+    blocks = [
+        (start, (bookmarks[start:start + BLOCK_SIZE], history[start:start + BLOCK_SIZE],
+                 user_factors[start:start + BLOCK_SIZE] if user_factors is not None else None))
+        for start in range(0, len(user_ids), BLOCK_SIZE)
+    ]
+    if workers is None:
+        workers = os.cpu_count() if len(user_ids) > POOL_THRESHOLD else 1
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(data,)) as pool:
+            block_results = list(pool.map(_score_worker_block, [(block, method, n) for start, block in blocks]))
+    else:
+        block_results = [score_block(data, block[0], method, n, *block[1:]) for start, block in blocks]
+    results = {}
+    for (start, block), scored in zip(blocks, block_results):
+        for offset, (rows, scores) in enumerate(scored):
+            results[user_ids[start + offset]] = (data.place_ids[rows].tolist(), scores.tolist())
+    return results
+
+
+_worker_data = None
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _score_worker_block(args):
+    block, method, n = args
+    return score_block(_worker_data, block[0], method, n, *block[1:])
+
+
+# -------------------
+# Result Store
+# -------------------
+
+class RecommendationStore:
+    # sqlite table of precomputed recommendations, shared by every worker process on the host
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS recommendations ("
+                "user_id TEXT, method TEXT, length INTEGER, created_at REAL, places TEXT, "
+                "PRIMARY KEY (user_id, method))"
+            )
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def put_many(self, method, length, results):
+        now = time.time()
+        rows = [
+            (user_id, method, length, now, json.dumps([place_ids, scores]))
+            for user_id, (place_ids, scores) in results.items()
+        ]
+        with self._connection() as connection:
+            connection.executemany("INSERT OR REPLACE INTO recommendations VALUES (?, ?, ?, ?, ?)", rows)
+
+    def get(self, user_id, method, length, max_age=RESULT_TTL):
+        # (place ids, scores) when a fresh enough result with at least `length` places exists
+        row = self._connection().execute(
+            "SELECT length, created_at, places FROM recommendations WHERE user_id = ? AND method = ?",
+            (user_id, method),
+        ).fetchone()
+        if row is None or row[0] < length or time.time() - row[1] > max_age:
+            return None
+        place_ids, scores = json.loads(row[2])
+        return place_ids[:length], scores[:length]
+
+    def on_snapshot(self, snapshot, previous):
+        # new places change everyone's scores, bookmarks, interactions and trips only their owners'
+        if previous is None:
+            return
+        if snapshot.changes is None or snapshot.changed("places"):
+            self.clear()
+            return
+        users = changed_users(snapshot, previous)
+        if users:
+            self.delete_users(users)
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM recommendations")
+
+    def delete_users(self, user_ids):
+        with self._connection() as connection:
+            connection.executemany("DELETE FROM recommendations WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+
+
+_store = None
+
+
+def get_result_store():
+    global _store
+    if _store is None:
+        store = RecommendationStore()
+        get_snapshot_store().add_listener(store.on_snapshot)
+        _store = store
+    return _store
+
+
+def run_job(user_ids=None, method="hybrid", length=10, workers=None):
+    # score the given users (default: everyone with bookmarks) and write the results to the store
+    snapshot = get_snapshot()
+    if user_ids is None:
+        user_ids = snapshot.bookmarks["user_id"].dropna().unique().tolist() if "user_id" in snapshot.bookmarks else []
+    start = time.perf_counter()
+    results = score_users(snapshot, user_ids, method=method, n=length, workers=workers)
+    get_result_store().put_many(method, length, results)
+    print(f"Scored {len(results)} users with {method} in {time.perf_counter() - start:.2f}s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute recommendations for many users")
+    parser.add_argument("--method", choices=METHODS, default="hybrid")
+    parser.add_argument("--length", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--users", nargs="*", default=None)
+    args = parser.parse_args()
+    run_job(user_ids=args.users, method=args.method, length=args.length, workers=args.workers)
@@ -0,0 +1,422 @@
+# change ingestion: insert/update/delete events of the tables the models read, from supabase realtime, from polling
+# the updated_at watermark or from a replay file, applied to the snapshot store in micro-batches. every batch is
+# published as an incremental snapshot, so the catalogue, the tag similarity and spatial indexes are patched
+# instead of rebuilt from re-downloaded tables
+import os
+import json
+import time
+import queue
+import asyncio
+import threading
+from collections import deque
+from datetime import datetime
+# shared data snapshots
+from app.data_snapshot import TABLE_KEYS, WATERMARK_COLUMN, RETRY_DELAY, fetch_many, get_store, parse_time, latest_time
+# stage timers and changefeed metrics
+from app.metrics import CHANGES, STALENESS, stage
+
+# installed along with supabase, only the realtime feed needs it
+try:
+    from realtime import AsyncRealtimeClient
+except ImportError:
+    AsyncRealtimeClient = None
+
+# "realtime", "poll" or "replay:<path>", empty leaves freshness to the snapshot store's own refreshes
+FEED = os.environ.get("BENA_CHANGEFEED", "")
+TABLES = ("places", "bookmarks", "interactions", "trips", "tripstep")
+# a batch is applied once it holds BATCH_SIZE changes or BATCH_DELAY seconds after its first one
+BATCH_SIZE = int(os.environ.get("BENA_CHANGEFEED_BATCH_SIZE", "500"))
+BATCH_DELAY = float(os.environ.get("BENA_CHANGEFEED_BATCH_DELAY", "0.5"))
+# changes queued before feeds are held back, and how long a feed waits for room before a change is dropped
+# and the store reloads the tables instead
+MAX_QUEUED = int(os.environ.get("BENA_CHANGEFEED_MAX_QUEUED", "10000"))
+SUBMIT_TIMEOUT = float(os.environ.get("BENA_CHANGEFEED_SUBMIT_TIMEOUT", "5"))
+POLL_INTERVAL = float(os.environ.get("BENA_CHANGEFEED_POLL_INTERVAL", "2"))
+# polls between key listings, which find deletes and inserts on tables without updated_at
+KEY_POLL_EVERY = int(os.environ.get("BENA_CHANGEFEED_KEY_POLL_EVERY", "10"))
+# commit to publish delays kept for the staleness report
+STALENESS_WINDOW = 1000
+
+
+def percentile(values, share):
+    # of sorted values
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+class Change:
+    # one row change, commit_time is when the database committed it in epoch seconds, None when unknown
+    __slots__ = ("table", "operation", "key", "record", "commit_time", "received_at")
+
+    def __init__(self, table, operation, key, record=None, commit_time=None):
+        self.table = table
+        self.operation = operation
+        self.key = key
+        self.record = record
+        self.commit_time = commit_time
+        self.received_at = time.time()
+
+    @classmethod
+    def from_payload(cls, data):
+        # a realtime postgres_changes payload: {"table", "type", "record", "old_record", "commit_timestamp"},
+        # deletes only carry the key in old_record
+        table, operation = data["table"], data["type"].upper()
+        record, old = data.get("record") or {}, data.get("old_record") or {}
+        key = TABLE_KEYS[table]
+        return cls(table, operation, record.get(key, old.get(key)), record if operation != "DELETE" else None,
+                   parse_time(data.get("commit_timestamp")))
+
+    def payload(self):
+        # the realtime payload of this change, the lines of replay files
+        key = TABLE_KEYS[self.table]
+        commit = datetime.fromtimestamp(self.commit_time).astimezone().isoformat() if self.commit_time is not None else None
+        return {
+            "table": self.table,
+            "type": self.operation,
+            "record": self.record if self.operation != "DELETE" else None,
+            "old_record": {key: self.key} if self.operation != "INSERT" else {},
+            "commit_timestamp": commit,
+        }
+
+
+# -------------------
+# Feeds
+# -------------------
+
+class ReplayFeed:
+    # changes from a JSON lines file of realtime payloads. speed 0 sends them as fast as the changefeed takes them,
+    # 1 at the recorded pace. commit times are moved to the moment a change is sent, staleness is then measured
+    # like for live changes
+    def __init__(self, path, speed=0.0):
+        self.path = path
+        self.speed = speed
+
+    def run(self, changefeed):
+        start, first = time.time(), None
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                if changefeed.stopped:
+                    return
+                if not line.strip():
+                    continue
+                change = Change.from_payload(json.loads(line))
+                if self.speed and change.commit_time is not None:
+                    first = change.commit_time if first is None else first
+                    delay = start + (change.commit_time - first) / self.speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                change.commit_time = change.received_at = time.time()
+                changefeed.submit(change)
+
+
+def write_replay(path, changes):
+    # a replay file of changes, e.g. to record a load pattern for ReplayFeed
+    with open(path, "w", encoding="utf-8") as file:
+        for change in changes:
+            file.write(json.dumps(change.payload(), ensure_ascii=False, default=str) + "\n")
+
+
+class PollFeed:
+    # rows past the updated_at watermark of every table, for deployments without realtime. every KEY_POLL_EVERY
+    # polls the key columns are listed too, which finds deletes and rows inserted into tables without updated_at
+    def __init__(self, source=None, tables=TABLES, interval=POLL_INTERVAL, key_poll_every=KEY_POLL_EVERY):
+        self.source = source
+        self.tables = tables
+        self.interval = interval
+        self.key_poll_every = key_poll_every
+
+    def run(self, changefeed):
+        source = self.source if self.source is not None else changefeed.store.source
+        # start from what the current snapshot holds
+        snapshot = changefeed.store.get()
+        known, watermarks = {}, {}
+        for table in self.tables:
+            frame, key = snapshot.tables[table], TABLE_KEYS[table]
+            known[table] = set(frame[key])
+            watermarks[table] = latest_time(frame[WATERMARK_COLUMN]) if WATERMARK_COLUMN in frame else None
+        polls = 0
+        while not changefeed.idle(self.interval):
+            polls += 1
+            for change in self.poll(source, known, watermarks, list_keys=polls % self.key_poll_every == 0):
+                if not changefeed.submit(change):
+                    # the store reloads every table, the watermarks are still good to carry on from
+                    break
+
+    def poll(self, source, known, watermarks, list_keys=False):
+        # the changes since the last poll, known keys and watermarks are advanced in place
+        requests, tables = [], [table for table in self.tables if watermarks[table] is not None or list_keys]
+        for table in tables:
+            key = TABLE_KEYS[table]
+            if watermarks[table] is not None:
+                requests.append({"table": table, "since": (WATERMARK_COLUMN, watermarks[table]), "key": key})
+            if list_keys:
+                requests.append({"table": table, "columns": key, "key": key})
+        results = iter(fetch_many(source, requests))
+        changes, inserted = [], {}
+        for table in tables:
+            key = TABLE_KEYS[table]
+            rows = next(results) if watermarks[table] is not None else []
+            for row in rows:
+                operation = "UPDATE" if row[key] in known[table] else "INSERT"
+                changes.append(Change(table, operation, row[key], row, parse_time(row.get(WATERMARK_COLUMN))))
+                known[table].add(row[key])
+            if rows:
+                watermarks[table] = latest_time([watermarks[table]] + [row.get(WATERMARK_COLUMN) for row in rows])
+            if list_keys:
+                keys = {row[key] for row in next(results)}
+                changes += [Change(table, "DELETE", deleted) for deleted in known[table] - keys]
+                inserted[table] = keys - known[table]
+                known[table] = keys
+        # rows the watermark didn't cover, their commit time is unknown
+        inserted = {table: ids for table, ids in inserted.items() if ids}
+        rows = fetch_many(source, [{"table": table, "ids": ids, "key": TABLE_KEYS[table]} for table, ids in inserted.items()])
+        for table, table_rows in zip(inserted, rows):
+            changes += [Change(table, "INSERT", row[TABLE_KEYS[table]], row) for row in table_rows]
+        return changes
+
+
+class RealtimeFeed:
+    # supabase realtime postgres_changes of the tables, replication has to be switched on for them.
+    # callbacks run on the feed's event loop, while the changefeed queue is full they block it and the socket
+    # is read slower
+    def __init__(self, url=None, key=None, tables=TABLES):
+        self.url = (url or os.environ.get("SUPABASE_URL") or "").rstrip("/")
+        self.key = key or os.environ.get("SUPABASE_KEY")
+        self.tables = tables
+
+    def run(self, changefeed):
+        if AsyncRealtimeClient is None:
+            raise RuntimeError("The realtime changefeed needs the realtime package")
+        asyncio.run(self._listen(changefeed))
+
+    async def _listen(self, changefeed):
+        client = AsyncRealtimeClient(f"{self.url}/realtime/v1", token=self.key)
+        await client.connect()
+        channel = client.channel("bena-changefeed")
+        for table in self.tables:
+            channel.on_postgres_changes("*", callback=lambda payload: self._on_change(changefeed, payload), table=table, schema="public")
+        # changes made before (re)subscribing are caught up by a store refresh
+        await channel.subscribe(lambda state, error: changefeed.store.request_refresh())
+        try:
+            while not changefeed.stopped:
+                await asyncio.sleep(1)
+        finally:
+            await client.close()
+
+    def _on_change(self, changefeed, payload):
+        try:
+            change = Change.from_payload(payload["data"])
+        except (KeyError, TypeError, AttributeError) as error:
+            print(f"Unreadable change payload: {error}")
+            return
+        changefeed.submit(change)
+
+
+# -------------------
+# Changefeed
+# -------------------
+
+class Changefeed:
+    # queues the changes of a feed and applies them to the snapshot store in micro-batches. the queue is bounded,
+    # feeds are held back while it is full, a change that can't be queued in time is dropped and the store
+    # reloads every table once the queue is drained
+    def __init__(self, store, feed, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY, max_queued=MAX_QUEUED,
+                 submit_timeout=SUBMIT_TIMEOUT):
+        self.store = store
+        self.feed = feed
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.submit_timeout = submit_timeout
+        self.applied = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.batches = 0
+        self.last_error = None
+        self._queue = queue.Queue(max_queued)
+        self._delays = deque(maxlen=STALENESS_WINDOW)
+        self._resync = False
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def idle(self, seconds):
+        # sleep for feeds, True once the changefeed is stopped
+        return self._stopped.wait(seconds)
+
+    def submit(self, change):
+        # called by feeds, blocks while the queue is full, False when the change was dropped
+        try:
+            self._queue.put(change, timeout=self.submit_timeout)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._resync = True
+            CHANGES.inc(table=change.table, operation=change.operation, outcome="dropped")
+            return False
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopped.clear()
+        self._threads = [
+            threading.Thread(target=self._run_feed, name="changefeed-feed", daemon=True),
+            threading.Thread(target=self._run_batches, name="changefeed-apply", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def wait(self):
+        # until the feed has run out, e.g. a replay file, and every queued change is applied
+        if self._threads:
+            self._threads[0].join()
+        self._queue.join()
+
+    def _run_feed(self):
+        # feeds that fail are restarted, one that returns has run out
+        while not self._stopped.is_set():
+            try:
+                self.feed.run(self)
+                return
+            except Exception as error:
+                self.last_error = str(error)
+                print(f"Changefeed failed: {error}")
+                self._stopped.wait(RETRY_DELAY)
+
+    def _run_batches(self):
+        while not self._stopped.is_set():
+            batch = self._next_batch()
+            try:
+                if batch:
+                    self.apply(batch)
+                if self._resync and self._queue.empty():
+                    self._resync = False
+                    self.store.refresh(full=True)
+            except Exception as error:
+                # the store keeps serving the last good snapshot, its next refresh catches up
+                self.last_error = str(error)
+                print(f"Changefeed batch failed: {error}")
+                self.store.request_refresh()
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _next_batch(self):
+        # up to batch_size changes, waiting at most batch_delay after the first one
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def apply(self, changes):
+        # the last change of every row wins, the batch is published as one snapshot
+        tables = {}
+        for change in changes:
+            if change.table not in TABLE_KEYS or change.key is None:
+                continue
+            rows, deleted = tables.setdefault(change.table, ({}, set()))
+            if change.operation == "DELETE":
+                rows.pop(change.key, None)
+                deleted.add(change.key)
+            else:
+                rows[change.key] = change.record
+                deleted.discard(change.key)
+        superseded = self._drop_superseded(tables)
+        with stage("changefeed.apply"):
+            self.store.apply_changes({table: (list(rows.values()), deleted) for table, (rows, deleted) in tables.items()})
+        published = time.time()
+        delays = []
+        for change in changes:
+            outcome = "superseded" if (change.table, change.key) in superseded else "applied"
+            CHANGES.inc(table=change.table, operation=change.operation, outcome=outcome)
+            if change.commit_time is not None:
+                delays.append(published - change.commit_time)
+                STALENESS.observe(published - change.commit_time)
+        with self._lock:
+            self.applied += len(changes) - len(superseded)
+            self.superseded += len(superseded)
+            self.batches += 1
+            self._delays.extend(delays)
+
+    def _drop_superseded(self, tables):
+        # upserts older than the row the snapshot already holds, e.g. a store refresh got there first
+        snapshot = self.store.get()
+        superseded = set()
+        for table, (rows, deleted) in tables.items():
+            frame, key = snapshot.tables.get(table), TABLE_KEYS[table]
+            if frame is None or WATERMARK_COLUMN not in frame or not rows:
+                continue
+            current = frame.loc[frame[key].isin(rows.keys()), [key, WATERMARK_COLUMN]].dropna()
+            for row_key, updated_at in zip(current[key], current[WATERMARK_COLUMN]):
+                # compared as instants, the feeds and the snapshot don't format timestamps alike
+                record_time, current_time = parse_time(rows[row_key].get(WATERMARK_COLUMN)), parse_time(updated_at)
+                if record_time is not None and current_time is not None and record_time < current_time:
+                    del rows[row_key]
+                    superseded.add((table, row_key))
+        return superseded
+
+    def report(self):
+        # end to end staleness: commit to publish delays of the recent changes, and how long the oldest
+        # change still queued has been waiting
+        with self._lock:
+            delays = sorted(self._delays)
+            applied, superseded, dropped, batches = self.applied, self.superseded, self.dropped, self.batches
+        with self._queue.mutex:
+            oldest = self._queue.queue[0].received_at if self._queue.queue else None
+        return {
+            "feed": type(self.feed).__name__,
+            "running": bool(self._threads) and not self.stopped,
+            "queued": self._queue.qsize(),
+            "oldest_queued_seconds": round(time.time() - oldest, 3) if oldest is not None else 0.0,
+            "applied": applied,
+            "superseded": superseded,
+            "dropped": dropped,
+            "batches": batches,
+            "staleness_p50_seconds": percentile(delays, 0.5),
+            "staleness_p95_seconds": percentile(delays, 0.95),
+            "staleness_max_seconds": delays[-1] if delays else None,
+            "last_error": self.last_error,
+        }
+
+
+def make_feed(name=FEED):
+    if name == "realtime":
+        return RealtimeFeed()
+    if name == "poll":
+        return PollFeed()
+    if name.startswith("replay:"):
+        return ReplayFeed(name[len("replay:"):])
+    raise ValueError(f"Unknown changefeed {name!r}, expected realtime, poll or replay:<path>")
+
+
+_changefeed = None
+_changefeed_lock = threading.Lock()
+
+
+def get_changefeed():
+    # the process wide changefeed on the process wide store, None when BENA_CHANGEFEED is not set
+    global _changefeed
+    if _changefeed is None and FEED:
+        with _changefeed_lock:
+            if _changefeed is None:
+                _changefeed = Changefeed(get_store(), make_feed())
+    return _changefeed
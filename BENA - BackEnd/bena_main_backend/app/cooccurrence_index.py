@@ -0,0 +1,308 @@
+# item-item collaborative filter from places that appear together in trips and bookmark lists
+import os
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+# shared data snapshots
+from app.data_snapshot import register_derived
+
+# neighbours kept per place
+TOP_K = int(os.environ.get("BENA_COOCCURRENCE_TOP_K", "50"))
+# damps the confidence of places that appear in only a few baskets
+SHRINKAGE = 2.0
+# above this share of changed baskets a full rebuild is cheaper than patching
+MAX_INCREMENTAL_SHARE = 0.1
+# patched baskets and histories leave empty rows behind, they are dropped once this share of the rows is empty
+MAX_STALE_SHARE = 0.2
+# latent factors fitted with implicit ALS when the library is installed, 0 turns them off
+ALS_FACTORS = int(os.environ.get("BENA_ALS_FACTORS", "32"))
+ALS_REGULARIZATION = 0.05
+ALS_ALPHA = 10.0
+ALS_ITERATIONS = 15
+# share of the latent score in the blended collaborative score
+ALS_WEIGHT = 0.5
+
+try:
+    from implicit.als import AlternatingLeastSquares
+except ImportError:
+    AlternatingLeastSquares = None
+
+
+def trip_steps(snapshot, trip_ids=None, user_ids=None):
+    # (trip_id, user_id, place_id) of the steps of all trips, or of the given trips or users' trips
+    steps, trips = snapshot.tripstep, snapshot.trips
+    if "trip_id" not in steps or "place_id" not in steps:
+        return pd.DataFrame(columns=["trip_id", "user_id", "place_id"])
+    owners = trips[["trip_id", "user_id"]] if "trip_id" in trips and "user_id" in trips else pd.DataFrame(columns=["trip_id", "user_id"])
+    if user_ids is not None:
+        owners = owners[owners["user_id"].isin(user_ids)]
+        trip_ids = set(owners["trip_id"]) | (set(trip_ids) if trip_ids is not None else set())
+    if trip_ids is not None:
+        steps = steps[steps["trip_id"].isin(trip_ids)]
+    return steps[["trip_id", "place_id"]].merge(owners, on="trip_id", how="left")
+
+
+def user_bookmarks(snapshot, user_ids=None):
+    bookmarks = snapshot.bookmarks
+    if "user_id" not in bookmarks or "place_id" not in bookmarks:
+        return pd.DataFrame(columns=["user_id", "place_id"])
+    if user_ids is not None:
+        bookmarks = bookmarks[bookmarks["user_id"].isin(user_ids)]
+    return bookmarks[["user_id", "place_id"]]
+
+
+def binary_matrix(keys, place_ids, row_of_key, row_of_place, shape):
+    # 1 where a basket (or user) contains a place, duplicates count once
+    rows, cols = [], []
+    for key, place_id in zip(keys, place_ids):
+        row, col = row_of_key.get(key), row_of_place.get(place_id)
+        if row is not None and col is not None:
+            rows.append(row)
+            cols.append(col)
+    matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
+    matrix.data[:] = 1
+    return matrix
+
+
+def top_k(matrix, k):
+    # keep the best k entries of every row
+    matrix = matrix.tocsr()
+    matrix.eliminate_zeros()
+    counts = np.diff(matrix.indptr)
+    if counts.max(initial=0) <= k:
+        return matrix
+    keep = np.ones(matrix.nnz, dtype=bool)
+    for row in np.flatnonzero(counts > k):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        drop = np.argpartition(matrix.data[start:end], -k)[:-k]
+        keep[start + drop] = False
+    matrix.data[~keep] = 0
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def scale_rows(scores):
+    # every row divided by its maximum, rows without a positive score stay 0
+    top = scores.max(axis=1, keepdims=True)
+    return np.divide(scores, top, out=np.zeros_like(scores), where=top > 0)
+
+
+def collaborative_scores(history, matrix, user_factors=None, item_factors=None):
+    # users x places scores in [0, 1], a sparse dot product of each user's history with the top-K rows,
+    # blended with the latent scores when there are factors
+    scores = scale_rows(np.asarray((history @ matrix).todense(), dtype=np.float32))
+    if item_factors is not None:
+        latent = np.maximum(user_factors @ item_factors.T, 0)
+        scores = (1 - ALS_WEIGHT) * scores + ALS_WEIGHT * scale_rows(latent)
+    return scores
+
+
+class CooccurrenceIndex:
+    # baskets are trips and per-user bookmark lists, `matrix` holds P(place j | place i) for the top-K j per row,
+    # rows and columns are aligned with the snapshot places frame
+    def __init__(self, ids, basket_row, baskets, counts, frequency, user_row, history, matrix, factors, k, build_seconds):
+        self.ids = ids
+        self.row_of = {place_id: row for row, place_id in enumerate(ids)}
+        self.basket_row = basket_row
+        self.baskets = baskets
+        self.counts = counts
+        self.frequency = frequency
+        self.user_row = user_row
+        self.history = history
+        self.matrix = matrix
+        # (user factors aligned with user_row, item factors, item gram matrix) or None
+        self.factors = factors
+        self.k = k
+        self.build_seconds = build_seconds
+
+    @classmethod
+    def build(cls, ids, steps, bookmarks, k=TOP_K):
+        start = time.perf_counter()
+        ids = np.asarray(ids, dtype=object)
+        row_of = {place_id: row for row, place_id in enumerate(ids)}
+        keys = [("trip", trip_id) for trip_id in steps["trip_id"]] + [("bookmarks", user_id) for user_id in bookmarks["user_id"]]
+        place_ids = steps["place_id"].tolist() + bookmarks["place_id"].tolist()
+        basket_row = {key: row for row, key in enumerate(dict.fromkeys(keys))}
+        baskets = binary_matrix(keys, place_ids, basket_row, row_of, (len(basket_row), len(ids)))
+        counts = cls._cooccurrences(baskets, baskets)
+        frequency = np.asarray(baskets.sum(axis=0), dtype=np.float32).ravel()
+        # a user's history is everything they bookmarked or put in one of their trips
+        users = steps["user_id"].tolist() + bookmarks["user_id"].tolist()
+        user_row = {user_id: row for row, user_id in enumerate(dict.fromkeys(user for user in users if pd.notna(user)))}
+        history = binary_matrix(users, place_ids, user_row, row_of, (len(user_row), len(ids)))
+        matrix = top_k(sp.diags(1 / (frequency + SHRINKAGE)) @ counts, k)
+        factors = cls._fit_factors(history)
+        return cls(ids, basket_row, baskets, counts, frequency, user_row, history, matrix, factors, k, time.perf_counter() - start)
+
+    @staticmethod
+    def _cooccurrences(left, right):
+        counts = (left.T @ right).tocsr()
+        counts.setdiag(0)
+        counts.eliminate_zeros()
+        return counts
+
+    @staticmethod
+    def _compact(row_of, matrix):
+        # (row_of, matrix, kept rows) without the rows no key points to and the keys of empty rows,
+        # kept rows is None while the empty rows stay under MAX_STALE_SHARE
+        nonempty = np.diff(matrix.indptr) > 0
+        live = sorted((row, key) for key, row in row_of.items() if nonempty[row])
+        if matrix.shape[0] - len(live) <= MAX_STALE_SHARE * matrix.shape[0]:
+            return row_of, matrix, None
+        kept = np.array([row for row, key in live], dtype=np.int64)
+        return {key: new for new, (row, key) in enumerate(live)}, matrix[kept], kept
+
+    @staticmethod
+    def _fit_factors(history):
+        if AlternatingLeastSquares is None or ALS_FACTORS <= 0 or history.nnz == 0:
+            return None
+        model = AlternatingLeastSquares(
+            factors=ALS_FACTORS, regularization=ALS_REGULARIZATION, alpha=ALS_ALPHA,
+            iterations=ALS_ITERATIONS, use_gpu=False, random_state=0,
+        )
+        model.fit(history, show_progress=False)
+        items = np.asarray(model.item_factors, dtype=np.float32)
+        return np.asarray(model.user_factors, dtype=np.float32), items, items.T @ items
+
+    def _fold_in(self, history, factors):
+        # least squares user factors against fixed item factors, used for users whose history changed
+        user_factors, items, gram = factors
+        regularization = ALS_REGULARIZATION * np.eye(items.shape[1], dtype=np.float32)
+        rows = []
+        for user in range(history.shape[0]):
+            seen = items[history.indices[history.indptr[user]:history.indptr[user + 1]]]
+            a = gram + ALS_ALPHA * seen.T @ seen + regularization
+            rows.append(np.linalg.solve(a, (1 + ALS_ALPHA) * seen.sum(axis=0)))
+        return np.array(rows, dtype=np.float32).reshape(-1, items.shape[1])
+
+    def update(self, ids, steps, bookmarks, trip_ids, user_ids, user_steps, user_marks):
+        # a new index after the given trips and users' bookmarks changed, None when a full build is needed.
+        # steps/bookmarks hold the current rows of the changed baskets, user_steps/user_marks the full history
+        # of the changed users
+        start = time.perf_counter()
+        if len(ids) != len(self.ids) or any(a != b for a, b in zip(ids, self.ids)):
+            return None
+        keys = [("trip", trip_id) for trip_id in trip_ids] + [("bookmarks", user_id) for user_id in user_ids]
+        if len(keys) > MAX_INCREMENTAL_SHARE * max(len(self.basket_row), 1):
+            return None
+        shape = len(self.ids)
+
+        # the changed baskets' old rows are taken out of the counts and their current contents put in
+        old_rows = [self.basket_row[key] for key in keys if key in self.basket_row]
+        old = self.baskets[old_rows]
+        new_row = {key: row for row, key in enumerate(keys)}
+        new = binary_matrix(
+            [("trip", trip_id) for trip_id in steps["trip_id"]] + [("bookmarks", user_id) for user_id in bookmarks["user_id"]],
+            steps["place_id"].tolist() + bookmarks["place_id"].tolist(), new_row, self.row_of, (len(keys), shape),
+        )
+        counts = self.counts - self._cooccurrences(old, old) + self._cooccurrences(new, new)
+        counts.eliminate_zeros()
+        frequency = self.frequency - np.asarray(old.sum(axis=0)).ravel() + np.asarray(new.sum(axis=0)).ravel()
+
+        # stale basket rows are zeroed and the new ones appended
+        mask = np.ones(self.baskets.shape[0], dtype=np.float32)
+        mask[old_rows] = 0
+        basket_row = dict(self.basket_row)
+        for key, row in new_row.items():
+            basket_row[key] = self.baskets.shape[0] + row
+        baskets = sp.vstack([sp.diags(mask) @ self.baskets, new]).tocsr()
+        basket_row, baskets, _ = self._compact(basket_row, baskets)
+
+        # only rows of places in a changed basket can change
+        touched = np.union1d(old.indices, new.indices)
+        untouched = np.ones(shape, dtype=np.float32)
+        untouched[touched] = 0
+        recomputed = sp.diags(1 - untouched) @ (sp.diags(1 / (frequency + SHRINKAGE)) @ counts)
+        matrix = top_k(sp.diags(untouched) @ self.matrix + recomputed, self.k)
+
+        # the same for the history of the changed users
+        users = list(dict.fromkeys(list(user_ids) + [user for user in user_steps["user_id"] if pd.notna(user)]))
+        old_users = [self.user_row[user] for user in users if user in self.user_row]
+        user_mask = np.ones(self.history.shape[0], dtype=np.float32)
+        user_mask[old_users] = 0
+        changed_user_row = {user: row for row, user in enumerate(users)}
+        changed_history = binary_matrix(
+            user_steps["user_id"].tolist() + user_marks["user_id"].tolist(),
+            user_steps["place_id"].tolist() + user_marks["place_id"].tolist(),
+            changed_user_row, self.row_of, (len(users), shape),
+        )
+        user_row = dict(self.user_row)
+        for user, row in changed_user_row.items():
+            user_row[user] = self.history.shape[0] + row
+        history = sp.vstack([sp.diags(user_mask) @ self.history, changed_history]).tocsr()
+        factors = self.factors
+        if factors is not None:
+            factors = (np.vstack([factors[0], self._fold_in(changed_history, factors)]), factors[1], factors[2])
+        user_row, history, kept = self._compact(user_row, history)
+        if factors is not None and kept is not None:
+            factors = (factors[0][kept], factors[1], factors[2])
+        return CooccurrenceIndex(
+            self.ids, basket_row, baskets, counts.tocsr(), frequency, user_row, history, matrix.tocsr(), factors, self.k,
+            self.build_seconds + time.perf_counter() - start,
+        )
+
+    def user_places(self, user_id):
+        # rows of the places in a user's history
+        row = self.user_row.get(user_id)
+        if row is None:
+            return np.zeros(0, dtype=np.int32)
+        return self.history.indices[self.history.indptr[row]:self.history.indptr[row + 1]]
+
+    def user_rows(self, user_ids):
+        # (users x places history, users x factors or None) of the given users, empty rows for unknown users
+        rows = np.array([self.user_row.get(user_id, -1) for user_id in user_ids], dtype=int)
+        known = rows >= 0
+        history = sp.csr_matrix((len(rows), len(self.ids)), dtype=np.float32)
+        if known.any():
+            history = (sp.diags(known.astype(np.float32)) @ self.history[np.maximum(rows, 0)]).tocsr()
+        user_factors = None
+        if self.factors is not None:
+            user_factors = np.where(known[:, None], self.factors[0][np.maximum(rows, 0)], 0).astype(np.float32)
+        return history, user_factors
+
+    def scores(self, user_ids):
+        history, user_factors = self.user_rows(user_ids)
+        return collaborative_scores(history, self.matrix, user_factors, self.factors[1] if self.factors is not None else None)
+
+    def stats(self):
+        nbytes = self.matrix.data.nbytes + self.matrix.indices.nbytes + self.counts.data.nbytes + self.counts.indices.nbytes
+        return {
+            "places": len(self.ids),
+            "baskets": len(self.basket_row),
+            "users": len(self.user_row),
+            "nnz": int(self.matrix.nnz),
+            "factors": 0 if self.factors is None else self.factors[1].shape[1],
+            "bytes": int(nbytes),
+            "build_seconds": round(self.build_seconds, 4),
+        }
+
+
+# -------------------
+# Snapshot integration
+# -------------------
+
+def build_cooccurrence_index(snapshot):
+    return CooccurrenceIndex.build(snapshot.places["places_id"].tolist(), trip_steps(snapshot), user_bookmarks(snapshot))
+
+
+def update_cooccurrence_index(index, snapshot):
+    if snapshot.changed("places"):
+        return None
+    previous = snapshot.parent
+    # trips whose steps or owner changed, and users whose bookmarks or trips changed
+    trip_ids = set(snapshot.changed("trips") or ()) | snapshot.changed_values("tripstep", "trip_id", previous)
+    user_ids = snapshot.changed_values("bookmarks", "user_id", previous) | snapshot.changed_values("trips", "user_id", previous)
+    if not trip_ids and not user_ids:
+        return index
+    steps = trip_steps(snapshot, trip_ids=trip_ids)
+    user_ids |= {user for user in steps["user_id"] if pd.notna(user)}
+    return index.update(
+        snapshot.places["places_id"].tolist(),
+        steps, user_bookmarks(snapshot, user_ids=user_ids),
+        sorted(trip_ids), sorted(user_ids),
+        trip_steps(snapshot, user_ids=user_ids), user_bookmarks(snapshot, user_ids=user_ids),
+    )
+
+
+register_derived("cooccurrence_index", build_cooccurrence_index, update_cooccurrence_index)
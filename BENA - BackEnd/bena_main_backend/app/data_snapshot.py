@@ -0,0 +1,560 @@
+# shared in-process data snapshots for all the models
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import os
+import time
+import asyncio
+import threading
+import httpx
+import pandas as pd
+from datetime import datetime
+from supabase import create_client, Client
+# stage timers
+from app.metrics import stage, timed
+
+# primary key of every table the models read
+TABLE_KEYS = {
+    "places": "places_id",
+    "bookmarks": "bookmark_id",
+    "interactions": "id",
+    "trips": "trip_id",
+    "tripstep": "step_id",
+}
+# column used as the incremental watermark for row updates
+WATERMARK_COLUMN = "updated_at"
+# supabase returns at most this many rows per request
+PAGE_SIZE = 1000
+# keys per `in` filter, keeps request urls short
+ID_CHUNK = 200
+# pooled connections of the async client
+MAX_CONNECTIONS = int(os.environ.get("BENA_DB_MAX_CONNECTIONS", "10"))
+HTTP_TIMEOUT = float(os.environ.get("BENA_DB_TIMEOUT", "30"))
+# seconds between background refreshes
+SNAPSHOT_TTL = float(os.environ.get("BENA_SNAPSHOT_TTL", "60"))
+# where models and indexes are persisted between restarts
+DATA_DIR = os.environ.get("BENA_DATA_DIR", "data")
+# every n refreshes reload whole tables to pick up updates on tables without updated_at
+FULL_REFRESH_EVERY = int(os.environ.get("BENA_FULL_REFRESH_EVERY", "30"))
+# seconds between attempts while the first snapshot can't be loaded
+RETRY_DELAY = float(os.environ.get("BENA_SNAPSHOT_RETRY_DELAY", "5"))
+
+
+def parse_time(value):
+    # epoch seconds of an ISO timestamp as postgres sends them, None when missing or unreadable
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def latest_time(values):
+    # the latest of ISO timestamps compared as times, not as strings that differ in offset or precision,
+    # None when none of them can be read
+    values = list(values)
+    times = pd.to_datetime(pd.Series(values, dtype=object), utc=True, errors="coerce", format="ISO8601")
+    if not times.notna().any():
+        return None
+    return values[int(times.idxmax())]
+
+
+# -------------------
+# Data Sources
+# -------------------
+
+class SupabaseSource:
+    # reads tables from supabase, the client is only created on first use
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self) -> Client:
+        if self._client is None:
+            url: str = os.environ.get("SUPABASE_URL")
+            key: str = os.environ.get("SUPABASE_KEY")
+            self._client = create_client(url, key)
+        return self._client
+
+    def fetch(self, table, columns="*", since=None, ids=None, key=None):
+        # since is a (column, value) pair, ids restricts rows to the given keys
+        if ids is not None:
+            rows = []
+            ids = list(ids)
+            for start in range(0, len(ids), ID_CHUNK):
+                response = self.client.table(table).select(columns).in_(key, ids[start:start + ID_CHUNK]).execute()
+                rows.extend(response.data)
+            return rows
+        rows = []
+        start = 0
+        while True:
+            query = self.client.table(table).select(columns)
+            if since is not None:
+                query = query.gt(since[0], since[1])
+            if key is not None:
+                # a stable order so pages don't overlap
+                query = query.order(key)
+            response = query.range(start, start + PAGE_SIZE - 1).execute()
+            rows.extend(response.data)
+            if len(response.data) < PAGE_SIZE:
+                return rows
+            start += PAGE_SIZE
+
+
+class AsyncSupabaseSource:
+    # reads tables through the supabase REST api with a pooled async http client,
+    # the client lives on its own event loop thread so fetches can be gathered from any thread
+    def __init__(self, url=None, key=None, max_connections=MAX_CONNECTIONS, timeout=HTTP_TIMEOUT, transport=None):
+        self.url = (url or os.environ.get("SUPABASE_URL") or "").rstrip("/")
+        self.key = key or os.environ.get("SUPABASE_KEY")
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.transport = transport
+        self._client = None
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="db-io", daemon=True).start()
+                self._loop = loop
+        return self._loop
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # only touched from the io loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=f"{self.url}/rest/v1",
+                headers={"apikey": self.key or "", "Authorization": f"Bearer {self.key or ''}"},
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+                timeout=self.timeout,
+                transport=self.transport,
+            )
+        return self._client
+
+    async def _get(self, table, params):
+        response = await self.client.get(f"/{table}", params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def fetch_async(self, table, columns="*", since=None, ids=None, key=None):
+        if ids is not None:
+            ids = list(ids)
+            chunks = [ids[start:start + ID_CHUNK] for start in range(0, len(ids), ID_CHUNK)]
+            pages = await asyncio.gather(*(
+                self._get(table, {"select": columns, key: "in.(" + ",".join(f'"{value}"' for value in chunk) + ")"})
+                for chunk in chunks
+            ))
+            return [row for page in pages for row in page]
+        params = {"select": columns, "limit": PAGE_SIZE}
+        if since is not None:
+            params[since[0]] = f"gt.{since[1]}"
+        if key is not None:
+            # a stable order so pages don't overlap
+            params["order"] = f"{key}.asc"
+        rows = []
+        offset = 0
+        while True:
+            page = await self._get(table, dict(params, offset=offset))
+            rows.extend(page)
+            if len(page) < PAGE_SIZE:
+                return rows
+            offset += PAGE_SIZE
+
+    async def fetch_many_async(self, requests):
+        # every request runs concurrently on the pooled client
+        return await asyncio.gather(*(self.fetch_async(**request) for request in requests))
+
+    def fetch_many(self, requests):
+        future = asyncio.run_coroutine_threadsafe(self.fetch_many_async(requests), self._ensure_loop())
+        return future.result()
+
+    def fetch(self, table, columns="*", since=None, ids=None, key=None):
+        return self.fetch_many([{"table": table, "columns": columns, "since": since, "ids": ids, "key": key}])[0]
+
+    def close(self):
+        if self._loop is None:
+            return
+        if self._client is not None:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+            self._client = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = None
+
+
+class LocalSource:
+    # in-memory tables with the same interface as SupabaseSource, used by tests and benchmarks
+    def __init__(self, tables=None):
+        self.tables = {name: list(rows) for name, rows in (tables or {}).items()}
+        self._lock = threading.Lock()
+
+    def fetch(self, table, columns="*", since=None, ids=None, key=None):
+        with self._lock:
+            rows = list(self.tables.get(table, []))
+        if since is not None:
+            after = parse_time(since[1])
+            rows = [row for row in rows if (parse_time(row.get(since[0])) or float("-inf")) > after]
+        if ids is not None:
+            ids = set(ids)
+            rows = [row for row in rows if row.get(key) in ids]
+        if columns != "*":
+            names = [name.strip() for name in columns.split(",")]
+            rows = [{name: row.get(name) for name in names} for row in rows]
+        return [dict(row) for row in rows]
+
+    def upsert(self, table, rows):
+        key = TABLE_KEYS[table]
+        with self._lock:
+            current = {row[key]: row for row in self.tables.get(table, [])}
+            for row in rows:
+                current[row[key]] = dict(row)
+            self.tables[table] = list(current.values())
+
+    def delete(self, table, ids):
+        key = TABLE_KEYS[table]
+        ids = set(ids)
+        with self._lock:
+            self.tables[table] = [row for row in self.tables.get(table, []) if row[key] not in ids]
+
+
+def fetch_many(source, requests):
+    # sources with fetch_many run the requests concurrently
+    if hasattr(source, "fetch_many"):
+        return source.fetch_many(requests)
+    return [source.fetch(**request) for request in requests]
+
+
+# -------------------
+# Snapshots
+# -------------------
+
+# values computed from a snapshot (models, indexes), registered by the model modules
+DERIVED = {}
+
+
+def register_derived(name, build, update=None):
+    # build(snapshot) computes the value from scratch
+    # update(previous_value, snapshot) patches the parent snapshot's value using snapshot.changes,
+    # it may return None to fall back to a full build
+    DERIVED[name] = (build, update)
+
+
+class Snapshot:
+    # an immutable view of all tables, readers must never mutate the frames in place
+    def __init__(self, version, tables, changes=None, parent=None):
+        self.version = version
+        self.tables = tables
+        # {table: (upserted keys, deleted keys)} relative to the parent snapshot, None after a full reload
+        self.changes = changes
+        self.created_at = time.time()
+        self._parent = parent
+        self._derived = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def parent(self):
+        # the snapshot this one was derived from, only kept while its derived values are built
+        return self._parent
+
+    @property
+    def places(self):
+        return self.tables["places"]
+
+    @property
+    def bookmarks(self):
+        return self.tables["bookmarks"]
+
+    @property
+    def interactions(self):
+        return self.tables["interactions"]
+
+    @property
+    def trips(self):
+        return self.tables["trips"]
+
+    @property
+    def tripstep(self):
+        return self.tables["tripstep"]
+
+    def changed(self, table):
+        # keys upserted or deleted in a table since the parent snapshot, None when unknown
+        if self.changes is None:
+            return None
+        upserted, deleted = self.changes.get(table, (set(), set()))
+        return upserted | deleted
+
+    def changed_values(self, table, column, previous):
+        # values of `column` in the rows changed since `previous`, e.g. the users whose bookmarks changed
+        if self.changes is None or table not in self.changes:
+            return set()
+        key = TABLE_KEYS[table]
+        upserted, deleted = self.changes[table]
+        values = set()
+        for frame, keys in ((self.tables[table], upserted), (previous.tables[table] if previous else None, upserted | deleted)):
+            if frame is not None and keys and column in frame:
+                values.update(frame.loc[frame[key].isin(keys), column].dropna())
+        return values
+
+    def derived(self, name):
+        # compute a registered value once per snapshot, concurrent callers wait for the first one
+        if name in self._derived:
+            return self._derived[name]
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._derived:
+                self._derived[name] = self._compute(name)
+        return self._derived[name]
+
+    def _compute(self, name):
+        build, update = DERIVED[name]
+        parent = self._parent
+        if update is not None and parent is not None and self.changes is not None and name in parent._derived:
+            with stage(f"derived.{name}.update"):
+                value = update(parent._derived[name], self)
+            if value is not None:
+                return value
+        with stage(f"derived.{name}.build"):
+            return build(self)
+
+    def warm(self):
+        for name in list(DERIVED):
+            self.derived(name)
+
+
+# -------------------
+# Snapshot Store
+# -------------------
+
+class SnapshotStore:
+    # keeps the latest snapshot and refreshes it incrementally in a background thread
+    def __init__(self, source=None, tables=None, ttl=SNAPSHOT_TTL, full_refresh_every=FULL_REFRESH_EVERY, warm=True):
+        self.source = source if source is not None else AsyncSupabaseSource()
+        self.table_keys = {name: TABLE_KEYS[name] for name in (tables or TABLE_KEYS)}
+        self.ttl = ttl
+        self.full_refresh_every = full_refresh_every
+        self.warm = warm
+        self._snapshot = None
+        self._watermarks = {}
+        self._refreshes = 0
+        self._listeners = []
+        self._refresh_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.last_error = None
+
+    @property
+    def ready(self):
+        return self._snapshot is not None
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._refresh_lock:
+                if self._snapshot is None:
+                    self._publish(self._load_full(), changes=None)
+            snapshot = self._snapshot
+        return snapshot
+
+    def add_listener(self, listener):
+        # listener(snapshot, previous) is called after every new snapshot is published
+        self._listeners.append(listener)
+
+    def refresh(self, full=False):
+        # build and publish a new snapshot if anything changed, returns the current snapshot
+        with self._refresh_lock:
+            self._refreshes += 1
+            if self.full_refresh_every and self._refreshes % self.full_refresh_every == 0:
+                full = True
+            if full or self._snapshot is None:
+                self._publish(self._load_full(), changes=None)
+                return self._snapshot
+            tables, changes = self._load_changes()
+            if changes:
+                self._publish(tables, changes=changes)
+            return self._snapshot
+
+    def apply_changes(self, changes):
+        # publish a snapshot with rows pushed by a changefeed, {table: (upserted rows, deleted keys)},
+        # returns the current snapshot
+        with self._refresh_lock:
+            if self._snapshot is None:
+                self._publish(self._load_full(), changes=None)
+            tables = dict(self._snapshot.tables)
+            applied = {}
+            for table, (rows, deleted) in changes.items():
+                if table in self.table_keys and (rows or deleted):
+                    applied[table] = self._merge(tables, table, rows, set(deleted))
+            if applied:
+                self._publish(tables, changes=applied)
+            return self._snapshot
+
+    def request_refresh(self):
+        # wake the background thread early, e.g. after a write we know about
+        self._wakeup.set()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="snapshot-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        # the first snapshot is loaded right away, retried until the database answers
+        while not self._stopped.is_set():
+            if self._snapshot is not None:
+                self._wakeup.wait(self.ttl)
+                self._wakeup.clear()
+                if self._stopped.is_set():
+                    return
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as error:
+                # keep serving the last good snapshot
+                self.last_error = str(error)
+                print(f"Snapshot refresh failed: {error}")
+                if self._snapshot is None:
+                    self._stopped.wait(RETRY_DELAY)
+
+    def _publish(self, tables, changes):
+        previous = self._snapshot
+        version = previous.version + 1 if previous is not None else 1
+        snapshot = Snapshot(version, tables, changes=changes, parent=previous)
+        if self.warm:
+            # build models before swapping so requests never see a half-built snapshot
+            snapshot.warm()
+            snapshot._parent = None
+        elif previous is not None:
+            # only the immediate parent is kept around for incremental updates
+            previous._parent = None
+        self._snapshot = snapshot
+        for listener in self._listeners:
+            try:
+                listener(snapshot, previous)
+            except Exception as error:
+                print(f"Snapshot listener failed: {error}")
+
+    def _fetch_many(self, requests):
+        return fetch_many(self.source, requests)
+
+    @timed("snapshot.load_full")
+    def _load_full(self):
+        tables = {}
+        results = self._fetch_many([{"table": table, "key": key} for table, key in self.table_keys.items()])
+        for (table, key), rows in zip(self.table_keys.items(), results):
+            tables[table] = self._to_frame(rows, key)
+            self._watermarks[table] = self._watermark(tables[table], key)
+        return tables
+
+    @timed("snapshot.load_changes")
+    def _load_changes(self):
+        current = self._snapshot.tables
+        tables = dict(current)
+        changes = {}
+        # the key column alone is cheap to pull and tells us about inserts and deletes,
+        # rows newer than the watermark cover updates on tables that track them
+        requests = []
+        for table, key in self.table_keys.items():
+            requests.append({"table": table, "columns": key, "key": key})
+            column, value = self._watermarks.get(table, (None, None))
+            if column is not None:
+                requests.append({"table": table, "since": (column, value), "key": key})
+        results = iter(self._fetch_many(requests))
+        found = {}
+        for table, key in self.table_keys.items():
+            keys = {row[key] for row in next(results)}
+            rows = next(results) if self._watermarks.get(table, (None, None))[0] is not None else []
+            known = set(current[table][key])
+            found[table] = (keys, rows, known - keys, keys - known)
+        # then only the new rows the watermark didn't cover
+        missing = {
+            table: added - {row[key] for row in rows}
+            for (table, key), (keys, rows, deleted, added) in zip(self.table_keys.items(), found.values())
+        }
+        missing = {table: ids for table, ids in missing.items() if ids}
+        missing_rows = self._fetch_many([
+            {"table": table, "ids": ids, "key": self.table_keys[table]} for table, ids in missing.items()
+        ]) if missing else []
+        missing_rows = dict(zip(missing, missing_rows))
+        for table, key in self.table_keys.items():
+            keys, rows, deleted, added = found[table]
+            rows = rows + missing_rows.get(table, [])
+            if rows or deleted:
+                changes[table] = self._merge(tables, table, rows, deleted)
+        return tables, changes
+
+    def _merge(self, tables, table, rows, deleted):
+        # unchanged rows keep their order, upserted rows go after them, returns (upserted keys, deleted keys)
+        key = self.table_keys[table]
+        frame = tables[table]
+        upserted = {row[key] for row in rows}
+        kept = frame[~frame[key].isin(upserted | deleted)]
+        new_rows = self._to_frame(rows, key)
+        tables[table] = pd.concat([kept, new_rows], ignore_index=True) if len(kept) else new_rows
+        self._watermarks[table] = self._watermark(tables[table], key)
+        return upserted, deleted
+
+    def _to_frame(self, rows, key):
+        frame = pd.DataFrame(rows)
+        if key not in frame:
+            frame[key] = pd.Series(dtype=object)
+        return frame
+
+    def _watermark(self, frame, key):
+        latest = latest_time(frame[WATERMARK_COLUMN]) if WATERMARK_COLUMN in frame else None
+        if latest is not None:
+            return WATERMARK_COLUMN, latest
+        return None, None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    # the process wide store, created and started on first use
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = SnapshotStore()
+                store.start()
+                _store = store
+    return _store
+
+
+def set_store(store):
+    # swap the process wide store, e.g. for a LocalSource in tests
+    global _store
+    with _store_lock:
+        if _store is not None and _store is not store:
+            _store.stop()
+        _store = store
+
+
+def get_snapshot():
+    return get_store().get()
+
+
+def loaded_snapshot():
+    # the latest snapshot if this process already loaded one, None otherwise, never starts a store
+    store = _store
+    return store.get() if store is not None and store.ready else None
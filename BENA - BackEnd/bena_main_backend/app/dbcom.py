@@ -4,61 +4,102 @@ load_dotenv()
 
 import re
 import os
+import time
+import uuid
 import numpy as np 
 import pandas as pd 
 from supabase import create_client, Client
 from datetime import datetime, timezone
+# stage timers
+from app.metrics import timed
+# place names for default trip titles, when the server already loaded them
+from app.data_snapshot import loaded_snapshot
 
-# initialize supabase connection
+# supabase connection, created on first use so importing this module never touches the network
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
+_supabase = None
+
+# rows per insert request
+WRITE_BATCH_SIZE = 500
+# a failed write is cleaned up and retried this many times in total
+WRITE_ATTEMPTS = 3
+RETRY_DELAY = 0.5
+# namespace of the trip ids derived from idempotency keys
+TRIP_NAMESPACE = uuid.UUID("6f1c3a52-93e4-4d1b-9a57-2b8e0c4d7f10")
+# title of trips sent without one whose first place has no known name
+DEFAULT_TITLE = "New trip"
+
+def get_supabase() -> Client:
+    global _supabase
+    if _supabase is None:
+        _supabase = create_client(url, key)
+    return _supabase
+
+def set_supabase(client):
+    # swap the client, e.g. for a local fake in benchmarks
+    global _supabase
+    _supabase = client
 
 def get_places():
     # get all places from supabase
     table_name = "places"
-    response = supabase.table(table_name).select("*").execute()
+    response = get_supabase().table(table_name).select("*").execute()
     return response
 
 def get_place(place_id):
     # get all places from supabase
     table_name = "places"
-    response = supabase.table(table_name).select("*").eq("places_id", place_id).execute()
+    response = get_supabase().table(table_name).select("*").eq("places_id", place_id).execute()
     return response.data
 
 def get_places_dataframe():
     # get all places from supabase
     table_name = "places"
-    response = supabase.table(table_name).select("*").execute()
+    response = get_supabase().table(table_name).select("*").execute()
     return pd.DataFrame(response.data)
 
 def get_users_dataframe():
     # get all places from supabase
     table_name = "users"
-    response = supabase.table(table_name).select("*").execute()
+    response = get_supabase().table(table_name).select("*").execute()
     return pd.DataFrame(response.data)
 
 def get_trips_dataframe():
     # get all places from supabase
     table_name = "trips"
-    response = supabase.table(table_name).select("*").execute()
+    response = get_supabase().table(table_name).select("*").execute()
     return pd.DataFrame(response.data)
 
-def create_trip(user_id: str, title: str, start_date, end_date, steps, description="no description", status="planned"):
-    # user_df = get_users_dataframe()
-    # trips_df = get_trips_dataframe()
-    # validate user_id
-    # if user_id not in user_df["user_id"]:
-    #     print("User with id ${user_id} not found")
-    #     return None
-    # print(user_df)
+def place_name(place_id):
+    # name of one place, from the loaded snapshot or else a single row read, None if it has none
+    snapshot = loaded_snapshot()
+    if snapshot is not None:
+        places_df = snapshot.places
+        names = places_df.loc[places_df["places_id"] == place_id, "name"].dropna()
+        if len(names):
+            return str(names.iloc[0])
+    response = get_supabase().table("places").select("name").eq("places_id", place_id).execute()
+    names = [row["name"] for row in response.data if row.get("name")]
+    return str(names[0]) if names else None
+
+def default_title(steps):
+    # "Trip to <first place>", named by the step or else by the places table
+    name = steps[0].get("name") if steps else None
+    if not name and steps:
+        name = place_name(steps[0]["place_id"])
+    return "Trip to " + name if name else DEFAULT_TITLE
+
+def build_trip(user_id: str, title: str, start_date, end_date, steps, description="no description", status="planned", idempotency_key=None):
+    # the trips row and its tripstep rows, trip ids are generated here so a failed write can be cleaned up
     # validate title
     if title is None or title == "":
         print("No title provided")
-        title = "Trip to " + steps[0]["name"]
-    
-    # create a new trip in the database
+        title = default_title(steps)
+    # the same idempotency key of the same user always maps to the same trip id
+    trip_id = str(uuid.uuid5(TRIP_NAMESPACE, f"{user_id}:{idempotency_key}")) if idempotency_key else str(uuid.uuid4())
     new_trip = {
+        "trip_id": trip_id,
         "user_id": user_id,
         "title": title,
         "description": description,
@@ -66,25 +107,79 @@ def create_trip(user_id: str, title: str, start_date, end_date, steps, descripti
         # "end_date": end_date,
         "status": status,
     }
-
-    # insert the new trip to trips table
-    created_trip = supabase.table("trips").insert(new_trip).execute()
-    # get the created trip id
-    trip_id = created_trip.data[0]["trip_id"]
-
-    # add steps to the trip
-    for step in steps:
-        new_step = {
-            "trip_id": trip_id,
-            "place_id": step["place_id"],
-            "step_num": steps.index(step),
-        }
-        supabase.table("tripstep").insert(new_step).execute()
-
-    print("Trip created successfully")
-    return new_trip
-
-create_trip("da170574-dbb5-43d6-b321-f57d2bc5ae91", "Trip to the beach", datetime.now(), datetime.now(), [{"place_id": "22bc5e88-6f6c-4784-bb82-6d3012cb6a6e"}])
+    # step numbers follow the order of the steps, duplicated places keep their own positions
+    new_steps = [
+        {"trip_id": trip_id, "place_id": step["place_id"], "step_num": step_num}
+        for step_num, step in enumerate(steps)
+    ]
+    return new_trip, new_steps
+
+@timed("trips.create")
+def create_trips(trips, attempts=WRITE_ATTEMPTS):
+    # create many trips with one insert for the trips and one for all their steps,
+    # `trips` holds create_trip keyword arguments, returns the trip rows in the same order
+    built = [build_trip(**trip) for trip in trips]
+    # a key repeated within one import creates its trip once
+    unique = {}
+    for new_trip, trip_steps in built:
+        unique.setdefault(new_trip["trip_id"], (new_trip, trip_steps))
+    new_trips = [new_trip for new_trip, trip_steps in unique.values()]
+    new_steps = [step for new_trip, trip_steps in unique.values() for step in trip_steps]
+    keyed = list({new_trip["trip_id"] for trip, (new_trip, trip_steps) in zip(trips, built) if trip.get("idempotency_key")})
+    for attempt in range(attempts):
+        written = []
+        try:
+            stored = _write_trips(new_trips, new_steps, keyed, written)
+            print(f"{len(new_trips) - len(stored)} trips created successfully")
+            # replayed keys answer with the trip as it was first written
+            return [stored.get(new_trip["trip_id"], unique[new_trip["trip_id"]][0]) for new_trip, trip_steps in built]
+        except Exception as error:
+            # leave nothing half written behind before trying again
+            _delete_trips(written)
+            if attempt == attempts - 1:
+                raise
+            print(f"Creating trips failed, retrying: {error}")
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+@timed("trips.write")
+def _write_trips(new_trips, new_steps, keyed, written):
+    # returns the stored rows of the trips that were already written, by trip id
+    supabase = get_supabase()
+    # trips of idempotency keys that were already used are not written again
+    existing = {}
+    for start in range(0, len(keyed), WRITE_BATCH_SIZE):
+        response = supabase.table("trips").select("*").in_("trip_id", keyed[start:start + WRITE_BATCH_SIZE]).execute()
+        existing.update((row["trip_id"], row) for row in response.data)
+    missing_trips = [trip for trip in new_trips if trip["trip_id"] not in existing]
+    missing_steps = [step for step in new_steps if step["trip_id"] not in existing]
+    for start in range(0, len(missing_trips), WRITE_BATCH_SIZE):
+        batch = missing_trips[start:start + WRITE_BATCH_SIZE]
+        supabase.table("trips").insert(batch).execute()
+        written.extend(trip["trip_id"] for trip in batch)
+    for start in range(0, len(missing_steps), WRITE_BATCH_SIZE):
+        supabase.table("tripstep").insert(missing_steps[start:start + WRITE_BATCH_SIZE]).execute()
+    return existing
+
+def _delete_trips(trip_ids):
+    # remove the steps first, then the trips they belong to
+    if not trip_ids:
+        return
+    supabase = get_supabase()
+    try:
+        for start in range(0, len(trip_ids), WRITE_BATCH_SIZE):
+            batch = trip_ids[start:start + WRITE_BATCH_SIZE]
+            supabase.table("tripstep").delete().in_("trip_id", batch).execute()
+            supabase.table("trips").delete().in_("trip_id", batch).execute()
+    except Exception as error:
+        print(f"Cleaning up trips {trip_ids} failed: {error}")
+
+def create_trip(user_id: str, title: str, start_date, end_date, steps, description="no description", status="planned", idempotency_key=None):
+    # one trip and all of its steps in two round trips (three with an idempotency key)
+    trip = {
+        "user_id": user_id, "title": title, "start_date": start_date, "end_date": end_date, "steps": steps,
+        "description": description, "status": status, "idempotency_key": idempotency_key,
+    }
+    return create_trips([trip])[0]
 
 
 # Adding basic database client
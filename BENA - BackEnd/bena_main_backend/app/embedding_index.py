@@ -0,0 +1,251 @@
+# hashed text embeddings of places with an IVF index for approximate nearest-neighbour queries
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+# shared data snapshots
+from app.data_snapshot import DATA_DIR, register_derived
+# the fuzzy search's normalized name, tags, arabic name and address text
+from app.search_index import normalize, search_text
+
+DIM = int(os.environ.get("BENA_EMBEDDING_DIM", "256"))
+# vectors are stored as int8, value = round(component * SCALE)
+SCALE = 127
+# places per inverted list on average, and lists scanned per query
+LIST_SIZE = 256
+NPROBE = int(os.environ.get("BENA_EMBEDDING_NPROBE", "16"))
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 20000
+# retrain the lists once this share of documents is stale or the index doubled since training
+MAX_STALE_SHARE = 0.2
+INDEX_DIR = os.path.join(DATA_DIR, "embeddings")
+
+# character n-grams hashed straight into DIM signed buckets, stateless so any text can be encoded at any time
+_vectorizer = HashingVectorizer(
+    analyzer="char_wb", ngram_range=(2, 4), n_features=DIM, alternate_sign=True, norm="l2", dtype=np.float32,
+)
+
+
+def encode(texts):
+    # unit length float32 vectors
+    return _vectorizer.transform(texts).toarray()
+
+
+def embed_query(query):
+    # unit length float32 vector of a search query
+    return encode([normalize(query)])[0]
+
+
+def quantize(vectors):
+    return np.round(np.clip(vectors, -1, 1) * SCALE).astype(np.int8)
+
+
+def fingerprint(ids, texts):
+    digest = hashlib.sha1()
+    for place_id, text in zip(ids, texts):
+        digest.update(f"{place_id}\x1f{text}\x1e".encode("utf-8"))
+    digest.update(str(DIM).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def kmeans(vectors, lists, rng, iterations=KMEANS_ITERATIONS):
+    # spherical k-means on a sample, centroids are unit length
+    sample = vectors[rng.choice(len(vectors), min(KMEANS_SAMPLE, len(vectors)), replace=False)].astype(np.float32) / SCALE
+    centroids = sample[rng.choice(len(sample), lists, replace=False)]
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # lists that lost every point keep their old centroid
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+    return centroids.astype(np.float32)
+
+
+def assign_lists(vectors, centroids, block=8192):
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block):
+        assign[start:start + block] = np.argmax(vectors[start:start + block].astype(np.float32) @ centroids.T, axis=1)
+    return assign
+
+
+class EmbeddingIndex:
+    # documents are numbered in insertion order, `rows` maps them to the snapshot places frame (-1 when stale),
+    # `order` lists the documents of every inverted list back to back, list i is order[offsets[i]:offsets[i + 1]]
+    def __init__(self, ids, vectors, rows, centroids, assign, order, offsets, trained_size, build_seconds, fingerprint=None):
+        self.ids = ids
+        self.vectors = vectors
+        self.rows = rows
+        self.centroids = centroids
+        self.assign = assign
+        self.order = order
+        self.offsets = offsets
+        self.trained_size = trained_size
+        self.build_seconds = build_seconds
+        # identifies the places a freshly built index was built from, None after updates
+        self.fingerprint = fingerprint
+        # document of every snapshot row
+        self.doc_of_row = np.full(int(rows.max(initial=-1)) + 1, -1, dtype=np.int64)
+        live = np.flatnonzero(rows >= 0)
+        self.doc_of_row[rows[live]] = live
+
+    @classmethod
+    def build(cls, ids, texts, seed=0):
+        start = time.perf_counter()
+        vectors = quantize(encode(texts))
+        lists = max(1, min(len(ids), len(ids) // LIST_SIZE))
+        centroids = kmeans(vectors, lists, np.random.default_rng(seed)) if len(ids) else np.zeros((0, DIM), dtype=np.float32)
+        assign = assign_lists(vectors, centroids) if len(ids) else np.zeros(0, dtype=np.int32)
+        order, offsets = cls._lists(assign, len(centroids))
+        return cls(
+            np.asarray(ids, dtype=str), vectors, np.arange(len(ids)), centroids, assign, order, offsets,
+            len(ids), time.perf_counter() - start, fingerprint=fingerprint(ids, texts),
+        )
+
+    @staticmethod
+    def _lists(assign, lists):
+        order = np.argsort(assign, kind="stable").astype(np.int32)
+        offsets = np.searchsorted(assign[order], np.arange(lists + 1)).astype(np.int64)
+        return order, offsets
+
+    def update(self, ids, texts, changed):
+        # a new index for the next snapshot, only the changed places are encoded again.
+        # texts only has to hold the changed places' texts
+        start = time.perf_counter()
+        row_of = {place_id: row for row, place_id in enumerate(ids)}
+        rows = np.array([
+            -1 if stale < 0 or place_id in changed else row_of.get(place_id, -1)
+            for place_id, stale in zip(self.ids, self.rows)
+        ], dtype=np.int64)
+        added_rows = [row_of[place_id] for place_id in changed if place_id in row_of]
+        rows = np.concatenate([rows, np.array(added_rows, dtype=np.int64)])
+        if (rows < 0).sum() > MAX_STALE_SHARE * len(rows) or len(rows) > 2 * self.trained_size:
+            return None
+        # new documents go to the closest existing list, no retraining
+        added = quantize(encode([texts[row] for row in added_rows])) if added_rows else np.zeros((0, DIM), dtype=np.int8)
+        assign = np.concatenate([self.assign, assign_lists(added, self.centroids)])
+        order, offsets = self._lists(assign, len(self.centroids))
+        return EmbeddingIndex(
+            np.concatenate([self.ids, np.asarray([ids[row] for row in added_rows], dtype=str)]),
+            np.concatenate([self.vectors, added]), rows, self.centroids, assign, order, offsets,
+            self.trained_size, self.build_seconds + time.perf_counter() - start,
+        )
+
+    def vectors_of_rows(self, rows):
+        # float32 vectors of snapshot rows, zero for rows without a document
+        rows = np.asarray(rows, dtype=np.int64)
+        docs = np.where(rows < len(self.doc_of_row), self.doc_of_row[np.minimum(rows, len(self.doc_of_row) - 1)], -1)
+        vectors = self.vectors[np.maximum(docs, 0)].astype(np.float32) / SCALE
+        vectors[docs < 0] = 0
+        return vectors
+
+    def _top(self, docs, vector, k, exclude):
+        docs = docs[self.rows[docs] >= 0]
+        if exclude is not None and len(exclude):
+            docs = docs[~np.isin(self.rows[docs], exclude)]
+        scores = self.vectors[docs].astype(np.float32) @ (vector / SCALE)
+        if len(docs) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            docs, scores = docs[best], scores[best]
+        order = np.lexsort((self.rows[docs], -scores))
+        return self.rows[docs[order]], scores[order]
+
+    def search(self, vector, k=10, nprobe=NPROBE, exclude=None):
+        # (rows, cosine scores) of the approximate k nearest places, scanning the nprobe closest lists
+        if not len(self.centroids):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ vector), nprobe - 1)[:nprobe]
+        docs = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+        return self._top(docs, vector, k, exclude)
+
+    def exact_search(self, vector, k=10, exclude=None):
+        # the same over every document, for benchmarks and small catalogues
+        return self._top(np.arange(len(self.rows)), vector, k, exclude)
+
+    def stats(self):
+        live = int((self.rows >= 0).sum())
+        return {
+            "places": live,
+            "stale_documents": len(self.rows) - live,
+            "lists": len(self.centroids),
+            "dim": DIM,
+            "bytes": int(self.vectors.nbytes + self.centroids.nbytes + self.order.nbytes + self.assign.nbytes),
+            "build_seconds": round(self.build_seconds, 4),
+        }
+
+    def save(self, directory):
+        # every array in its own .npy file so load() can memory-map them, swapped in as a whole
+        os.makedirs(os.path.dirname(directory) or ".", exist_ok=True)
+        # temp and old directories per process, every worker may save the same index at once
+        temp = f"{directory}.{os.getpid()}.tmp"
+        shutil.rmtree(temp, ignore_errors=True)
+        os.makedirs(temp)
+        for name in ("ids", "vectors", "rows", "centroids", "assign", "order", "offsets"):
+            np.save(os.path.join(temp, f"{name}.npy"), np.asarray(getattr(self, name)))
+        with open(os.path.join(temp, "meta.json"), "w") as file:
+            json.dump({"trained_size": self.trained_size, "build_seconds": self.build_seconds, "fingerprint": self.fingerprint, "dim": DIM}, file)
+        old = f"{directory}.{os.getpid()}.old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(directory):
+            os.replace(directory, old)
+        os.replace(temp, directory)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory):
+        # zero-copy, the arrays stay on disk and are paged in on use
+        with open(os.path.join(directory, "meta.json")) as file:
+            meta = json.load(file)
+        if meta["dim"] != DIM:
+            raise ValueError(f"index has {meta['dim']} dimensions, expected {DIM}")
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                  for name in ("ids", "vectors", "rows", "centroids", "assign", "order", "offsets")}
+        return cls(
+            arrays["ids"], arrays["vectors"], arrays["rows"], arrays["centroids"], arrays["assign"],
+            arrays["order"], arrays["offsets"], meta["trained_size"], meta["build_seconds"], fingerprint=meta["fingerprint"],
+        )
+
+
+# -------------------
+# Snapshot integration
+# -------------------
+
+def build_embedding_index(snapshot):
+    places_df = snapshot.places
+    ids, texts = places_df["places_id"].astype(str).tolist(), search_text(places_df)
+    # reuse the persisted index when it was built from the same places
+    if os.path.exists(INDEX_DIR):
+        try:
+            index = EmbeddingIndex.load(INDEX_DIR)
+            if index.fingerprint == fingerprint(ids, texts):
+                return index
+        except Exception as error:
+            print(f"Could not load embedding index: {error}")
+    index = EmbeddingIndex.build(ids, texts)
+    # a failed save only costs the next worker a rebuild, the snapshot is still published
+    try:
+        index.save(INDEX_DIR)
+    except OSError as error:
+        print(f"Could not save embedding index: {error}")
+    return index
+
+
+def update_embedding_index(index, snapshot):
+    changed = snapshot.changed("places")
+    if not changed:
+        return index
+    places_df = snapshot.places
+    ids = places_df["places_id"].astype(str).tolist()
+    # only the changed places need their text normalized again
+    changed_rows = places_df["places_id"].isin(changed).to_numpy()
+    texts = [None] * len(ids)
+    for row, text in zip(np.flatnonzero(changed_rows), search_text(places_df[changed_rows])):
+        texts[row] = text
+    return index.update(ids, texts, {str(place_id) for place_id in changed})
+
+
+register_derived("embedding_index", build_embedding_index, update_embedding_index)
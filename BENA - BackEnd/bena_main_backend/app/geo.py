@@ -0,0 +1,51 @@
+# vectorized great-circle distances shared by all the models
+import numpy as np
+
+R = 6371  # Radius of Earth in kilometers
+# anchors processed per block in min_distance, bounds the scratch matrix to places x ANCHOR_BLOCK
+ANCHOR_BLOCK = 64
+
+
+def coordinates(df, lat_column="latitude", lon_column="longitude"):
+    # float32 latitude/longitude arrays of a dataframe, missing or invalid values become NaN
+    lat = np.asarray(df[lat_column].to_numpy(dtype=np.float32, na_value=np.nan), dtype=np.float32)
+    lon = np.asarray(df[lon_column].to_numpy(dtype=np.float32, na_value=np.nan), dtype=np.float32)
+    return lat, lon
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    # works on scalars or any broadcastable arrays, returns kilometers
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=np.float32)) for value in (lat1, lon1, lat2, lon2))
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * R * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def distance_matrix(lat1, lon1, lat2, lon2):
+    # distances between every point of the first set (rows) and of the second set (columns)
+    lat1, lon1 = np.asarray(lat1, dtype=np.float32), np.asarray(lon1, dtype=np.float32)
+    lat2, lon2 = np.asarray(lat2, dtype=np.float32), np.asarray(lon2, dtype=np.float32)
+    return haversine_distance(lat1[:, None], lon1[:, None], lat2[None, :], lon2[None, :])
+
+
+def min_distance(lat, lon, anchor_lat, anchor_lon):
+    # distance from every point to its closest anchor, inf when there are no anchors
+    lat, lon = np.asarray(lat, dtype=np.float32), np.asarray(lon, dtype=np.float32)
+    anchor_lat, anchor_lon = np.asarray(anchor_lat, dtype=np.float32), np.asarray(anchor_lon, dtype=np.float32)
+    # anchors without coordinates can't be the closest one
+    valid = ~(np.isnan(anchor_lat) | np.isnan(anchor_lon))
+    anchor_lat, anchor_lon = np.radians(anchor_lat[valid]), np.radians(anchor_lon[valid])
+    # precompute the per point terms once instead of once per anchor
+    lat_rad, lon_rad = np.radians(lat)[:, None], np.radians(lon)[:, None]
+    cos_lat = np.cos(lat_rad)
+    best = np.full(lat.shape, np.inf, dtype=np.float32)
+    for start in range(0, len(anchor_lat), ANCHOR_BLOCK):
+        block_lat = anchor_lat[None, start:start + ANCHOR_BLOCK]
+        block_lon = anchor_lon[None, start:start + ANCHOR_BLOCK]
+        a = np.sin((block_lat - lat_rad) / 2) ** 2 + cos_lat * np.cos(block_lat) * np.sin((block_lon - lon_rad) / 2) ** 2
+        # haversine grows with a, so reduce before the arcsin
+        np.minimum(best, a.min(axis=1), out=best)
+    if not len(anchor_lat):
+        return best
+    return 2 * R * np.arcsin(np.sqrt(np.clip(best, 0, 1)))
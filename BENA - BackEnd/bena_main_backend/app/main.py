@@ -1,19 +1,121 @@
 # backend models
 from app.recommendation_model import recommend_places
 from app.recommendation_model import users_has_interactions
+from app.recommendation_model import recommend_places_batch
+from app.recommendation_model import stored_recommendations
+from app.recommendation_model import SCORE_COLUMNS
 from app.search_places_model import find_places_near_place_id
+from app.search_places_model import find_similar_places
 from app.search_places_model import smart_search
+from app.search_places_model import autocomplete_places
+from app.search_places_model import semantic_search
+from app.dbcom import create_trips
+from app.auto_create_trip_model import generate_trip, MAX_STOPS, DEFAULT_STOPS, DEFAULT_HOURS
+# cpu bound work runs on a bounded pool so the event loop stays free
+from app.request_executor import run_in_executor, in_flight, WORKERS, MAX_PENDING
+# shared data snapshots and the stores that follow them
+from app.data_snapshot import get_store
+from app.batch_recommendation import get_result_store
+from app.result_cache import get_result_cache
+# incremental change ingestion, when BENA_CHANGEFEED is set
+from app.changefeed import get_changefeed
+# per route and per stage metrics, the opt-in profiler
+from app.metrics import Trace, current_trace, observe_rows, render, register_collector, get_profile, list_profiles
+from app.metrics import REQUEST_SECONDS, REQUESTS, PROFILING, PROFILE_HEADER
+# field projection, fast encoding, compression and ETags
+from app.responses import respond, records
 # FastAPI
-from typing import Union
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+import time
+from typing import List, Union
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # start loading the first snapshot in the background, the worker accepts connections right away
+    # and reports ready once the models are built
+    store = get_store()
+    store.start()
+    get_result_cache()
+    get_result_store()
+    changefeed = get_changefeed()
+    if changefeed is not None:
+        changefeed.start()
+    yield
+    if changefeed is not None:
+        changefeed.stop()
+    store.stop()
 
 # initialize FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
-# Recommendation API
-@app.get("/recommend/{user_id}")
-def read_item(user_id: str, method: Union[str, None] = None, length: Union[int, None] = None):
+# most users scored in one batch request
+MAX_BATCH_USERS = 500
+# most trips created in one bulk import request
+MAX_BULK_TRIPS = 1000
+
+def collect_metrics():
+    # gauges read at scrape time from the snapshot store, the result cache and the request pool
+    store = get_store()
+    cache = get_result_cache().stats()
+    samples = [
+        ("snapshot_ready", "gauge", "1 once the first snapshot and its models are loaded.", [({}, int(store.ready))]),
+        ("result_cache_lookups_total", "counter", "Result cache lookups by result.",
+         [({"result": "hit"}, cache["hits"]), ({"result": "miss"}, cache["misses"])]),
+        ("result_cache_hit_ratio", "gauge", "Share of result cache lookups that were hits.", [({}, cache["hit_rate"])]),
+        ("result_cache_entries", "gauge", "Entries in the result cache.", [({}, cache["entries"])]),
+        ("result_cache_bytes", "gauge", "Approximate size of the result cache.", [({}, cache["bytes"])]),
+        ("result_cache_evictions_total", "counter", "Entries dropped from the result cache.",
+         [({"reason": "size"}, cache["evictions"]), ({"reason": "expired"}, cache["expirations"]),
+          ({"reason": "invalidated"}, cache["invalidations"])]),
+        ("executor_in_flight", "gauge", "Requests running or waiting for a worker.", [({}, in_flight())]),
+        ("executor_workers", "gauge", "Worker threads of the request pool.", [({}, WORKERS)]),
+        ("executor_max_pending", "gauge", "Requests accepted before answering 503.", [({}, MAX_PENDING)]),
+    ]
+    if store.ready:
+        snapshot = store.get()
+        samples += [
+            ("snapshot_version", "gauge", "Version of the current snapshot.", [({}, snapshot.version)]),
+            ("snapshot_age_seconds", "gauge", "Seconds since the current snapshot was published.", [({}, time.time() - snapshot.created_at)]),
+            ("snapshot_rows", "gauge", "Rows per table in the current snapshot.",
+             [({"table": table}, len(frame)) for table, frame in snapshot.tables.items()]),
+        ]
+    changefeed = get_changefeed()
+    if changefeed is not None:
+        report = changefeed.report()
+        samples += [
+            ("changefeed_queued", "gauge", "Changes waiting to be applied.", [({}, report["queued"])]),
+            ("changefeed_oldest_queued_seconds", "gauge", "Seconds the oldest queued change has been waiting.",
+             [({}, report["oldest_queued_seconds"])]),
+            ("changefeed_batches_total", "counter", "Change batches published as snapshots.", [({}, report["batches"])]),
+        ]
+    return samples
+
+register_collector(collect_metrics)
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    # latency and status per route template, the request's stages go back in a Server-Timing header
+    trace = Trace(profile=PROFILING and PROFILE_HEADER in request.headers)
+    token = current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_trace.reset(token)
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    REQUEST_SECONDS.observe(time.perf_counter() - start, route=path)
+    REQUESTS.inc(route=path, method=request.method, status=response.status_code)
+    if trace.stages:
+        response.headers["Server-Timing"] = trace.server_timing()
+    if trace.profile_id is not None:
+        response.headers["X-Bena-Profile-Id"] = trace.profile_id
+    return response
+
+def validate_recommendation_params(method, length):
     warnings = ""
     # manage length margins and fix wrong inputs
     if length is None or length < 1 or length > 10: 
@@ -23,33 +125,230 @@ def read_item(user_id: str, method: Union[str, None] = None, length: Union[int,
     if method is None: method = "hybrid"
     else :
         method = method.lower()
-        if method not in ["content_based", "near_bookmarks", "hybrid", "random"]:
+        if method not in ["content_based", "near_bookmarks", "hybrid", "collaborative", "semantic", "random"]:
             method = "hybrid"
             warnings = warnings + "Method entered is not valid, hybrid recommendations are generated." + "\n"
+    return method, length, warnings
+
+# liveness probe, the process is up and serving
+@app.get("/health/live")
+async def live():
+    return {"status": "alive"}
+
+# readiness probe, the first snapshot and its models are loaded
+@app.get("/health/ready")
+async def ready():
+    store = get_store()
+    if not store.ready:
+        return JSONResponse(status_code=503, content={"status": "loading", "error": store.last_error})
+    return {"status": "ready", "snapshot_version": store.get().version}
+
+# freshness of the served data: snapshot age and, with a changefeed, how far behind the changes it applies
+@app.get("/health/freshness")
+async def freshness():
+    store = get_store()
+    changefeed = get_changefeed()
+    snapshot = store.get() if store.ready else None
+    return {
+        "snapshot_version": snapshot.version if snapshot is not None else None,
+        "snapshot_age_seconds": round(time.time() - snapshot.created_at, 3) if snapshot is not None else None,
+        "changefeed": changefeed.report() if changefeed is not None else None,
+    }
+
+# Prometheus scrape endpoint, numbers are per worker process
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+# profiles of requests sent with the profile header while BENA_PROFILING=1
+@app.get("/metrics/profiles")
+async def profiles():
+    return {"profiles": list_profiles(), "enabled": PROFILING}
+
+# one profile as folded stacks, ready for flamegraph.pl or speedscope
+@app.get("/metrics/profiles/{profile_id}")
+async def profile(profile_id: str):
+    profile = get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found.")
+    return PlainTextResponse(profile["stacks"])
+
+# Recommendation API
+@app.get("/recommend/{user_id}")
+async def read_item(http_request: Request, user_id: str, method: Union[str, None] = None, length: Union[int, None] = None,
+                    fields: Union[str, None] = None):
+    return await run_in_executor("recommend", respond, http_request.headers, get_recommendations, user_id, method, length, fields)
+
+def get_recommendations(user_id, method, length, fields=None):
+    method, length, warnings = validate_recommendation_params(method, length)
     # check if user has any past bookmarks or interactions
     if not users_has_interactions(user_id): 
         method = "random"
         warnings = warnings + "No past bookmarks or interactions found for this user, random recommendations is generated." + "\n"
+    # serve precomputed recommendations from the batch job when there are fresh ones
+    recommendations = stored_recommendations(user_id=user_id, n=length, method=method)
     # get recommendations
-    recommendations = recommend_places(user_id=user_id, n=length, method=method)
+    if recommendations is None:
+        recommendations = recommend_places(user_id=user_id, n=length, method=method)
+    # send the response, the method's score column is part of the compact fields
+    rows = records(recommendations, fields, extra=[SCORE_COLUMNS.get(method)])
+    observe_rows("recommend", len(rows))
+    return {"recommendations": rows, "method": method, "length": length, "warnings": warnings}
+
+class BatchRecommendationRequest(BaseModel):
+    user_ids: List[str]
+    method: Union[str, None] = None
+    length: Union[int, None] = None
+
+# Batch Recommendation API
+@app.post("/recommend/batch")
+async def read_items(http_request: Request, request: BatchRecommendationRequest, fields: Union[str, None] = None):
+    return await run_in_executor("recommend_batch", respond, http_request.headers, get_batch_recommendations, request, fields)
+
+def get_batch_recommendations(request, fields=None):
+    method, length, warnings = validate_recommendation_params(request.method, request.length)
+    # manage batch size margins
+    user_ids = list(dict.fromkeys(request.user_ids))
+    if len(user_ids) > MAX_BATCH_USERS:
+        user_ids = user_ids[:MAX_BATCH_USERS]
+        warnings = warnings + f"Only the first {MAX_BATCH_USERS} users are recommended." + "\n"
+    # users without any past bookmarks or interactions get random recommendations
+    random_users = [user_id for user_id in user_ids if method == "random" or not users_has_interactions(user_id)]
+    recommendations = {user_id: recommend_places(user_id=user_id, n=length, method="random") for user_id in random_users}
+    scored_users = [user_id for user_id in user_ids if user_id not in recommendations]
+    if scored_users:
+        recommendations.update(recommend_places_batch(scored_users, n=length, method=method))
     # send the response
-    return {"recommendations": recommendations.to_dict(orient="records"), "method": method, "length": length, "warnings": warnings}
+    rows = {user_id: records(recommendations[user_id], fields, extra=[SCORE_COLUMNS.get(method)]) for user_id in user_ids}
+    observe_rows("recommend_batch", sum(len(user_rows) for user_rows in rows.values()))
+    return {
+        "recommendations": rows,
+        "random_users": random_users,
+        "method": method,
+        "length": length,
+        "warnings": warnings,
+    }
+
+class TripStepRequest(BaseModel):
+    place_id: str
+    name: Union[str, None] = None
+
+class TripRequest(BaseModel):
+    user_id: str
+    title: Union[str, None] = None
+    description: str = "no description"
+    status: str = "planned"
+    start_date: Union[str, None] = None
+    end_date: Union[str, None] = None
+    steps: List[TripStepRequest]
+    # retrying a request with the same key never creates the trip twice
+    idempotency_key: Union[str, None] = None
+
+class BulkTripRequest(BaseModel):
+    trips: List[TripRequest]
+
+# Bulk trip import API
+@app.post("/trips/bulk")
+async def create_items(http_request: Request, request: BulkTripRequest):
+    # manage batch size margins
+    if len(request.trips) > MAX_BULK_TRIPS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_TRIPS} trips can be imported at once.")
+    for trip in request.trips:
+        if not trip.steps:
+            raise HTTPException(status_code=422, detail="Every trip needs at least one step.")
+    return await run_in_executor("trips_bulk", respond, http_request.headers, import_trips, request)
+
+def import_trips(request):
+    trips = create_trips([trip.model_dump() for trip in request.trips])
+    # pick the new trips up without waiting for the next scheduled refresh
+    get_store().request_refresh()
+    observe_rows("trips_bulk", len(trips))
+    return {"trips": trips, "length": len(trips)}
 
 # suggested trips API
+@app.get("/trips/auto")
+async def read_item(http_request: Request, place_id: Union[str, None] = None, user_id: Union[str, None] = None,
+                    theme: Union[str, None] = None, stops: Union[int, None] = None, hours: Union[float, None] = None,
+                    fields: Union[str, None] = None):
+    if place_id is None and user_id is None and not theme:
+        raise HTTPException(status_code=422, detail="A place_id, a user_id or a theme is needed to build a trip.")
+    return await run_in_executor("auto_trip", respond, http_request.headers, auto_trip, place_id, user_id, theme, stops, hours, fields)
+
+def auto_trip(place_id, user_id, theme, stops, hours, fields=None):
+    warnings = ""
+    # manage stops and hours margins and fix wrong inputs
+    if stops is None or stops < 1 or stops > MAX_STOPS:
+        if stops is not None:
+            warnings = warnings + f"Stops entered is not valid, a trip of {DEFAULT_STOPS} stops is generated." + "\n"
+        stops = DEFAULT_STOPS
+    if hours is None or hours <= 0 or hours > 24: hours = DEFAULT_HOURS
+    # get the trip
+    trip = generate_trip(place_id=place_id, user_id=user_id, theme=theme, stops=stops, hours=hours)
+    if len(trip) < stops:
+        warnings = warnings + f"Only {len(trip)} stops fit the trip." + "\n"
+    # send the response
+    rows = records(trip, fields, extra=["step_num", "trip_score", "distance_from_previous"])
+    observe_rows("auto_trip", len(rows))
+    return {
+        "trip": rows,
+        "length": len(trip),
+        "total_distance": float(trip["distance_from_previous"].sum()) if len(trip) else 0.0,
+        "warnings": warnings,
+    }
+
 
 
 
 # search a place APIs
 @app.get("/search/places/{query}")
-def read_item(query: str):
+async def read_item(http_request: Request, query: str, fields: Union[str, None] = None):
+    return await run_in_executor("search", respond, http_request.headers, search_places, query, fields)
+
+def search_places(query, fields=None):
     # get the search results
     result = smart_search(query)
     # send the response
-    return {"search_results": result.to_dict(orient="records"), "length": len(result), "searched_query": query}
+    rows = records(result, fields)
+    observe_rows("search", len(rows))
+    return {"search_results": rows, "length": len(result), "searched_query": query}
+
+# nearest places by meaning of the query rather than exact spelling
+@app.get("/search/semantic/{query}")
+async def read_item(http_request: Request, query: str, length: Union[int, None] = None, fields: Union[str, None] = None):
+    return await run_in_executor("semantic_search", respond, http_request.headers, semantic_places, query, length, fields)
+
+def semantic_places(query, length, fields=None):
+    # manage length margins and fix wrong inputs
+    if length is None or length < 1 or length > 50: length = 10
+    # get the search results
+    result = semantic_search(query, n=length)
+    # send the response
+    rows = records(result, fields, extra=["semantic_score"])
+    observe_rows("semantic_search", len(rows))
+    return {"search_results": rows, "length": len(result), "searched_query": query}
+
+# typeahead suggestions API, called on every keystroke
+@app.get("/search/autocomplete/{prefix}")
+async def read_item(http_request: Request, prefix: str, length: Union[int, None] = None, fields: Union[str, None] = None):
+    return await run_in_executor("autocomplete", respond, http_request.headers, complete_prefix, prefix, length, fields)
+
+def complete_prefix(prefix, length, fields=None):
+    # manage length margins and fix wrong inputs
+    if length is None or length < 1 or length > 20: length = 8
+    # get the suggestions
+    result = autocomplete_places(prefix, n=length)
+    # send the response
+    rows = records(result, fields, extra=["popularity"])
+    observe_rows("autocomplete", len(rows))
+    return {"suggestions": rows, "length": len(result), "searched_prefix": prefix}
 
 # places near to a place API
 @app.get("/search/places/near/{place_id}")
-def read_item(place_id: str, length: Union[int, None] = None, radius: Union[float, None] = None):
+async def read_item(http_request: Request, place_id: str, length: Union[int, None] = None, radius: Union[float, None] = None,
+                    fields: Union[str, None] = None):
+    return await run_in_executor("near", respond, http_request.headers, near_places, place_id, length, radius, fields)
+
+def near_places(place_id, length, radius, fields=None):
     # manage length margins and fix wrong inputs
     if length is None or length < 1 or length > 5: length = 5
     # manage radius margins and fix wrong inputs
@@ -57,7 +356,24 @@ def read_item(place_id: str, length: Union[int, None] = None, radius: Union[floa
     # get the nearby places
     result = find_places_near_place_id(place_id, n=length, radius=radius)
     # send the response
-    return {"near_places": result.to_dict(orient="records"), "searched_place_id": place_id, "length": len(result), "radius": radius}
+    rows = records(result, fields, extra=["distance_from_place"])
+    observe_rows("near", len(rows))
+    return {"near_places": rows, "searched_place_id": place_id, "length": len(result), "radius": radius}
+
+# places sharing tags with a place API
+@app.get("/search/places/similar/{place_id}")
+async def read_item(http_request: Request, place_id: str, length: Union[int, None] = None, fields: Union[str, None] = None):
+    return await run_in_executor("similar", respond, http_request.headers, similar_places, place_id, length, fields)
+
+def similar_places(place_id, length, fields=None):
+    # manage length margins and fix wrong inputs
+    if length is None or length < 1 or length > 20: length = 5
+    # get the similar places
+    result = find_similar_places(place_id, n=length)
+    # send the response
+    rows = records(result, fields, extra=["similarity_score"])
+    observe_rows("similar", len(rows))
+    return {"similar_places": rows, "searched_place_id": place_id, "length": len(result)}
 
 
 @app.get("/share/trip/{trip_id}", response_class=HTMLResponse)
@@ -0,0 +1,258 @@
+# in-process metrics in the Prometheus text format, per-stage timers and an opt-in sampling profiler.
+# every uvicorn worker keeps its own numbers, scrape each worker or label them by instance
+import os
+import sys
+import time
+import uuid
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from collections import Counter as StackCounts, OrderedDict
+
+PREFIX = "bena_"
+# upper bounds of the latency buckets in seconds, and of the payload row count buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROW_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 500, 1000, 5000)
+# requests sending this header are run under the sampling profiler, only when profiling is switched on
+PROFILE_HEADER = "x-bena-profile"
+PROFILING = os.environ.get("BENA_PROFILING", "0") == "1"
+PROFILE_INTERVAL = float(os.environ.get("BENA_PROFILE_INTERVAL", "0.001"))
+# finished profiles kept for /metrics/profiles
+MAX_PROFILES = 50
+# frames kept per sampled stack, from the innermost one
+MAX_DEPTH = 64
+
+
+def _labels(labels, extra=None):
+    items = sorted(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for name, value in items]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = PREFIX + name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.items())
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self.values.items())
+        lines += [f"{self.name}{_labels(key)} {_number(value)}" for key, value in values]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket, sum, count]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.items())
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        for key, counts, total, count in values:
+            for bound, bucket in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(key, ('le', _number(float(bound))))} {bucket}")
+            lines.append(f"{self.name}_bucket{_labels(key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_labels(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("request_seconds", "HTTP request latency by route.")
+REQUESTS = Counter("requests_total", "HTTP requests by route and status code.")
+STAGE_SECONDS = Histogram("stage_seconds", "Time spent in each model and data stage.")
+RESPONSE_ROWS = Histogram("response_rows", "Rows returned per response by endpoint.", ROW_BUCKETS)
+REJECTED = Counter("rejected_requests_total", "Requests turned away by the executor, by endpoint and reason.")
+LOOKUPS = Counter("cache_lookups_total", "Cache lookups by cache and result.")
+CHANGES = Counter("changefeed_events_total", "Change events by table, operation and outcome.")
+STALENESS = Histogram("changefeed_staleness_seconds", "Seconds from a change's commit until a snapshot serving it was published.")
+METRICS = [REQUEST_SECONDS, REQUESTS, STAGE_SECONDS, RESPONSE_ROWS, REJECTED, LOOKUPS, CHANGES, STALENESS]
+# functions returning (name, type, help, [(labels dict, value)]) gauges computed at scrape time
+COLLECTORS = []
+
+
+def register_collector(collect):
+    COLLECTORS.append(collect)
+
+
+def render():
+    # every metric in the Prometheus text exposition format
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    for collect in COLLECTORS:
+        try:
+            samples = collect()
+        except Exception as error:
+            print(f"Metrics collector failed: {error}")
+            continue
+        for name, kind, help, values in samples:
+            lines += [f"# HELP {PREFIX}{name} {help}", f"# TYPE {PREFIX}{name} {kind}"]
+            lines += [f"{PREFIX}{name}{_labels(tuple(labels.items()))} {_number(value)}" for labels, value in values]
+    return "\n".join(lines) + "\n"
+
+
+# -------------------
+# Stage timers and request traces
+# -------------------
+
+class Trace:
+    # the stages of one request, reported back in the Server-Timing header
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.profile_id = None
+        self.stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            total, count = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, count + 1)
+
+    def server_timing(self):
+        return ", ".join(f"{name.replace('.', '-')};dur={total * 1000:.2f}" for name, (total, count) in self.stages.items())
+
+
+current_trace = contextvars.ContextVar("bena_trace", default=None)
+
+
+@contextmanager
+def stage(name):
+    # times a block into the stage histogram and into the current request's trace
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=name)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(name, seconds)
+
+
+def timed(name):
+    # decorator form of stage()
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def observe_rows(endpoint, rows):
+    RESPONSE_ROWS.observe(rows, endpoint=endpoint)
+
+
+# -------------------
+# Sampling Profiler
+# -------------------
+
+class Sampler:
+    # samples one thread's python stack every interval from a background thread, stacks are kept folded
+    # ("outer;inner" -> samples) so they can be fed to flamegraph tools as they are
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = StackCounts()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None and len(names) < MAX_DEPTH:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+                self.samples += 1
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stopped.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self._start
+
+    def folded(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+_profiles = OrderedDict()
+_profiles_lock = threading.Lock()
+
+
+def profiled(function, *args, **kwargs):
+    # run function on the current thread, under the sampler when the current request asked for a profile
+    trace = current_trace.get()
+    if trace is None or not trace.profile:
+        return function(*args, **kwargs)
+    with Sampler(threading.get_ident()) as sampler:
+        result = function(*args, **kwargs)
+    profile_id = uuid.uuid4().hex
+    with _profiles_lock:
+        _profiles[profile_id] = {
+            "function": getattr(function, "__name__", str(function)),
+            "seconds": round(sampler.seconds, 4),
+            "samples": sampler.samples,
+            "stacks": sampler.folded(),
+        }
+        while len(_profiles) > MAX_PROFILES:
+            _profiles.popitem(last=False)
+    trace.profile_id = profile_id
+    return result
+
+
+def get_profile(profile_id):
+    with _profiles_lock:
+        return _profiles.get(profile_id)
+
+
+def list_profiles():
+    with _profiles_lock:
+        return [
+            {"profile_id": profile_id, "function": profile["function"], "seconds": profile["seconds"], "samples": profile["samples"]}
+            for profile_id, profile in reversed(_profiles.items())
+        ]
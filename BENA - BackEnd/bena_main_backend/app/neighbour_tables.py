@@ -0,0 +1,331 @@
+# precomputed top-K nearest and top-K most similar places of every place, for place detail lookups without a query.
+# fixed width int32/float32 tables aligned with the snapshot places frame, rows are -1 padded
+# usage: python -m app.neighbour_tables   (builds and saves the tables for the current data, workers then load them)
+import os
+import json
+import time
+import zlib
+import shutil
+import hashlib
+import argparse
+import numpy as np
+from sklearn.neighbors import KDTree
+# shared data snapshots
+from app.data_snapshot import DATA_DIR, get_snapshot, register_derived
+# vectorized distances
+from app.geo import R, coordinates
+# sparse top-K tag similarity between places
+from app.similarity_index import SimilarityIndex
+
+# nearest and most similar places kept per place, near lookups asking for more fall back to the spatial index
+NEAR_K = int(os.environ.get("BENA_NEAR_TOP_K", "20"))
+SIMILAR_K = int(os.environ.get("BENA_SIMILAR_TOP_K", "20"))
+# moved places compared with every place per block during updates, bounds the scratch matrix to BLOCK x places
+BLOCK = 256
+CHORD_SLACK = 1e-12
+# above this share of affected rows a full rebuild is cheaper than patching
+MAX_INCREMENTAL_SHARE = 0.25
+TABLES_DIR = os.path.join(DATA_DIR, "neighbours")
+ARRAYS = ("ids", "lat", "lon", "tag_hashes", "near_rows", "near_distances", "similar_rows", "similar_scores")
+
+
+def fingerprint(ids, lat, lon, similarity_fingerprint):
+    # identifies the places, coordinates and tag similarities the tables were computed from
+    digest = hashlib.sha1()
+    digest.update("\x1f".join(map(str, ids)).encode("utf-8"))
+    digest.update(np.asarray(lat, dtype=np.float32).tobytes())
+    digest.update(np.asarray(lon, dtype=np.float32).tobytes())
+    digest.update(str(similarity_fingerprint).encode("utf-8"))
+    digest.update(f"{NEAR_K}/{SIMILAR_K}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def tag_hashes(tags):
+    # a checksum of every place's tags, updates tell retagged places from ones that only moved
+    return np.array([zlib.crc32(tag.encode("utf-8")) for tag in tags], dtype=np.uint32)
+
+
+def unit_vectors(lat, lon):
+    # points on the unit sphere, the straight line (chord) between two of them grows with their great-circle
+    # distance, so a euclidean KDTree ranks neighbours like a haversine tree at a fraction of the cost
+    lat, lon = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lon, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def nearest_rows(lat, lon, rows, k):
+    # the k nearest places of each of `rows` without the place itself, closest first, from one KDTree over every place
+    rows = np.asarray(rows, dtype=np.int64)
+    near_rows = np.full((len(rows), k), -1, dtype=np.int32)
+    near_distances = np.full((len(rows), k), np.inf, dtype=np.float32)
+    valid = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    # places without coordinates are near nothing
+    queried = np.flatnonzero(~(np.isnan(lat[rows]) | np.isnan(lon[rows])))
+    width = min(k + 1, len(valid))
+    if not len(queried) or width < 2:
+        return near_rows, near_distances
+    # one extra neighbour for the place itself
+    tree = KDTree(unit_vectors(lat[valid], lon[valid]))
+    chords, indices = tree.query(unit_vectors(lat[rows[queried]], lon[rows[queried]]), k=width)
+    found = valid[indices]
+    # drop the place itself, or the farthest hit when duplicates at the same spot hid it
+    others = found != rows[queried][:, None]
+    order = np.argsort(~others, axis=1, kind="stable")[:, :width - 1]
+    found, chords = np.take_along_axis(found, order, axis=1), np.take_along_axis(chords, order, axis=1)
+    near_rows[queried, :width - 1] = found
+    near_distances[queried, :width - 1] = 2 * R * np.arcsin(np.clip(chords / 2, 0, 1))
+    return near_rows, near_distances
+
+
+def similar_rows(matrix, rows, k):
+    # the k most similar places of each of `rows` from the similarity matrix, best first, without the place itself
+    block = matrix[rows].tocsr()
+    block.sort_indices()
+    counts = np.diff(block.indptr)
+    width = int(counts.max(initial=0))
+    # the rows hold at most the similarity index's top-K, sort them side by side in a padded dense block
+    owner = np.repeat(np.arange(len(rows)), counts)
+    position = np.arange(block.nnz) - block.indptr[owner]
+    scores = np.full((len(rows), width), -np.inf, dtype=np.float32)
+    columns = np.full((len(rows), width), -1, dtype=np.int32)
+    scores[owner, position] = np.where(block.indices == np.asarray(rows)[owner], -np.inf, block.data)
+    columns[owner, position] = block.indices
+    # best first, ties by place row as the columns are sorted
+    order = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    scores, columns = np.take_along_axis(scores, order, axis=1), np.take_along_axis(columns, order, axis=1)
+    found = np.isfinite(scores)
+    table_rows = np.full((len(rows), k), -1, dtype=np.int32)
+    table_scores = np.zeros((len(rows), k), dtype=np.float32)
+    table_rows[:, :order.shape[1]] = np.where(found, columns, -1)
+    table_scores[:, :order.shape[1]] = np.where(found, scores, 0)
+    return table_rows, table_scores
+
+
+class NeighbourTables:
+    # row i holds the neighbours of the place at snapshot row i, neighbours are snapshot rows too
+    def __init__(self, ids, lat, lon, tag_hashes, near_rows, near_distances, similar_rows, similar_scores, build_seconds,
+                 fingerprint=None, fit_id=None):
+        self.ids = ids
+        self.lat, self.lon = lat, lon
+        self.tag_hashes = tag_hashes
+        self.near_rows, self.near_distances = near_rows, near_distances
+        self.similar_rows, self.similar_scores = similar_rows, similar_scores
+        self.build_seconds = build_seconds
+        self.fingerprint = fingerprint
+        # the tag weights the similarities were scored with, a refit changes every score
+        self.fit_id = fit_id
+
+    @property
+    def near_k(self):
+        return self.near_rows.shape[1]
+
+    @classmethod
+    def build(cls, ids, lat, lon, similarity: SimilarityIndex, near_k=NEAR_K, similar_k=SIMILAR_K):
+        start = time.perf_counter()
+        lat, lon = np.asarray(lat, dtype=np.float32), np.asarray(lon, dtype=np.float32)
+        near, near_distances = nearest_rows(lat, lon, np.arange(len(ids)), near_k)
+        similar, similar_scores = similar_rows(similarity.matrix, np.arange(len(ids)), similar_k)
+        return cls(
+            np.asarray(ids, dtype=str), lat, lon, tag_hashes(similarity.tags), near, near_distances, similar, similar_scores,
+            time.perf_counter() - start, fingerprint=fingerprint(ids, lat, lon, similarity.fingerprint),
+            fit_id=similarity.fit_id,
+        )
+
+    def update(self, ids, lat, lon, similarity: SimilarityIndex, changed):
+        # tables for the next snapshot recomputing only the rows the changed places can affect,
+        # returns None when a full build is cheaper
+        start = time.perf_counter()
+        if similarity.fit_id != self.fit_id:
+            return None
+        lat, lon = np.asarray(lat, dtype=np.float32), np.asarray(lon, dtype=np.float32)
+        size, near_k, similar_k = len(ids), self.near_rows.shape[1], self.similar_rows.shape[1]
+        row_of = {place_id: row for row, place_id in enumerate(ids)}
+        old_ids = self.ids.tolist()
+        new_of_old = np.array([row_of.get(place_id, -1) for place_id in old_ids], dtype=np.int64)
+        survivors = np.flatnonzero(new_of_old >= 0)
+        old_of_new = np.full(size, -1, dtype=np.int64)
+        old_of_new[new_of_old[survivors]] = survivors
+        changed_rows = np.array([row_of[place_id] for place_id in changed if place_id in row_of], dtype=np.int64)
+
+        # places that are new or moved change distances, new or retagged ones change tag similarities
+        hashes = np.zeros(size, dtype=np.uint32)
+        hashes[old_of_new >= 0] = self.tag_hashes[old_of_new[old_of_new >= 0]]
+        hashes[changed_rows] = tag_hashes([similarity.tags[row] for row in changed_rows])
+        moved = old_of_new < 0
+        retagged = old_of_new < 0
+        if len(changed_rows):
+            old = old_of_new[changed_rows]
+            kept = old >= 0
+            same = np.zeros(len(changed_rows), dtype=bool)
+            same[kept] = (self.lat[old[kept]] == lat[changed_rows[kept]]) & (self.lon[old[kept]] == lon[changed_rows[kept]])
+            same[kept] |= np.isnan(self.lat[old[kept]]) & np.isnan(lat[changed_rows[kept]])
+            moved[changed_rows[~same]] = True
+            retagged[changed_rows[kept]] = self.tag_hashes[old[kept]] != hashes[changed_rows[kept]]
+
+        # neighbours referring to a moved or deleted place are lost, other references are renumbered
+        stale_near = np.full(len(old_ids), -1, dtype=np.int64)
+        stale_near[survivors] = np.where(moved[new_of_old[survivors]], -1, new_of_old[survivors])
+        stale_similar = np.full(len(old_ids), -1, dtype=np.int64)
+        stale_similar[survivors] = np.where(retagged[new_of_old[survivors]], -1, new_of_old[survivors])
+
+        near, near_distances, near_affected = self._carry(self.near_rows, self.near_distances, old_of_new, stale_near, np.inf)
+        similar, similar_scores, similar_affected = self._carry(self.similar_rows, self.similar_scores, old_of_new, stale_similar, 0)
+        near_affected |= moved
+        similar_affected |= retagged
+
+        # places a moved place is now closer to than their farthest kept neighbour, compared as squared chords
+        # (2 - 2 cos) with some slack for rounding, a row recomputed for nothing is still correct
+        moved_rows = np.flatnonzero(moved & ~(np.isnan(lat) | np.isnan(lon)))
+        if len(moved_rows):
+            points = unit_vectors(lat, lon)
+            full = near[:, -1] >= 0
+            farthest = np.full(size, np.inf)
+            farthest[full] = (2 * np.sin(near_distances[full, -1].astype(np.float64) / (2 * R))) ** 2
+            for begin in range(0, len(moved_rows), BLOCK):
+                closest = np.fmin.reduce(2 - 2 * (points[moved_rows[begin:begin + BLOCK]] @ points.T), axis=0)
+                near_affected |= closest < farthest + CHORD_SLACK
+        # the distance rows are the costly ones to recompute
+        if near_affected.sum() > MAX_INCREMENTAL_SHARE * size:
+            return None
+        # places the retagged places became similar to
+        retagged_rows = np.flatnonzero(retagged)
+        if len(retagged_rows):
+            similar_to_retagged = similarity.matrix[:, retagged_rows].tocsr()
+            similar_affected[np.flatnonzero(np.diff(similar_to_retagged.indptr))] = True
+        rows = np.flatnonzero(near_affected)
+        if len(rows):
+            near[rows], near_distances[rows] = nearest_rows(lat, lon, rows, near_k)
+        rows = np.flatnonzero(similar_affected)
+        if len(rows):
+            similar[rows], similar_scores[rows] = similar_rows(similarity.matrix, rows, similar_k)
+        return NeighbourTables(
+            np.asarray(ids, dtype=str), lat, lon, hashes, near, near_distances, similar, similar_scores,
+            self.build_seconds + time.perf_counter() - start, fingerprint=fingerprint(ids, lat, lon, similarity.fingerprint),
+            fit_id=self.fit_id,
+        )
+
+    @staticmethod
+    def _carry(table, values, old_of_new, renumber, empty):
+        # the rows of the surviving places at their new positions, with their neighbours renumbered,
+        # and the rows that lost a neighbour or are new
+        size, k = len(old_of_new), table.shape[1]
+        rows = np.full((size, k), -1, dtype=np.int32)
+        carried = np.full((size, k), empty, dtype=np.float32)
+        kept = np.flatnonzero(old_of_new >= 0)
+        old = np.asarray(table[old_of_new[kept]], dtype=np.int64)
+        present = old >= 0
+        moved = np.where(present, renumber[np.maximum(old, 0)], -1)
+        rows[kept] = moved
+        carried[kept] = np.where(moved >= 0, values[old_of_new[kept]], empty)
+        affected = old_of_new < 0
+        affected[kept] = (present & (moved < 0)).any(axis=1)
+        return rows, carried, affected
+
+    def near(self, row, radius, n):
+        # (rows, distances) of up to n places within radius km of the place at row, closest first,
+        # None when the table can't tell: fewer than n kept neighbours are within the radius
+        # and farther places could still be
+        rows, distances = self.near_rows[row], self.near_distances[row]
+        count = int((rows >= 0).sum())
+        hits = int(np.searchsorted(distances[:count], radius, side="right"))
+        if hits >= n or count < self.near_k or distances[count - 1] > radius:
+            hits = min(hits, n)
+            return np.asarray(rows[:hits], dtype=np.int64), np.asarray(distances[:hits])
+        return None
+
+    def similar(self, row, n):
+        # (rows, similarity scores) of up to n places sharing tags with the place at row, best first
+        rows, scores = self.similar_rows[row], self.similar_scores[row]
+        count = min(int((rows >= 0).sum()), n)
+        return np.asarray(rows[:count], dtype=np.int64), np.asarray(scores[:count])
+
+    def stats(self):
+        return {
+            "places": len(self.ids),
+            "near_k": self.near_rows.shape[1],
+            "similar_k": self.similar_rows.shape[1],
+            "bytes": int(sum(np.asarray(getattr(self, name)).nbytes for name in ARRAYS[1:])),
+            "build_seconds": round(self.build_seconds, 4),
+        }
+
+    def save(self, directory):
+        # every array in its own .npy file so load() can memory-map them, swapped in as a whole
+        os.makedirs(os.path.dirname(directory) or ".", exist_ok=True)
+        # temp and old directories per process, workers and the job may save at the same time
+        temp = f"{directory}.{os.getpid()}.tmp"
+        shutil.rmtree(temp, ignore_errors=True)
+        os.makedirs(temp)
+        for name in ARRAYS:
+            np.save(os.path.join(temp, f"{name}.npy"), np.asarray(getattr(self, name)))
+        with open(os.path.join(temp, "meta.json"), "w") as file:
+            json.dump({"build_seconds": self.build_seconds, "fingerprint": self.fingerprint}, file)
+        old = f"{directory}.{os.getpid()}.old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(directory):
+            os.replace(directory, old)
+        os.replace(temp, directory)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory):
+        # zero-copy, the tables stay on disk and only the looked up rows are paged in
+        with open(os.path.join(directory, "meta.json")) as file:
+            meta = json.load(file)
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+        return cls(*(arrays[name] for name in ARRAYS), meta["build_seconds"], fingerprint=meta["fingerprint"])
+
+
+# -------------------
+# Snapshot integration
+# -------------------
+
+def _place_coordinates(snapshot):
+    places_df = snapshot.places
+    lat, lon = coordinates(places_df)
+    return places_df["places_id"].astype(str).tolist(), lat, lon
+
+
+def build_neighbour_tables(snapshot):
+    ids, lat, lon = _place_coordinates(snapshot)
+    similarity: SimilarityIndex = snapshot.derived("similarity_index")
+    # reuse the tables saved by the job or another worker when they were computed from the same places
+    if os.path.exists(TABLES_DIR):
+        try:
+            tables = NeighbourTables.load(TABLES_DIR)
+            if tables.fingerprint == fingerprint(ids, lat, lon, similarity.fingerprint):
+                tables.fit_id = similarity.fit_id
+                return tables
+        except Exception as error:
+            print(f"Could not load neighbour tables: {error}")
+    tables = NeighbourTables.build(ids, lat, lon, similarity)
+    _save(tables)
+    return tables
+
+
+def update_neighbour_tables(tables, snapshot):
+    changed = snapshot.changed("places")
+    if not changed:
+        return tables
+    ids, lat, lon = _place_coordinates(snapshot)
+    tables = tables.update(ids, lat, lon, snapshot.derived("similarity_index"), {str(place_id) for place_id in changed})
+    if tables is not None:
+        _save(tables)
+    return tables
+
+
+def _save(tables):
+    # a failed save only costs the next worker a rebuild, the snapshot is still published
+    try:
+        tables.save(TABLES_DIR)
+    except OSError as error:
+        print(f"Could not save neighbour tables: {error}")
+
+
+register_derived("neighbour_tables", build_neighbour_tables, update_neighbour_tables)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the nearest and most similar places of every place")
+    parser.parse_args()
+    start = time.perf_counter()
+    tables = get_snapshot().derived("neighbour_tables")
+    print(f"Neighbour tables of {len(tables.ids)} places ready in {time.perf_counter() - start:.2f}s: {tables.stats()}")
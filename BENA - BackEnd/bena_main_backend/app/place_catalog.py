@@ -0,0 +1,300 @@
+# compact columnar place catalogue, memory-mapped from disk so every worker process shares one copy
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+# shared data snapshots
+from app.data_snapshot import DATA_DIR, register_derived
+
+# Arrow IPC files when pyarrow is installed, plain .npy files otherwise
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+TEXT_COLUMNS = ["name", "arabic_name", "address"]
+# places with this tag are shown with a low score
+UNAVAILABLE_TAG = "not available yet"
+CATALOG_PATH = os.path.join(DATA_DIR, "places.arrow" if pa is not None else "places")
+
+
+class StringColumn:
+    # utf-8 strings stored back to back in Arrow's layout, row i is data[offsets[i]:offsets[i + 1]], missing values are ""
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_values(cls, values):
+        encoded = [b"" if value is None or value != value else str(value).encode("utf-8") for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int32)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return self.data[self.offsets[row]:self.offsets[row + 1]].tobytes().decode("utf-8")
+
+    def tolist(self):
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        return [data[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def take(self, rows):
+        offsets, positions = take_ragged(self.offsets, rows)
+        return StringColumn(offsets, np.asarray(self.data)[positions])
+
+    def append(self, other):
+        offsets = np.concatenate([self.offsets, np.asarray(other.offsets[1:]) + self.offsets[-1]]).astype(np.int32)
+        return StringColumn(offsets, np.concatenate([self.data, other.data]))
+
+
+def take_ragged(indptr, rows):
+    # (indptr, value positions) of the given rows of a ragged layout, row i spanning indptr[i]:indptr[i + 1]
+    starts = np.asarray(indptr, dtype=np.int64)[rows]
+    lengths = np.asarray(indptr, dtype=np.int64)[np.asarray(rows) + 1] - starts
+    new_indptr = np.zeros(len(starts) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=new_indptr[1:])
+    positions = np.repeat(starts - new_indptr[:-1], lengths) + np.arange(new_indptr[-1])
+    return new_indptr, positions
+
+
+def split_tags(tags):
+    # dictionary-encoded tags: (vocabulary, indptr, codes), row i has codes[indptr[i]:indptr[i + 1]]
+    lists = tags.fillna("").astype(str).str.split(",")
+    exploded = lists.explode().str.strip()
+    counts = np.zeros(len(tags), dtype=np.int32)
+    rows = np.repeat(np.arange(len(tags)), lists.str.len().to_numpy())
+    keep = (exploded != "").to_numpy()
+    np.add.at(counts, rows[keep], 1)
+    codes, vocabulary = pd.factorize(exploded[keep])
+    indptr = np.zeros(len(tags) + 1, dtype=np.int32)
+    np.cumsum(counts, out=indptr[1:])
+    return [str(tag) for tag in vocabulary], indptr, codes.astype(np.int32)
+
+
+def fingerprint(ids, lat, lon, vocabulary, codes, texts):
+    digest = hashlib.sha1()
+    for column in (ids, *texts):
+        digest.update(column.offsets.tobytes())
+        digest.update(column.data.tobytes())
+    for array in (lat, lon, codes):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update("\x1f".join(vocabulary).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class PlaceCatalog:
+    # the places table as flat arrays aligned with snapshot.places rows: string ids, float32 coordinates,
+    # dictionary-encoded tags and the text columns, plus an id -> row hash map
+    def __init__(self, ids, lat, lon, vocabulary, tag_indptr, tag_codes, texts, fingerprint=None):
+        self.ids = ids
+        self.lat = lat
+        self.lon = lon
+        self.vocabulary = vocabulary
+        self.tag_indptr = tag_indptr
+        self.tag_codes = tag_codes
+        self.texts = texts
+        self.fingerprint = fingerprint
+        # the file the arrays are mapped from, None while they are in memory
+        self.path = None
+        self.row_of = {place_id: row for row, place_id in enumerate(ids.tolist())}
+        # places tagged "Not available yet"
+        flagged = np.array([UNAVAILABLE_TAG in tag.lower() for tag in vocabulary], dtype=bool)
+        tag_rows = np.repeat(np.arange(len(ids)), np.diff(tag_indptr))
+        self.unavailable = np.zeros(len(ids), dtype=bool)
+        if len(flagged):
+            self.unavailable[tag_rows[flagged[tag_codes]]] = True
+
+    @classmethod
+    def build(cls, places_df):
+        ids = StringColumn.from_values(places_df["places_id"].astype(str))
+        lat = pd.to_numeric(places_df["latitude"], errors="coerce").to_numpy(dtype=np.float32) if "latitude" in places_df else np.full(len(places_df), np.nan, dtype=np.float32)
+        lon = pd.to_numeric(places_df["longitude"], errors="coerce").to_numpy(dtype=np.float32) if "longitude" in places_df else np.full(len(places_df), np.nan, dtype=np.float32)
+        vocabulary, indptr, codes = split_tags(places_df["tags"] if "tags" in places_df else pd.Series([""] * len(places_df)))
+        texts = {column: StringColumn.from_values(places_df[column] if column in places_df else [""] * len(places_df)) for column in TEXT_COLUMNS}
+        return cls(ids, lat, lon, vocabulary, indptr, codes, texts,
+                   fingerprint=fingerprint(ids, lat, lon, vocabulary, codes, texts.values()))
+
+    def update(self, places_df, changed):
+        # the catalogue of the next snapshot, whose frame keeps the unchanged places in order and appends the
+        # changed ones after them, only those are encoded. None when the frame is laid out differently
+        changed = {str(place_id) for place_id in changed}
+        ids = self.ids.tolist()
+        kept = np.array([row for row, place_id in enumerate(ids) if place_id not in changed], dtype=np.int64)
+        if places_df["places_id"].iloc[:len(kept)].astype(str).tolist() != [ids[row] for row in kept]:
+            return None
+        tail = PlaceCatalog.build(places_df.iloc[len(kept):])
+        # the appended places' tags coded against the current vocabulary, tags it doesn't know go at its end
+        vocabulary = list(self.vocabulary)
+        code_of = {tag: code for code, tag in enumerate(vocabulary)}
+        for tag in tail.vocabulary:
+            if tag not in code_of:
+                code_of[tag] = len(vocabulary)
+                vocabulary.append(tag)
+        recode = np.array([code_of[tag] for tag in tail.vocabulary], dtype=np.int32)
+        indptr, positions = take_ragged(self.tag_indptr, kept)
+        tag_indptr = np.concatenate([indptr, tail.tag_indptr[1:] + indptr[-1]]).astype(np.int32)
+        tag_codes = np.concatenate([np.asarray(self.tag_codes)[positions], recode[tail.tag_codes]]).astype(np.int32)
+        place_ids = self.ids.take(kept).append(tail.ids)
+        lat = np.concatenate([self.lat[kept], tail.lat])
+        lon = np.concatenate([self.lon[kept], tail.lon])
+        texts = {column: self.texts[column].take(kept).append(tail.texts[column]) for column in TEXT_COLUMNS}
+        return PlaceCatalog(place_ids, lat, lon, vocabulary, tag_indptr, tag_codes, texts,
+                            fingerprint=fingerprint(place_ids, lat, lon, vocabulary, tag_codes, texts.values()))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, place_id):
+        # row of a place id, None when it is not in the catalogue
+        return self.row_of.get(place_id)
+
+    def rows(self, place_ids):
+        # rows of the known place ids, in the given order
+        return np.array([self.row_of[place_id] for place_id in place_ids if place_id in self.row_of], dtype=np.int64)
+
+    def tags(self, row):
+        return [self.vocabulary[code] for code in self.tag_codes[self.tag_indptr[row]:self.tag_indptr[row + 1]]]
+
+    def stats(self):
+        arrays = [self.ids.offsets, self.ids.data, self.lat, self.lon, self.tag_indptr, self.tag_codes]
+        arrays += [array for column in self.texts.values() for array in (column.offsets, column.data)]
+        return {
+            "places": len(self),
+            "tags": len(self.vocabulary),
+            "bytes": int(sum(array.nbytes for array in arrays)),
+            "path": self.path,
+        }
+
+    # -------------------
+    # Persistence
+    # -------------------
+
+    def save(self, path=CATALOG_PATH):
+        temp = f"{path}.{os.getpid()}.tmp"
+        if pa is not None:
+            self._save_arrow(temp)
+        else:
+            self._save_numpy(temp)
+        # replace the whole file or directory at once, readers keep their old mapping
+        old = f"{path}.{os.getpid()}.old"
+        if os.path.isdir(path):
+            os.replace(path, old)
+        os.replace(temp, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path=CATALOG_PATH):
+        catalog = cls._load_arrow(path) if pa is not None else cls._load_numpy(path)
+        catalog.path = path
+        return catalog
+
+    def _save_arrow(self, path):
+        def strings(column):
+            return pa.StringArray.from_buffers(len(column), pa.py_buffer(column.offsets), pa.py_buffer(column.data))
+
+        tags = pa.ListArray.from_arrays(
+            pa.array(self.tag_indptr, type=pa.int32()),
+            pa.DictionaryArray.from_arrays(pa.array(self.tag_codes, type=pa.int32()), pa.array(self.vocabulary, type=pa.string())),
+        )
+        columns = {"places_id": strings(self.ids), "latitude": pa.array(self.lat), "longitude": pa.array(self.lon), "tags": tags}
+        columns.update({column: strings(values) for column, values in self.texts.items()})
+        table = pa.table(columns).replace_schema_metadata({"fingerprint": self.fingerprint or ""})
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    @classmethod
+    def _load_arrow(cls, path):
+        # zero-copy, every array below is a view into the mapped file
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+        def column(name):
+            return table.column(name).chunk(0)
+
+        def strings(name):
+            array = column(name)
+            offsets = np.frombuffer(array.buffers()[1], dtype=np.int32)[array.offset:array.offset + len(array) + 1]
+            return StringColumn(offsets, np.frombuffer(array.buffers()[2], dtype=np.uint8))
+
+        tags = column("tags")
+        return cls(
+            strings("places_id"),
+            column("latitude").to_numpy(zero_copy_only=True),
+            column("longitude").to_numpy(zero_copy_only=True),
+            tags.values.dictionary.to_pylist(),
+            tags.offsets.to_numpy(zero_copy_only=True),
+            tags.values.indices.to_numpy(zero_copy_only=True),
+            {name: strings(name) for name in TEXT_COLUMNS},
+            fingerprint=table.schema.metadata[b"fingerprint"].decode() or None,
+        )
+
+    def _arrays(self):
+        arrays = {"ids_offsets": self.ids.offsets, "ids_data": self.ids.data, "lat": self.lat, "lon": self.lon,
+                  "tag_indptr": self.tag_indptr, "tag_codes": self.tag_codes}
+        for name, column in self.texts.items():
+            arrays[f"{name}_offsets"], arrays[f"{name}_data"] = column.offsets, column.data
+        return arrays
+
+    def _save_numpy(self, path):
+        os.makedirs(path)
+        for name, array in self._arrays().items():
+            np.save(os.path.join(path, f"{name}.npy"), np.asarray(array))
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump({"vocabulary": self.vocabulary, "fingerprint": self.fingerprint}, file)
+
+    @classmethod
+    def _load_numpy(cls, path):
+        with open(os.path.join(path, "meta.json")) as file:
+            meta = json.load(file)
+
+        def array(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        return cls(
+            StringColumn(array("ids_offsets"), array("ids_data")), array("lat"), array("lon"),
+            meta["vocabulary"], array("tag_indptr"), array("tag_codes"),
+            {name: StringColumn(array(f"{name}_offsets"), array(f"{name}_data")) for name in TEXT_COLUMNS},
+            fingerprint=meta["fingerprint"],
+        )
+
+
+# -------------------
+# Snapshot integration
+# -------------------
+
+def _share(catalog):
+    # the first worker to see a snapshot writes the catalogue, the others map the same file
+    if os.path.exists(CATALOG_PATH):
+        try:
+            persisted = PlaceCatalog.load(CATALOG_PATH)
+            if persisted.fingerprint == catalog.fingerprint:
+                return persisted
+        except Exception as error:
+            print(f"Could not load place catalogue: {error}")
+    try:
+        catalog.save(CATALOG_PATH)
+        return PlaceCatalog.load(CATALOG_PATH)
+    except OSError as error:
+        print(f"Could not save place catalogue: {error}")
+        return catalog
+
+
+def build_place_catalog(snapshot):
+    return _share(PlaceCatalog.build(snapshot.places))
+
+
+def update_place_catalog(catalog, snapshot):
+    changed = snapshot.changed("places")
+    if not changed:
+        return catalog
+    catalog = catalog.update(snapshot.places, changed)
+    return _share(catalog) if catalog is not None else None
+
+
+register_derived("place_catalog", build_place_catalog, update_place_catalog)
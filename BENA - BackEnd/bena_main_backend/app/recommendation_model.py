@@ -1,57 +1,82 @@
 # create auto categorization model and its auto generated Trips
-from dotenv import load_dotenv
-
-load_dotenv()
-
 import re
 import os
 import numpy as np 
 import pandas as pd 
-from supabase import create_client, Client
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.neighbors import NearestNeighbors
-
-# initialize supabase connection
-url: str = os.environ.get("SUPABASE_URL")
-key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
-def update_dataframes():
-    # fetch places data from database into dataframe
-    table_name = "places"
-    response = supabase.table(table_name).select("*").execute()
-    data = response.data
-    places_df = pd.DataFrame(data)
-    # fetch bookmarks data from database into dataframe
-    table_name = "bookmarks"
-    response = supabase.table(table_name).select("*").execute()
-    data = response.data
-    bookmarks_df = pd.DataFrame(data)
-    # fetch interactions data from database into dataframe
-    table_name = "interactions"
-    response = supabase.table(table_name).select("*").execute()
-    data = response.data
-    interactions_df = pd.DataFrame(data)
+# shared data snapshots
+from app.data_snapshot import get_snapshot, register_derived
+# matrix scoring for many users and precomputed results
+from app.batch_recommendation import METHODS as BATCH_METHODS, get_result_store, score_users, top_n
+# per-user result cache
+from app.result_cache import get_result_cache
+# stage timers and cache lookup counters
+from app.metrics import stage, timed, LOOKUPS
+# vectorized distances
+from app.geo import min_distance
+# sparse top-K tag similarity between places
+from app.similarity_index import SimilarityIndex
+# spatial index over place coordinates
+from app.spatial_index import SpatialIndex
+# places visited together in trips and bookmark lists
+from app.cooccurrence_index import CooccurrenceIndex
+# hashed text embeddings with an approximate nearest-neighbour index
+from app.embedding_index import EmbeddingIndex
+# compact place columns and the id -> row map
+from app.place_catalog import PlaceCatalog
+
+def build_interactions(snapshot):
+    interactions_df = snapshot.interactions
+    bookmarks_df = snapshot.bookmarks
+    for df in (interactions_df, bookmarks_df):
+        if "user_id" not in df or "place_id" not in df:
+            return pd.DataFrame(columns=["user_id", "place_id"])
     # merge interactions and bookmarks tables
-    interactions_df = interactions_df.merge(bookmarks_df, on=["user_id", "place_id"], how="outer")  
+    return interactions_df.merge(bookmarks_df, on=["user_id", "place_id"], how="outer")
+
+# built once per snapshot instead of once per request
+register_derived("recommendation.interactions", build_interactions)
+
+@timed("recommend.snapshot")
+def update_dataframes():
+    # read the latest snapshot, the models and merges are cached on it.
+    # places_df is shared with every other request: the recommenders score into their own arrays
+    # and only copy the n recommended rows
+    snapshot = get_snapshot()
+    places_df = snapshot.places
+    bookmarks_df = snapshot.bookmarks
+    interactions_df = snapshot.derived("recommendation.interactions")
     # -------------------
     # Content-Based Filtering
     # -------------------
+    # top-K tag similarities, rows are aligned with places_df
+    similarity: SimilarityIndex = snapshot.derived("similarity_index")
+    # radius and nearest neighbour queries, rows are aligned with places_df
+    spatial_index: SpatialIndex = snapshot.derived("spatial_index")
+    # -------------------
+    # Collaborative Filtering
+    # -------------------
+    # trip and bookmark co-occurrences, rows are aligned with places_df
+    cooccurrence: CooccurrenceIndex = snapshot.derived("cooccurrence_index")
+    # text embeddings, rows are aligned with places_df
+    embeddings: EmbeddingIndex = snapshot.derived("embedding_index")
+    # place id -> row lookups and tag flags without scanning places_df
+    catalog: PlaceCatalog = snapshot.derived("place_catalog")
 
-    # Create a TF-IDF vectorizer for tags
-    tfidf = TfidfVectorizer(stop_words="english")
-    places_df["tags"] = places_df["tags"].fillna("")
-    tag_matrix = tfidf.fit_transform(places_df["tags"])
-
-    # Cosine similarity for places based on tags
-    cosine_sim = cosine_similarity(tag_matrix, tag_matrix)
-
-    return places_df, bookmarks_df, interactions_df, cosine_sim
+    return places_df, bookmarks_df, interactions_df, similarity, spatial_index, cooccurrence, embeddings, catalog
 
 
+def result_rows(places_df, rows, **scores):
+    # copy only the recommended rows out of the shared places_df and attach their score columns
+    recommendations = places_df.iloc[rows].copy()
+    if "tags" in recommendations:
+        recommendations["tags"] = recommendations["tags"].fillna("")
+    for column, values in scores.items():
+        recommendations[column] = values
+    return recommendations
 
 
-def recommend_places_content_based(user_id, places_df, cosine_sim, bookmarks_df, n=5):
+@timed("recommend.content_based")
+def recommend_places_content_based(user_id, places_df, similarity, bookmarks_df, catalog, n=5):
     # Get the user's bookmarked places
     bookmarked_places = bookmarks_df[bookmarks_df["user_id"] == user_id]["place_id"].tolist()
     
@@ -59,41 +84,19 @@ def recommend_places_content_based(user_id, places_df, cosine_sim, bookmarks_df,
         print(f"No bookmarks found for user {user_id}.")
         return pd.DataFrame()  # Return an empty DataFrame if no bookmarks exist
 
-    # Calculate content-based scores
-    content_scores = np.zeros(len(places_df))
-    
-    for place_id in bookmarked_places:
-        place_idx = places_df[places_df["places_id"] == place_id].index[0]
-        content_scores += cosine_sim[place_idx]
-    
-    # Assign scores to places
-    places_df["score"] = content_scores
+    # Calculate content-based scores by summing the sparse similarity rows of the bookmarks
+    scores = similarity.scores(bookmarked_places)
 
     # Exclude places with tags "Not available yet" or assign them a low score
-    average_score = places_df["score"].mean()
     low_score = 0.1
-    places_df.loc[places_df["tags"].str.contains("Not available yet", case=False, na=False), "score"] = low_score
-    
-    
-    # Sort by content-based scores
-    recommendations = places_df.sort_values(by="score", ascending=False)
-    
-    # Exclude places the user has already bookmarked
-    recommendations = recommendations[~recommendations["places_id"].isin(bookmarked_places)]
-    
-    # Return top `n` recommendations
-    return recommendations.head(n)
-
-def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371  # Radius of Earth in kilometers
-    lat1, lat2, lon1, lon2 = map(np.radians, [lat1, lat2, lon1, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    return R * c
-
-def recommend_places_near_bookmarks(user_id, places_df, bookmarks_df, n=5):
+    scores[catalog.unavailable] = low_score
+
+    # Top `n` recommendations without the places the user has already bookmarked
+    rows, scores = top_n(scores, n, exclude=catalog.rows(bookmarked_places))
+    return result_rows(places_df, rows, score=scores)
+
+@timed("recommend.near_bookmarks")
+def recommend_places_near_bookmarks(user_id, places_df, bookmarks_df, spatial_index, catalog, n=5):
     # Get the user's bookmarked places
     bookmarked_places = bookmarks_df[bookmarks_df["user_id"] == user_id]["place_id"].tolist()
     
@@ -102,34 +105,64 @@ def recommend_places_near_bookmarks(user_id, places_df, bookmarks_df, n=5):
         return pd.DataFrame()  # Return an empty DataFrame if no bookmarks exist
 
     # Get coordinates of bookmarked places
-    bookmarked_places_coords = places_df[places_df["places_id"].isin(bookmarked_places)][["latitude", "longitude"]].values
+    bookmarked_rows = catalog.rows(bookmarked_places)
     
     # If no coordinates are found, return an empty DataFrame
-    if bookmarked_places_coords.size == 0:
+    if not len(bookmarked_rows):
         print(f"No coordinates found for bookmarked places of user {user_id}.")
         return pd.DataFrame()
 
-    # Calculate minimum distance to any bookmarked place
-    def min_distance_to_bookmarked(lat, lon):
-        distances = [haversine_distance(lat, lon, b_lat, b_lon) for b_lat, b_lon in bookmarked_places_coords]
-        return min(distances) if distances else float('inf')
+    # The places closest to any bookmarked place, over-fetching by the bookmarks which are excluded below
+    lat, lon = catalog.lat[bookmarked_rows], catalog.lon[bookmarked_rows]
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    if not valid.any():
+        print(f"No coordinates found for bookmarked places of user {user_id}.")
+        return pd.DataFrame()
+    rows, distances = spatial_index.query_knn_multi(lat[valid], lon[valid], n + len(bookmarked_rows))
 
-    # Compute distances for all places
-    places_df["distance_to_bookmarked"] = places_df.apply(
-        lambda row: min_distance_to_bookmarked(row["latitude"], row["longitude"]),
-        axis=1
-    )
+    # Exclude already bookmarked places, the rest is already sorted by distance
+    keep = ~np.isin(rows, bookmarked_rows)
+    return result_rows(places_df, rows[keep][:n], distance_to_bookmarked=distances[keep][:n])
 
-    # Exclude already bookmarked places
-    recommendations = places_df[~places_df["places_id"].isin(bookmarked_places)]
-    
-    # Sort by distance
-    recommendations = recommendations.sort_values(by="distance_to_bookmarked", ascending=True)
-    
-    # Return top `n` recommendations
-    return recommendations.head(n)
+@timed("recommend.collaborative")
+def recommend_places_collaborative(user_id, places_df, cooccurrence, n=5):
+    # Places in the user's bookmarks and trips
+    visited_rows = cooccurrence.user_places(user_id)
+
+    if not len(visited_rows):
+        print(f"No bookmarks or trips found for user {user_id}.")
+        return pd.DataFrame()  # Return an empty DataFrame if there is no history
+
+    # Score places by how often they appear together with the user's places, one sparse dot product
+    scores = cooccurrence.scores([user_id])[0]
 
-def recommend_places_hybrid(user_id,places_df, bookmarks_df, cosine_sim, n=5, weight_content=0.6, weight_proximity=0.4):
+    # Exclude places already in the user's history and places nobody visited together with them
+    rows, scores = top_n(np.where(scores > 0, scores, np.nan), n, exclude=visited_rows)
+    return result_rows(places_df, rows, collaborative_score=scores)
+
+@timed("recommend.semantic")
+def recommend_places_semantic(user_id, places_df, bookmarks_df, embeddings, catalog, n=5):
+    # Get the user's bookmarked places
+    bookmarked_places = bookmarks_df[bookmarks_df["user_id"] == user_id]["place_id"].tolist()
+
+    if not bookmarked_places:
+        print(f"No bookmarks found for user {user_id}.")
+        return pd.DataFrame()  # Return an empty DataFrame if no bookmarks exist
+
+    # The user's profile is the normalized sum of the bookmarked places' embeddings
+    bookmarked_rows = catalog.rows(bookmarked_places)
+    profile = embeddings.vectors_of_rows(bookmarked_rows).sum(axis=0)
+    norm = np.linalg.norm(profile)
+    if norm == 0:
+        print(f"No embeddings found for bookmarked places of user {user_id}.")
+        return pd.DataFrame()
+
+    # Nearest places to the profile from the approximate index, without the bookmarks, already sorted by similarity
+    rows, scores = embeddings.search(profile / norm, k=n, exclude=bookmarked_rows)
+    return result_rows(places_df, rows, semantic_score=scores)
+
+@timed("recommend.hybrid")
+def recommend_places_hybrid(user_id,places_df, bookmarks_df, similarity, catalog, n=5, weight_content=0.6, weight_proximity=0.4, cooccurrence=None, weight_collaborative=0.3):
     # Get the user's bookmarked places
     bookmarked_places = bookmarks_df[bookmarks_df["user_id"] == user_id]["place_id"].tolist()
     
@@ -138,71 +171,126 @@ def recommend_places_hybrid(user_id,places_df, bookmarks_df, cosine_sim, n=5, we
         return pd.DataFrame()  # Return an empty DataFrame if no bookmarks exist
 
     # ------- Content-Based Filtering ------------
-    content_scores = np.zeros(len(places_df))
-    for place_id in bookmarked_places:
-        place_idx = places_df[places_df["places_id"] == place_id].index[0]
-        content_scores += cosine_sim[place_idx]
-    places_df["content_score"] = content_scores
+    with stage("recommend.hybrid.content"):
+        content_scores = similarity.scores(bookmarked_places)
 
-    # Exclude places with tags "Not available yet" or assign them a low score
-    average_score = places_df["content_score"].mean()
-    low_score = 0.1
-    places_df.loc[places_df["tags"].str.contains("Not available yet", case=False, na=False), "content_score"] = low_score
+        # Exclude places with tags "Not available yet" or assign them a low score
+        low_score = 0.1
+        content_scores[catalog.unavailable] = low_score
 
     # ------- Proximity to Bookmarked Places ------------
     # Get coordinates of bookmarked places
-    bookmarked_places_coords = places_df[places_df["places_id"].isin(bookmarked_places)][["latitude", "longitude"]].values
+    bookmarked_rows = catalog.rows(bookmarked_places)
 
     # If no coordinates are found, return an empty DataFrame
-    if bookmarked_places_coords.size == 0:
+    if not len(bookmarked_rows):
         print(f"No coordinates found for bookmarked places of user {user_id}.")
         return pd.DataFrame()
 
-    # Calculate minimum distance to any bookmarked place
-    def min_distance_to_bookmarked(lat, lon):
-        distances = [haversine_distance(lat, lon, b_lat, b_lon) for b_lat, b_lon in bookmarked_places_coords]
-        return min(distances) if distances else float('inf')
+    with stage("recommend.hybrid.proximity"):
+        # Compute the minimum distance from all places to any bookmarked place in one pass
+        distances = min_distance(catalog.lat, catalog.lon, catalog.lat[bookmarked_rows], catalog.lon[bookmarked_rows])
 
-    # Compute distances for all places
-    places_df["distance_to_bookmarked"] = places_df.apply(
-        lambda row: min_distance_to_bookmarked(row["latitude"], row["longitude"]),
-        axis=1
-    )
-    
-    # Normalize distance scores (smaller is better)
-    max_distance = places_df["distance_to_bookmarked"].max()
-    places_df["proximity_score"] = 1 - (places_df["distance_to_bookmarked"] / max_distance)  # Scale to [0, 1]
+        # Normalize distance scores (smaller is better)
+        proximity_scores = 1 - distances / np.nanmax(distances)  # Scale to [0, 1]
 
-    # -------- Hybrid Scoring ------------
-    # Combine content-based and proximity scores
-    places_df["hybrid_score"] = (
-        weight_content * places_df["content_score"] +
-        weight_proximity * places_df["proximity_score"]
-    )
+    # ------- Places Visited Together ------------
+    # Users without trip or bookmark co-occurrences get a 0 here and keep the content and proximity ranking
+    with stage("recommend.hybrid.collaborative"):
+        collaborative_scores = cooccurrence.scores([user_id])[0] if cooccurrence is not None else np.zeros(len(places_df), dtype=np.float32)
 
-    # Exclude already bookmarked places
-    recommendations = places_df[~places_df["places_id"].isin(bookmarked_places)]
-    
-    # Sort by hybrid score
-    recommendations = recommendations.sort_values(by="hybrid_score", ascending=False)
+    # -------- Hybrid Scoring ------------
+    with stage("recommend.hybrid.rank"):
+        # Combine content-based, proximity and collaborative scores
+        hybrid_scores = (
+            weight_content * content_scores +
+            weight_proximity * proximity_scores +
+            weight_collaborative * collaborative_scores
+        )
 
-    # Return top `n` recommendations
-    return recommendations.head(n)
+        # Top `n` recommendations without the already bookmarked places
+        rows, scores = top_n(hybrid_scores, n, exclude=bookmarked_rows)
+    return result_rows(
+        places_df, rows, content_score=content_scores[rows], distance_to_bookmarked=distances[rows],
+        proximity_score=proximity_scores[rows], collaborative_score=collaborative_scores[rows], hybrid_score=scores,
+    )
 
 def users_has_interactions(user_id):
-    interactions_df = update_dataframes()[2]
+    interactions_df = get_snapshot().derived("recommendation.interactions")
     if user_id not in interactions_df["user_id"].values:
         return False
     return True
 
 def recommend_places(user_id, n=5, method="hybrid"):
-    places_df, bookmarks_df, interactions_df, cosine_sim = update_dataframes()
+    # random recommendations should differ on every call, so they are never cached
+    if method == "random":
+        return compute_recommendations(user_id=user_id, n=n, method=method)
+    cache = get_result_cache()
+    # read before computing, a result computed while a newer snapshot is published counts as the older one's
+    snapshot_time = get_snapshot().created_at
+    recommendations = cache.get((user_id, method, n))
+    if recommendations is None:
+        recommendations = compute_recommendations(user_id=user_id, n=n, method=method)
+        cache.set((user_id, method, n), recommendations, snapshot_time)
+    return recommendations
+
+def compute_recommendations(user_id, n=5, method="hybrid"):
+    places_df, bookmarks_df, interactions_df, similarity, spatial_index, cooccurrence, embeddings, catalog = update_dataframes()
     if method == "content_based":
-        return recommend_places_content_based(user_id=user_id, n=n, places_df=places_df, bookmarks_df=bookmarks_df, cosine_sim=cosine_sim)
+        return recommend_places_content_based(user_id=user_id, n=n, places_df=places_df, bookmarks_df=bookmarks_df, similarity=similarity, catalog=catalog)
     elif method == "near_bookmarks":
-        return recommend_places_near_bookmarks(user_id=user_id, n=n, places_df=places_df, bookmarks_df=bookmarks_df)
+        return recommend_places_near_bookmarks(user_id=user_id, n=n, places_df=places_df, bookmarks_df=bookmarks_df, spatial_index=spatial_index, catalog=catalog)
+    elif method == "collaborative":
+        return recommend_places_collaborative(user_id=user_id, n=n, places_df=places_df, cooccurrence=cooccurrence)
+    elif method == "semantic":
+        return recommend_places_semantic(user_id=user_id, n=n, places_df=places_df, bookmarks_df=bookmarks_df, embeddings=embeddings, catalog=catalog)
     elif method == "random":
-        return places_df.sample(n=n)
+        with stage("recommend.random"):
+            return result_rows(places_df, np.random.choice(len(places_df), size=min(n, len(places_df)), replace=False))
     else:
-        return recommend_places_hybrid(user_id=user_id, n=n, places_df=places_df, bookmarks_df=bookmarks_df, cosine_sim=cosine_sim)
+        return recommend_places_hybrid(user_id=user_id, n=n, places_df=places_df, bookmarks_df=bookmarks_df, similarity=similarity, catalog=catalog, cooccurrence=cooccurrence)
+
+
+# columns holding each method's score in the recommendations
+SCORE_COLUMNS = {"content_based": "score", "near_bookmarks": "distance_to_bookmarked", "hybrid": "hybrid_score", "collaborative": "collaborative_score", "semantic": "semantic_score"}
+
+def recommendations_from_ids(places_df, catalog, place_ids, scores, method):
+    # rebuild a recommendations dataframe from scored place ids, skipping places deleted since
+    found = [(catalog.row_of[place_id], score) for place_id, score in zip(place_ids, scores) if place_id in catalog.row_of]
+    recommendations = places_df.iloc[[row for row, score in found]].copy()
+    recommendations[SCORE_COLUMNS[method]] = [score for row, score in found]
+    return recommendations
+
+def stored_recommendations(user_id, n=5, method="hybrid"):
+    # recommendations precomputed by the batch job, None when there are none or they are stale
+    if method not in SCORE_COLUMNS:
+        return None
+    stored = get_result_store().get(user_id, method, n)
+    if stored is None:
+        LOOKUPS.inc(cache="result_store", result="miss")
+        return None
+    LOOKUPS.inc(cache="result_store", result="hit")
+    snapshot = get_snapshot()
+    return recommendations_from_ids(snapshot.places, snapshot.derived("place_catalog"), stored[0], stored[1], method)
 
+def recommend_places_batch(user_ids, n=5, method="hybrid"):
+    # {user_id: recommendations} for many users, served from the result store when possible
+    results = {}
+    missing = []
+    for user_id in user_ids:
+        stored = stored_recommendations(user_id, n=n, method=method)
+        if stored is None:
+            missing.append(user_id)
+        else:
+            results[user_id] = stored
+    if missing and method not in BATCH_METHODS:
+        # methods without a matrix form are answered one user at a time
+        for user_id in missing:
+            results[user_id] = recommend_places(user_id=user_id, n=n, method=method)
+    elif missing:
+        snapshot = get_snapshot()
+        catalog = snapshot.derived("place_catalog")
+        # score every missing user in one matrix product
+        for user_id, (place_ids, scores) in score_users(snapshot, missing, method=method, n=n, workers=1).items():
+            results[user_id] = recommendations_from_ids(snapshot.places, catalog, place_ids, scores, method)
+    return results
@@ -0,0 +1,70 @@
+# bounded thread pool that runs the cpu bound part of requests off the event loop
+import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+# request traces, rejection counters and the sampling profiler
+from app.metrics import REJECTED, profiled
+
+WORKERS = int(os.environ.get("BENA_REQUEST_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))
+# requests running or waiting for a worker, more than this are turned away with 503
+MAX_PENDING = int(os.environ.get("BENA_MAX_PENDING_REQUESTS", str(WORKERS * 4)))
+# seconds each endpoint may take before it answers 504, None waits for the work to end
+TIMEOUTS = {
+    "recommend": 10.0,
+    "recommend_batch": 30.0,
+    "search": 3.0,
+    "semantic_search": 3.0,
+    "autocomplete": 1.0,
+    "near": 2.0,
+    "similar": 2.0,
+    # a write keeps running after a 504, so a client retrying it would race the first attempt
+    "trips_bulk": None,
+    "auto_trip": 2.0,
+}
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="request")
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+def in_flight():
+    # requests running or waiting for a worker right now
+    return _pending
+
+
+def _acquire():
+    global _pending
+    with _pending_lock:
+        if _pending >= MAX_PENDING:
+            return False
+        _pending += 1
+        return True
+
+
+def _release(_=None):
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+
+async def run_in_executor(endpoint, function, *args, **kwargs):
+    # run function(*args, **kwargs) on the pool within the endpoint's timeout
+    if not _acquire():
+        REJECTED.inc(endpoint=endpoint, reason="busy")
+        raise HTTPException(status_code=503, detail="Server is busy, try again later.")
+    try:
+        # the worker thread sees the request's trace through a copy of its context
+        future = _executor.submit(contextvars.copy_context().run, profiled, function, *args, **kwargs)
+    except BaseException:
+        _release()
+        raise
+    # the slot is given back when the work really ends, not when the client stops waiting
+    future.add_done_callback(_release)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), TIMEOUTS[endpoint])
+    except asyncio.TimeoutError:
+        REJECTED.inc(endpoint=endpoint, reason="timeout")
+        raise HTTPException(status_code=504, detail=f"Request took longer than {TIMEOUTS[endpoint]:g}s.")
@@ -0,0 +1,147 @@
+# compact JSON responses: field projection straight from the numpy columns, a fast encoder when one is installed,
+# gzip/brotli compression and ETags so repeated identical queries are answered with 304
+import os
+import json
+import math
+import gzip
+import hashlib
+import numpy as np
+from starlette.responses import Response
+# stage timers
+from app.metrics import stage, timed
+
+# orjson encodes several times faster than the standard library, brotli compresses text tighter than gzip,
+# both are optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# every column is sent when a request names no fields, as before projection existed. ?fields=compact sends
+# these place columns and the endpoint's own score columns, the ones the mobile client reads
+PLACE_FIELDS = [field.strip() for field in os.environ.get(
+    "BENA_COMPACT_FIELDS",
+    "places_id,name,arabic_name,address,city,tags,description,image,rating,latitude,longitude",
+).split(",") if field.strip()]
+ALL_FIELDS = "*"
+COMPACT_FIELDS = "compact"
+# bodies smaller than this are sent as they are, compressing them costs more than it saves
+MIN_COMPRESS_SIZE = int(os.environ.get("BENA_MIN_COMPRESS_SIZE", "1024"))
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def parse_fields(fields):
+    # "name, tags" -> ["name", "tags"], ALL_FIELDS for every column, COMPACT_FIELDS for the compact schema
+    if fields is None or not fields.strip() or fields.strip() == ALL_FIELDS:
+        return ALL_FIELDS
+    if fields.strip() == COMPACT_FIELDS:
+        return COMPACT_FIELDS
+    return list(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+
+
+def project(frame, fields=None, extra=()):
+    # the columns of frame to send, fields the result does not have are skipped
+    fields = parse_fields(fields)
+    if fields == ALL_FIELDS:
+        return list(frame.columns)
+    if fields == COMPACT_FIELDS:
+        fields = PLACE_FIELDS + [column for column in extra if column not in PLACE_FIELDS]
+    return [column for column in fields if column in frame]
+
+
+@timed("serialize")
+def records(frame, fields=None, extra=()):
+    # row dicts built column by column from numpy instead of row by row, missing values (NaN != NaN) become None
+    columns = project(frame, fields, extra)
+    values = [[None if value != value else value for value in frame[column].tolist()] for column in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def _default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def _finite(value):
+    # inf and NaN become null as orjson writes them, the standard library would write invalid JSON or raise
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _finite(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite(item) for item in value]
+    if isinstance(value, (np.generic, np.ndarray)):
+        return _finite(_default(value))
+    return value
+
+
+def dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(_finite(payload), default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def etag_of(body):
+    # weak, the same payload matches whatever encoding it was sent with
+    return 'W/"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in tags]
+
+
+def choose_encoding(accept_encoding, size):
+    # br when brotli is installed and the client takes it, then gzip, None for small bodies
+    if size < MIN_COMPRESS_SIZE or not accept_encoding:
+        return None
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def respond(headers, function, *args, **kwargs):
+    # run an endpoint's function and encode its payload for the request headers, on the request pool
+    # so neither the encoding nor the compression runs on the event loop
+    payload = function(*args, **kwargs)
+    with stage("encode"):
+        body = dumps(payload)
+    etag = etag_of(body)
+    response_headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+    if etag_matches(headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=response_headers)
+    encoding = choose_encoding(headers.get("accept-encoding"), len(body))
+    if encoding is not None:
+        with stage("compress"):
+            body = compress(body, encoding)
+        response_headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=response_headers)
@@ -0,0 +1,273 @@
+# per-user recommendation result cache invalidated by snapshot changes
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+# shared data snapshots
+from app.data_snapshot import DATA_DIR, get_store
+
+MAX_ENTRIES = int(os.environ.get("BENA_RESULT_CACHE_SIZE", "10000"))
+MAX_BYTES = int(os.environ.get("BENA_RESULT_CACHE_BYTES", str(64 * 1024 * 1024)))
+TTL = float(os.environ.get("BENA_RESULT_CACHE_TTL", "300"))
+# "memory" keeps entries per process, "sqlite" shares them between the uvicorn workers on the host
+BACKEND = os.environ.get("BENA_RESULT_CACHE_BACKEND", "memory")
+SQLITE_PATH = os.path.join(DATA_DIR, "result_cache.sqlite")
+# user id of the invalidation marker of a full clear
+CLEARED = "*"
+
+
+def changed_users(snapshot, previous):
+    # users whose bookmarks, interactions or trips changed since `previous`
+    users = snapshot.changed_values("bookmarks", "user_id", previous)
+    users |= snapshot.changed_values("interactions", "user_id", previous)
+    users |= snapshot.changed_values("trips", "user_id", previous)
+    trip_ids = snapshot.changed_values("tripstep", "trip_id", previous)
+    trips = snapshot.trips
+    if trip_ids and "trip_id" in trips and "user_id" in trips:
+        users |= set(trips.loc[trips["trip_id"].isin(trip_ids), "user_id"].dropna())
+    return users
+
+
+def entry_size(value):
+    # approximate bytes held by a cached dataframe
+    try:
+        return int(value.memory_usage(index=True, deep=True).sum())
+    except AttributeError:
+        return len(pickle.dumps(value))
+
+
+class MemoryBackend:
+    # LRU ordered dict bounded by entries and bytes
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # snapshot time of the latest invalidation per user, and of the latest clear
+        self.invalidated = {}
+        self.cleared_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, size, expires):
+        # returns how many entries were evicted to make room
+        evicted = 0
+        with self._lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size, expires)
+            self.bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+                evicted += 1
+        return evicted
+
+    def delete(self, key):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def delete_users(self, user_ids, at):
+        with self._lock:
+            keys = [key for key in self.entries if key[0] in user_ids]
+            for key in keys:
+                self.bytes -= self.entries.pop(key)[1]
+            for user_id in user_ids:
+                self.invalidated[user_id] = max(self.invalidated.get(user_id, at), at)
+        return len(keys)
+
+    def clear(self, at):
+        with self._lock:
+            count = len(self.entries)
+            self.entries.clear()
+            self.bytes = 0
+            self.cleared_at = max(self.cleared_at, at)
+            self.invalidated = {user_id: time for user_id, time in self.invalidated.items() if time > self.cleared_at}
+        return count
+
+    def invalidated_at(self, user_id):
+        return max(self.cleared_at, self.invalidated.get(user_id, float("-inf")))
+
+    def size(self):
+        return len(self.entries), self.bytes
+
+
+class SqliteBackend:
+    # the same LRU bounds over a sqlite file every worker process opens
+    def __init__(self, path=SQLITE_PATH, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS result_cache ("
+                "key TEXT PRIMARY KEY, user_id TEXT, value BLOB, size INTEGER, expires REAL, used REAL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS result_cache_user ON result_cache (user_id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS result_cache_used ON result_cache (used)")
+            # every worker's invalidations, CLEARED stands for all users
+            connection.execute("CREATE TABLE IF NOT EXISTS result_cache_invalidations (user_id TEXT PRIMARY KEY, at REAL)")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        with self._connection() as connection:
+            row = connection.execute("SELECT value, size, expires FROM result_cache WHERE key = ?", (repr(key),)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE result_cache SET used = ? WHERE key = ?", (time.time(), repr(key)))
+        return pickle.loads(row[0]), row[1], row[2]
+
+    def set(self, key, value, size, expires):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (repr(key), key[0], pickle.dumps(value), size, expires, time.time()),
+            )
+            count, total = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache").fetchone()
+            evicted = 0
+            # drop the least recently used entries until both bounds hold
+            while count > self.max_entries or total > self.max_bytes:
+                row = connection.execute("SELECT key, size FROM result_cache ORDER BY used LIMIT 1").fetchone()
+                if row is None:
+                    break
+                connection.execute("DELETE FROM result_cache WHERE key = ?", (row[0],))
+                count, total, evicted = count - 1, total - row[1], evicted + 1
+        return evicted
+
+    def delete(self, key):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM result_cache WHERE key = ?", (repr(key),))
+
+    def delete_users(self, user_ids, at):
+        with self._connection() as connection:
+            cursor = connection.executemany("DELETE FROM result_cache WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+            self._mark(connection, user_ids, at)
+        return cursor.rowcount
+
+    def clear(self, at):
+        with self._connection() as connection:
+            count = connection.execute("DELETE FROM result_cache").rowcount
+            connection.execute("DELETE FROM result_cache_invalidations WHERE at <= ?", (at,))
+            self._mark(connection, [CLEARED], at)
+        return count
+
+    def _mark(self, connection, user_ids, at):
+        connection.executemany(
+            "INSERT INTO result_cache_invalidations VALUES (?, ?) ON CONFLICT (user_id) DO UPDATE SET at = MAX(at, excluded.at)",
+            [(user_id, at) for user_id in user_ids],
+        )
+
+    def invalidated_at(self, user_id):
+        row = self._connection().execute(
+            "SELECT MAX(at) FROM result_cache_invalidations WHERE user_id IN (?, ?)", (user_id, CLEARED),
+        ).fetchone()
+        return row[0] if row[0] is not None else float("-inf")
+
+    def size(self):
+        return self._connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache").fetchone()
+
+
+class ResultCache:
+    # keys are (user_id, method, length), values are treated as immutable. Values are stored with the creation
+    # time of the snapshot they were computed from, and invalidations with the creation time of the snapshot
+    # that caused them: a value computed before its user's latest invalidation is stale even when it was set
+    # after it, by a request that was still running on the older snapshot or by a worker that is behind.
+    # Version numbers are per process, creation times compare across the workers sharing the sqlite backend
+    def __init__(self, backend=None, ttl=TTL):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        stored, size, expires = entry
+        # entries of a sqlite file written before snapshot times were stored count as stale
+        computed_at, value = stored if isinstance(stored, tuple) else (float("-inf"), stored)
+        if expires < time.time():
+            self.backend.delete(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        if computed_at < self.backend.invalidated_at(key[0]):
+            self.backend.delete(key)
+            self.stale += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, value, snapshot_time):
+        # snapshot_time: creation time of the snapshot the value was computed from
+        self.evictions += self.backend.set(key, (snapshot_time, value), entry_size(value), time.time() + self.ttl)
+
+    def invalidate_users(self, user_ids, at=None):
+        if user_ids:
+            self.invalidations += self.backend.delete_users(set(user_ids), time.time() if at is None else at)
+
+    def clear(self, at=None):
+        self.invalidations += self.backend.clear(time.time() if at is None else at)
+
+    def on_snapshot(self, snapshot, previous):
+        # new places change everyone's scores, bookmarks, interactions and trips only their owners'
+        if previous is None or snapshot.changes is None or snapshot.changed("places"):
+            self.clear(snapshot.created_at)
+            return
+        self.invalidate_users(changed_users(snapshot, previous), snapshot.created_at)
+
+    def stats(self):
+        entries, size = self.backend.size()
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "stale": self.stale,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    # the process wide cache, subscribed to the snapshot store on creation
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                backend = SqliteBackend() if BACKEND == "sqlite" else MemoryBackend()
+                cache = ResultCache(backend)
+                get_store().add_listener(cache.on_snapshot)
+                _cache = cache
+    return _cache
@@ -0,0 +1,157 @@
+# trigram search index over place names, tags and addresses
+import re
+import time
+import numpy as np
+# search similarities libraries
+from fuzzywuzzy import fuzz
+# shared data snapshots
+from app.data_snapshot import register_derived
+
+# fields searched, in the order they are joined
+SEARCH_FIELDS = ["name", "tags", "arabic_name", "address"]
+NGRAM = 3
+# documents scored with fuzz.partial_ratio per query
+CANDIDATES = 300
+# rebuild from scratch once this share of documents is stale
+MAX_STALE_SHARE = 0.2
+
+ARABIC_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+ARABIC_LETTERS = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه",
+})
+SPACES = re.compile(r"\s+")
+
+
+def normalize(text):
+    # lower case, strip arabic diacritics and tatweel, unify alef/ya/ta marbuta spellings
+    text = ARABIC_DIACRITICS.sub("", str(text).lower())
+    return SPACES.sub(" ", text.translate(ARABIC_LETTERS)).strip()
+
+
+def ngrams(text, size=NGRAM):
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def search_text(places_df):
+    # one normalized search string per place
+    fields = [places_df[field].fillna("").astype(str) if field in places_df else "" for field in SEARCH_FIELDS]
+    joined = fields[0]
+    for field in fields[1:]:
+        joined = joined + " " + field
+    return [normalize(text) for text in joined]
+
+
+class SearchIndex:
+    # documents are numbered in insertion order, `rows` maps them to the snapshot places frame (-1 when stale)
+    def __init__(self, ids, texts, rows, postings, build_seconds):
+        self.ids = ids
+        self.texts = texts
+        self.rows = rows
+        self.postings = postings
+        self.build_seconds = build_seconds
+
+    @classmethod
+    def build(cls, ids, texts):
+        start = time.perf_counter()
+        postings = {}
+        for doc, text in enumerate(texts):
+            for gram in ngrams(text):
+                postings.setdefault(gram, []).append(doc)
+        postings = {gram: np.array(docs, dtype=np.int32) for gram, docs in postings.items()}
+        return cls(list(ids), list(texts), np.arange(len(ids)), postings, time.perf_counter() - start)
+
+    def update(self, ids, texts, changed):
+        # a new index for the next snapshot, only the changed places are (re)indexed
+        start = time.perf_counter()
+        row_of = {place_id: row for row, place_id in enumerate(ids)}
+        doc_ids = list(self.ids)
+        doc_texts = list(self.texts)
+        # documents of changed places go stale, their new text is appended as a new document
+        rows = np.array([
+            -1 if stale < 0 or place_id in changed else row_of.get(place_id, -1)
+            for place_id, stale in zip(self.ids, self.rows)
+        ], dtype=int)
+        postings = dict(self.postings)
+        added = {}
+        added_rows = []
+        for place_id in changed:
+            row = row_of.get(place_id)
+            if row is None:
+                continue
+            doc = len(doc_ids)
+            doc_ids.append(place_id)
+            doc_texts.append(texts[row])
+            added_rows.append(row)
+            for gram in ngrams(texts[row]):
+                added.setdefault(gram, []).append(doc)
+        rows = np.concatenate([rows, np.array(added_rows, dtype=int)])
+        if (rows < 0).sum() > MAX_STALE_SHARE * len(rows):
+            return None
+        for gram, docs in added.items():
+            previous = postings.get(gram)
+            docs = np.array(docs, dtype=np.int32)
+            postings[gram] = docs if previous is None else np.concatenate([previous, docs])
+        return SearchIndex(doc_ids, doc_texts, rows, postings, self.build_seconds + time.perf_counter() - start)
+
+    def candidates(self, query, limit=CANDIDATES):
+        # documents sharing the most n-grams with the query, best first
+        grams = [self.postings[gram] for gram in ngrams(query) if gram in self.postings]
+        if not grams:
+            return np.zeros(0, dtype=np.int32)
+        counts = np.bincount(np.concatenate(grams), minlength=len(self.ids))
+        counts[self.rows < 0] = 0
+        hits = np.flatnonzero(counts)
+        if len(hits) > limit:
+            hits = hits[np.argpartition(counts[hits], -limit)[-limit:]]
+        return hits[np.argsort(-counts[hits], kind="stable")]
+
+    def search(self, query, n=10, min_score=50, limit=CANDIDATES):
+        # (rows, scores) of the best fuzzy matches, scored only on the n-gram shortlist
+        query = normalize(query)
+        if len(query) < NGRAM:
+            # too short for n-grams, score every live document
+            docs = np.flatnonzero(self.rows >= 0)
+        else:
+            docs = self.candidates(query, limit)
+        scores = np.array([fuzz.partial_ratio(query, self.texts[doc]) for doc in docs], dtype=int)
+        keep = scores >= min_score
+        docs, scores = docs[keep], scores[keep]
+        order = np.lexsort((self.rows[docs], -scores))[:n]
+        return self.rows[docs[order]], scores[order]
+
+    def stats(self):
+        live = int((self.rows >= 0).sum())
+        return {
+            "places": live,
+            "stale_documents": len(self.rows) - live,
+            "ngrams": len(self.postings),
+            "postings": int(sum(len(docs) for docs in self.postings.values())),
+            "build_seconds": round(self.build_seconds, 4),
+        }
+
+
+# -------------------
+# Snapshot integration
+# -------------------
+
+def build_search_index(snapshot):
+    places_df = snapshot.places
+    return SearchIndex.build(places_df["places_id"].tolist(), search_text(places_df))
+
+
+def update_search_index(index, snapshot):
+    changed = snapshot.changed("places")
+    if not changed:
+        return index
+    places_df = snapshot.places
+    ids = places_df["places_id"].tolist()
+    # only the changed places need their text normalized again
+    changed_rows = places_df["places_id"].isin(changed).to_numpy()
+    texts = [None] * len(ids)
+    for row, text in zip(np.flatnonzero(changed_rows), search_text(places_df[changed_rows])):
+        texts[row] = text
+    return index.update(ids, texts, changed)
+
+
+register_derived("search_index", build_search_index, update_search_index)
@@ -1,103 +1,134 @@
 # create auto categorization model and its auto generated Trips
-from dotenv import load_dotenv
-
-load_dotenv()
-
 import re
 import os
 import numpy as np 
 import pandas as pd 
-from supabase import create_client, Client
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.neighbors import NearestNeighbors
-# search similarities libraries
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
-
-# initialize supabase connection
-url: str = os.environ.get("SUPABASE_URL")
-key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
-
-# fetch places data from database into dataframe
-table_name = "places"
-response = supabase.table(table_name).select("*").execute()
-data = response.data
-places_df = pd.DataFrame(data)
-
-# refetch bookmarks data from database into dataframe
-def update_dataframes():
-    # fetch places data from database into dataframe
-    table_name = "places"
-    response = supabase.table(table_name).select("*").execute()
-    data = response.data
-    places_df = pd.DataFrame(data)
-
-
-def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371  # Radius of Earth in kilometers
-    lat1, lat2, lon1, lon2 = map(np.radians, [lat1, lat2, lon1, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    return R * c
-
+# shared data snapshots
+from app.data_snapshot import get_snapshot
+# vectorized distances
+from app.geo import coordinates
+# prefix search for typeahead
+from app.autocomplete import AutocompleteIndex
+# n-gram fuzzy search index
+from app.search_index import SearchIndex
+# spatial index over place coordinates
+from app.spatial_index import SpatialIndex
+# compact place columns and the id -> row map
+from app.place_catalog import PlaceCatalog
+# hashed text embeddings with an approximate nearest-neighbour index
+from app.embedding_index import EmbeddingIndex, embed_query
+# precomputed nearest and most similar places of every place
+from app.neighbour_tables import NeighbourTables
+# stage timers
+from app.metrics import timed
+
+@timed("search.near")
 def find_places_near_place_id(place_id, radius=5, n=5):
-    update_dataframes()
+    snapshot = get_snapshot()
+    places_df = snapshot.places
     if places_df.empty:
         print("Places dataframe is empty.")
         return pd.DataFrame()
-    # Get the coordinates of the given place_id
-    place = places_df[places_df["places_id"] == place_id]
+    # Get the row of the given place_id from the id -> row map instead of scanning places_df
+    catalog: PlaceCatalog = snapshot.derived("place_catalog")
+    row = catalog.row(place_id)
     
-    if place.empty:
+    if row is None:
         print(f"No place found with place_id {place_id}.")
         return pd.DataFrame()  # Return an empty DataFrame if the place_id does not exist
     
-    lat, lon = place.iloc[0]["latitude"], place.iloc[0]["longitude"]
+    lat, lon = coordinates(places_df.iloc[[row]])
+    if np.isnan(lat[0]) or np.isnan(lon[0]):
+        print(f"No coordinates found for place_id {place_id}.")
+        return pd.DataFrame()
+
+    # Look the places up in the precomputed table when it covers the radius and length
+    tables: NeighbourTables = snapshot.derived("neighbour_tables")
+    found = tables.near(row, radius, n)
+    if found is not None:
+        rows, distances = found
+    else:
+        # Places within the specified radius, closest first, from the spatial index
+        spatial_index: SpatialIndex = snapshot.derived("spatial_index")
+        rows, distances = spatial_index.query_radius(lat[0], lon[0], radius)
+
+        # Exclude the given place_id itself from the results and keep the top n places
+        keep = rows != row
+        rows, distances = rows[keep][:n], distances[keep][:n]
+
+    nearby_places = places_df.iloc[rows].copy()
+    nearby_places["distance_from_place"] = distances
+    
+    return nearby_places
 
-    # Calculate the distance of all places from the given place_id
-    places_df["distance_from_place"] = places_df.apply(
-        lambda row: haversine_distance(lat, lon, row["latitude"], row["longitude"]),
-        axis=1
-    )
+@timed("search.similar")
+def find_similar_places(place_id, n=5):
+    snapshot = get_snapshot()
+    places_df = snapshot.places
+    if places_df.empty:
+        print("Places dataframe is empty.")
+        return pd.DataFrame()
+    catalog: PlaceCatalog = snapshot.derived("place_catalog")
+    row = catalog.row(place_id)
 
-    # Filter places within the specified radius
-    nearby_places = places_df[places_df["distance_from_place"] <= radius].copy()
+    if row is None:
+        print(f"No place found with place_id {place_id}.")
+        return pd.DataFrame()
 
-    # Exclude the given place_id itself from the results
-    nearby_places = nearby_places[nearby_places["places_id"] != place_id]
+    # Places sharing the most tags with it, precomputed for every place
+    tables: NeighbourTables = snapshot.derived("neighbour_tables")
+    rows, scores = tables.similar(row, n)
 
-    # Sort by distance and return the top n places
-    nearby_places = nearby_places.sort_values("distance_from_place").head(n)
-    
-    return nearby_places
+    similar_places = places_df.iloc[rows].copy()
+    similar_places["similarity_score"] = scores
+    return similar_places
 
+@timed("search.smart")
 def smart_search(query, n=10, min_score=50):
+    snapshot = get_snapshot()
+    places_df = snapshot.places
     if places_df.empty:
         print("Places dataframe is empty.")
         return pd.DataFrame()
     
-    # Preprocessing: Combine 'name' and 'tags' columns for searching
-    places_df["search_field"] = (
-        places_df["name"].fillna("") + " " + 
-        places_df["tags"].fillna("") +
-        places_df["arabic_name"].fillna("") +
-        places_df["address"].fillna("")
-    )
-
-    # Calculate similarity scores
-    places_df["similarity_score"] = places_df["search_field"].apply(
-        lambda text: fuzz.partial_ratio(query.lower(), text.lower())
-    )
-
-    # Filter results by minimum score
-    results = places_df[places_df["similarity_score"] >= min_score]
-
-    # Sort by similarity score and return top n results
-    results = results.sort_values(by="similarity_score", ascending=False).head(n)
-    
-    # Drop intermediate columns before returning
-    return results.drop(columns=["search_field", "similarity_score"])
\ No newline at end of file
+    # Fuzzy match name, tags, arabic name and address, scoring only the n-gram candidates
+    search_index: SearchIndex = snapshot.derived("search_index")
+    rows, scores = search_index.search(query, n=n, min_score=min_score)
+
+    # Results are already filtered by minimum score and sorted by similarity score
+    return places_df.iloc[rows]
+
+@timed("search.semantic")
+def semantic_search(query, n=10):
+    snapshot = get_snapshot()
+    places_df = snapshot.places
+    if places_df.empty:
+        print("Places dataframe is empty.")
+        return pd.DataFrame()
+
+    # Nearest places to the query's embedding, also finding spellings the n-gram search misses
+    embeddings: EmbeddingIndex = snapshot.derived("embedding_index")
+    rows, scores = embeddings.search(embed_query(query), k=n)
+
+    results = places_df.iloc[rows].copy()
+    results["semantic_score"] = scores
+    return results
+
+@timed("search.autocomplete")
+def autocomplete_places(prefix, n=8):
+    snapshot = get_snapshot()
+    places_df = snapshot.places
+    if places_df.empty:
+        print("Places dataframe is empty.")
+        return pd.DataFrame()
+
+    # Places with a name, arabic name or tag starting with the prefix, most popular first
+    autocomplete: AutocompleteIndex = snapshot.derived("autocomplete")
+    popularity = snapshot.derived("place_popularity")
+    rows = autocomplete.complete(prefix, popularity, n=n)
+
+    suggestions = places_df.iloc[rows][[column for column in ["places_id", "name", "arabic_name", "tags"] if column in places_df]].copy()
+    suggestions["popularity"] = popularity[rows]
+    return suggestions
@@ -0,0 +1,275 @@
+# sparse top-K place similarity index over TF-IDF tag vectors
+import os
+import time
+import uuid
+import hashlib
+import joblib
+import numpy as np
+import scipy.sparse as sp
+from sklearn.base import clone
+from sklearn.feature_extraction.text import TfidfVectorizer
+# shared data snapshots
+from app.data_snapshot import DATA_DIR, register_derived
+
+# neighbours kept per place
+TOP_K = int(os.environ.get("BENA_SIMILARITY_TOP_K", "50"))
+# rows scored per block while building, bounds the dense scratch memory to CHUNK_SIZE x places
+CHUNK_SIZE = 256
+# above this share of changed places a full rebuild is cheaper than patching
+MAX_INCREMENTAL_SHARE = 0.1
+# seconds between saves of patched indexes, pickling one costs more than a small patch
+SAVE_INTERVAL = float(os.environ.get("BENA_SIMILARITY_SAVE_INTERVAL", "300"))
+
+
+def fingerprint(ids, tags):
+    # identifies the exact places and tags an index was built from
+    digest = hashlib.sha1()
+    for place_id, tag in zip(ids, tags):
+        digest.update(f"{place_id}\x1f{tag}\x1e".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def top_k_rows(tag_matrix, rows, k):
+    # cosine similarity of the given rows against all places, keeping the best k per row
+    data, indices, indptr = [], [], [0]
+    for start in range(0, len(rows), CHUNK_SIZE):
+        block = rows[start:start + CHUNK_SIZE]
+        sims = (tag_matrix[block] @ tag_matrix.T).toarray().astype(np.float32)
+        for row_sims in sims:
+            nonzero = np.flatnonzero(row_sims > 0)
+            if len(nonzero) > k:
+                nonzero = nonzero[np.argpartition(row_sims[nonzero], -k)[-k:]]
+            nonzero.sort()
+            data.append(row_sims[nonzero])
+            indices.append(nonzero)
+            indptr.append(indptr[-1] + len(nonzero))
+    if not data:
+        return [], [], [0]
+    return data, indices, indptr
+
+
+class SimilarityIndex:
+    # keeps only the top-K most similar places per place as a CSR matrix aligned with `ids`
+    def __init__(self, ids, tags, vectorizer, tag_matrix, matrix, k, build_seconds, fit_id=None):
+        self.ids = np.asarray(ids, dtype=object)
+        self.tags = list(tags)
+        self.vectorizer = vectorizer
+        # identifies the fitted weights, patched indexes keep it as long as the scores of unchanged places hold
+        self.fit_id = fit_id or uuid.uuid4().hex
+        self.tag_matrix = tag_matrix
+        self.matrix = matrix
+        self.k = k
+        self.build_seconds = build_seconds
+        self.row_of = {place_id: row for row, place_id in enumerate(self.ids)}
+        self.fingerprint = fingerprint(self.ids, self.tags)
+
+    @classmethod
+    def build(cls, ids, tags, k=TOP_K):
+        start = time.perf_counter()
+        tags = list(tags)
+        # Create a TF-IDF vectorizer for tags
+        vectorizer = TfidfVectorizer(stop_words="english", dtype=np.float32)
+        try:
+            tag_matrix = vectorizer.fit_transform(tags).tocsr()
+        except ValueError:
+            # every tag is empty or a stop word, nothing is similar to anything
+            vectorizer = None
+            tag_matrix = sp.csr_matrix((len(tags), 0), dtype=np.float32)
+        data, indices, indptr = top_k_rows(tag_matrix, np.arange(len(tags)), k)
+        matrix = cls._assemble(data, indices, indptr, len(tags))
+        return cls(ids, tags, vectorizer, tag_matrix, matrix, k, time.perf_counter() - start)
+
+    def update(self, ids, tags):
+        # patch the index for a new list of places, returns None when a full build is needed
+        start = time.perf_counter()
+        ids = np.asarray(ids, dtype=object)
+        tags = list(tags)
+        if self.vectorizer is None:
+            return None
+        old_tags = {place_id: self.tags[row] for place_id, row in self.row_of.items()}
+        changed = [row for row, (place_id, tag) in enumerate(zip(ids, tags)) if old_tags.get(place_id) != tag]
+        removed = set(self.row_of) - set(ids)
+        if len(changed) + len(removed) > MAX_INCREMENTAL_SHARE * max(len(ids), 1):
+            return None
+        # words no place had before get new columns, the known words keep their weights
+        analyzer = self.vectorizer.build_analyzer()
+        words = {row: set(analyzer(tags[row])) for row in changed}
+        new_words = sorted(set().union(*words.values()) - self.vectorizer.vocabulary_.keys())
+        vectorizer = self._extend(new_words, words.values(), len(ids)) if new_words else self.vectorizer
+
+        # reuse the vectors of unchanged places, transform only the changed ones
+        old_rows = np.array([self.row_of.get(place_id, -1) for place_id in ids])
+        changed_mask = np.zeros(len(ids), dtype=bool)
+        changed_mask[changed] = True
+        reuse = np.flatnonzero(~changed_mask)
+        reused = self.tag_matrix[old_rows[reuse]]
+        reused.resize((len(reuse), len(vectorizer.vocabulary_)))
+        blocks = [reused]
+        if changed:
+            blocks.append(vectorizer.transform([tags[row] for row in changed]).astype(np.float32))
+        stacked = sp.vstack(blocks).tocsr()
+        order = np.concatenate([reuse, changed]).astype(int)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        tag_matrix = stacked[inverse]
+
+        # remap the old neighbour lists to the new row numbers, dropping removed and changed places
+        new_row_of_old = np.full(len(self.ids), -1)
+        new_row_of_old[old_rows[reuse]] = reuse
+        old = self.matrix.tocoo()
+        rows, cols = new_row_of_old[old.row], new_row_of_old[old.col]
+        keep = (rows >= 0) & (cols >= 0)
+        remapped = sp.csr_matrix((old.data[keep], (rows[keep], cols[keep])), shape=(len(ids), len(ids)))
+
+        # rows that lost a neighbour must be recomputed in full, as must the changed rows
+        lost = np.bincount(rows[(rows >= 0) & (cols < 0)], minlength=len(ids)) > 0
+        recompute = np.flatnonzero(lost | changed_mask)
+        data, indices, indptr = top_k_rows(tag_matrix, recompute, self.k)
+        recomputed = self._assemble(data, indices, indptr, len(ids), rows=recompute)
+
+        # every other row only has to consider the changed places as new candidates
+        others = np.flatnonzero(~(lost | changed_mask))
+        if changed and len(others):
+            candidates = (tag_matrix[others] @ tag_matrix[changed].T).tocoo()
+            candidates = sp.csr_matrix(
+                (candidates.data, (others[candidates.row], np.asarray(changed)[candidates.col])),
+                shape=(len(ids), len(ids)),
+            )
+            merged = remapped + candidates
+        else:
+            merged = remapped
+        merged = sp.diags((~(lost | changed_mask)).astype(np.float32)) @ merged
+        matrix = self._prune((merged + recomputed).tocsr(), self.k)
+        return SimilarityIndex(ids, tags, vectorizer, tag_matrix, matrix, self.k, time.perf_counter() - start, fit_id=self.fit_id)
+
+    def _extend(self, words, documents, size):
+        # a vectorizer with words appended to the fitted vocabulary, weighted with the smoothed idf a fit
+        # would give them, only the changed places can contain them
+        offset = len(self.vectorizer.vocabulary_)
+        vocabulary = {**self.vectorizer.vocabulary_, **{word: offset + i for i, word in enumerate(words)}}
+        vectorizer = clone(self.vectorizer).set_params(vocabulary=vocabulary)
+        counts = np.array([sum(word in document for document in documents) for word in words])
+        idf = np.log((1 + size) / (1 + counts)) + 1
+        vectorizer.idf_ = np.concatenate([self.vectorizer.idf_, idf]).astype(self.vectorizer.idf_.dtype)
+        return vectorizer
+
+    @staticmethod
+    def _assemble(data, indices, indptr, size, rows=None):
+        data = np.concatenate(data) if len(data) else np.zeros(0, dtype=np.float32)
+        indices = np.concatenate(indices) if len(indices) else np.zeros(0, dtype=np.int32)
+        if rows is None:
+            return sp.csr_matrix((data, indices, np.asarray(indptr)), shape=(size, size), dtype=np.float32)
+        # scatter the computed rows into a full size matrix
+        row_ids = np.repeat(rows, np.diff(indptr))
+        return sp.csr_matrix((data, (row_ids, indices)), shape=(size, size), dtype=np.float32)
+
+    @staticmethod
+    def _prune(matrix, k):
+        # keep the best k entries of every row, ranked within their rows all at once
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+        counts = np.diff(matrix.indptr)
+        if counts.max(initial=0) <= k:
+            return matrix
+        row_ids = np.repeat(np.arange(matrix.shape[0]), counts)
+        order = np.lexsort((-matrix.data, row_ids))
+        keep = np.zeros(matrix.nnz, dtype=bool)
+        keep[order[np.arange(matrix.nnz) - matrix.indptr[row_ids[order]] < k]] = True
+        indptr = np.zeros(matrix.shape[0] + 1, dtype=matrix.indptr.dtype)
+        np.cumsum(np.minimum(counts, k), out=indptr[1:])
+        return sp.csr_matrix((matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape)
+
+    def scores(self, place_ids):
+        # sum of the similarity rows of the given places, a dense score per place
+        rows = [self.row_of[place_id] for place_id in place_ids if place_id in self.row_of]
+        if not rows:
+            return np.zeros(len(self.ids), dtype=np.float32)
+        return np.asarray(self.matrix[rows].sum(axis=0)).ravel()
+
+    def neighbours(self, place_id):
+        # (place ids, similarities) of a place's top-K, best first
+        row = self.matrix.getrow(self.row_of[place_id])
+        order = np.argsort(-row.data)
+        return self.ids[row.indices[order]], row.data[order]
+
+    def stats(self):
+        nbytes = self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+        return {
+            "places": len(self.ids),
+            "k": self.k,
+            "nnz": int(self.matrix.nnz),
+            "bytes": int(nbytes),
+            "build_seconds": round(self.build_seconds, 4),
+        }
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # one temp file per process, every worker may save the same index at once
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        joblib.dump(self, temp_path)
+        # atomic swap so other workers never load a partial file
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path):
+        index = joblib.load(path)
+        # indexes saved before fit ids existed
+        index.__dict__.setdefault("fit_id", uuid.uuid4().hex)
+        return index
+
+
+# -------------------
+# Snapshot integration
+# -------------------
+
+INDEX_PATH = os.path.join(DATA_DIR, "similarity_index.joblib")
+# monotonic time of this process's last save, None until it saved once
+_saved_at = None
+
+
+def _place_tags(snapshot):
+    places_df = snapshot.places
+    return places_df["places_id"].tolist(), places_df["tags"].fillna("").tolist()
+
+
+def build_similarity_index(snapshot):
+    ids, tags = _place_tags(snapshot)
+    # reuse the persisted index when it was built from the same places
+    if os.path.exists(INDEX_PATH):
+        try:
+            index = SimilarityIndex.load(INDEX_PATH)
+            if index.fingerprint == fingerprint(ids, tags):
+                return index
+        except Exception as error:
+            print(f"Could not load similarity index: {error}")
+    index = SimilarityIndex.build(ids, tags)
+    _save(index)
+    return index
+
+
+def update_similarity_index(index, snapshot):
+    if not snapshot.changed("places"):
+        return index
+    ids, tags = _place_tags(snapshot)
+    index = index.update(ids, tags)
+    if index is not None and _save_due():
+        _save(index)
+    return index
+
+
+def _save_due():
+    # the first patch of a process is always saved, the file on disk predates it
+    return _saved_at is None or time.monotonic() - _saved_at >= SAVE_INTERVAL
+
+
+def _save(index):
+    # a failed save only costs the next worker a rebuild, the snapshot is still published
+    global _saved_at
+    try:
+        index.save(INDEX_PATH)
+        _saved_at = time.monotonic()
+    except OSError as error:
+        print(f"Could not save similarity index: {error}")
+
+
+register_derived("similarity_index", build_similarity_index, update_similarity_index)
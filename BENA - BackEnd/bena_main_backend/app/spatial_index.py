@@ -0,0 +1,212 @@
+# spatial index over place coordinates for radius and k-nearest queries
+import os
+import time
+import hashlib
+import joblib
+import numpy as np
+from sklearn.neighbors import BallTree
+# shared data snapshots
+from app.data_snapshot import DATA_DIR, register_derived
+# vectorized distances
+from app.geo import R, coordinates, distance_matrix
+
+# places added since the last tree build are scanned linearly until the buffer reaches this share of the tree
+MAX_DELTA_SHARE = 0.05
+MIN_DELTA_SIZE = 1000
+
+
+def fingerprint(ids, lat, lon):
+    digest = hashlib.sha1()
+    digest.update("\x1f".join(map(str, ids)).encode("utf-8"))
+    digest.update(np.asarray(lat, dtype=np.float32).tobytes())
+    digest.update(np.asarray(lon, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+class SpatialIndex:
+    # a haversine BallTree over the places known at build time, plus a small buffer of later additions
+    # query results are (rows, distances in km) where rows are positions in the snapshot places frame
+    def __init__(self, tree, ids, lat, lon, rows, delta_ids, delta_lat, delta_lon, delta_rows, removed, build_seconds, fingerprint=None):
+        self.tree = tree
+        self.ids, self.lat, self.lon, self.rows = ids, lat, lon, rows
+        self.delta_ids, self.delta_lat, self.delta_lon, self.delta_rows = delta_ids, delta_lat, delta_lon, delta_rows
+        # ids in the tree that were deleted or moved since the build
+        self.removed = removed
+        self.removed_mask = np.isin(ids, list(removed)) if removed else None
+        self.build_seconds = build_seconds
+        # identifies the places a freshly built index was built from, None after updates
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, ids, lat, lon):
+        start = time.perf_counter()
+        ids, lat, lon = np.asarray(ids, dtype=object), np.asarray(lat, dtype=np.float32), np.asarray(lon, dtype=np.float32)
+        source = fingerprint(ids, lat, lon)
+        rows = np.arange(len(ids))
+        # places without coordinates can never be near anything
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        ids, lat, lon, rows = ids[valid], lat[valid], lon[valid], rows[valid]
+        tree = BallTree(np.radians(np.column_stack([lat, lon])), metric="haversine") if len(ids) else None
+        empty = np.zeros(0, dtype=np.float32)
+        return cls(
+            tree, ids, lat, lon, rows,
+            np.zeros(0, dtype=object), empty, empty, np.zeros(0, dtype=int), set(),
+            time.perf_counter() - start, fingerprint=source,
+        )
+
+    def update(self, ids, lat, lon, changed):
+        # a new index for the next snapshot, `changed` holds the upserted or deleted place ids
+        start = time.perf_counter()
+        ids, lat, lon = np.asarray(ids, dtype=object), np.asarray(lat, dtype=np.float32), np.asarray(lon, dtype=np.float32)
+        removed = self.removed | (set(self.ids) & changed)
+        # changed places go (back) into the delta buffer with their new coordinates
+        keep = ~np.isin(self.delta_ids, list(changed))
+        added = np.flatnonzero(np.isin(ids, list(changed)) & ~(np.isnan(lat) | np.isnan(lon)))
+        delta_ids = np.concatenate([self.delta_ids[keep], ids[added]])
+        if len(delta_ids) + len(removed) > max(MIN_DELTA_SIZE, MAX_DELTA_SHARE * len(self.ids)):
+            return None
+        delta_lat = np.concatenate([self.delta_lat[keep], lat[added]])
+        delta_lon = np.concatenate([self.delta_lon[keep], lon[added]])
+        # rows shift when the snapshot frame changes, map every id to its new position
+        row_of = {place_id: row for row, place_id in enumerate(ids)}
+        rows = np.array([row_of.get(place_id, -1) for place_id in self.ids], dtype=int)
+        delta_rows = np.array([row_of[place_id] for place_id in delta_ids], dtype=int)
+        return SpatialIndex(
+            self.tree, self.ids, self.lat, self.lon, rows,
+            delta_ids, delta_lat, delta_lon, delta_rows, removed,
+            self.build_seconds + time.perf_counter() - start,
+        )
+
+    def _points(self, lat, lon):
+        return np.radians(np.column_stack([np.atleast_1d(lat), np.atleast_1d(lon)]).astype(np.float64))
+
+    def _merge(self, rows, distances):
+        # sort by distance, one entry per row
+        rows, distances = np.concatenate(rows).astype(int), np.concatenate(distances).astype(np.float32)
+        order = np.lexsort((distances, rows))
+        rows, distances = rows[order], distances[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = rows[1:] != rows[:-1]
+        rows, distances = rows[first], distances[first]
+        order = np.argsort(distances, kind="stable")
+        return rows[order], distances[order]
+
+    def _tree_hits(self, indices, distances):
+        # drop tombstoned points and translate to snapshot rows
+        indices, distances = np.asarray(indices, dtype=int), np.asarray(distances) * R
+        if self.removed_mask is not None:
+            live = ~self.removed_mask[indices]
+            indices, distances = indices[live], distances[live]
+        return self.rows[indices], distances
+
+    def query_radius(self, lat, lon, radius):
+        return self.query_radius_multi([lat], [lon], radius)
+
+    def query_radius_multi(self, lats, lons, radius):
+        # places within `radius` km of any of the points, with the distance to the closest one
+        rows, distances = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=np.float32)]
+        if not np.size(lats):
+            # the tree refuses empty queries, nothing is near no point
+            return self._merge(rows, distances)
+        if self.tree is not None:
+            indices, tree_distances = self.tree.query_radius(self._points(lats, lons), r=radius / R, return_distance=True)
+            for point_indices, point_distances in zip(indices, tree_distances):
+                hit_rows, hit_distances = self._tree_hits(point_indices, point_distances)
+                rows.append(hit_rows)
+                distances.append(hit_distances)
+        if len(self.delta_ids):
+            delta = distance_matrix(lats, lons, self.delta_lat, self.delta_lon)
+            for point_distances in delta:
+                within = point_distances <= radius
+                rows.append(self.delta_rows[within])
+                distances.append(point_distances[within])
+        return self._merge(rows, distances)
+
+    def query_knn(self, lat, lon, k):
+        return self.query_knn_multi([lat], [lon], k)
+
+    def query_knn_multi(self, lats, lons, k):
+        # the k places closest to any of the points, the k nearest of each point always contain them
+        rows, distances = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=np.float32)]
+        if not np.size(lats):
+            return self._merge(rows, distances)
+        if self.tree is not None:
+            # ask for extra neighbours to make up for tombstoned ones
+            tree_k = min(k + len(self.removed), len(self.ids))
+            tree_distances, indices = self.tree.query(self._points(lats, lons), k=tree_k)
+            for point_indices, point_distances in zip(indices, tree_distances):
+                hit_rows, hit_distances = self._tree_hits(point_indices, point_distances)
+                rows.append(hit_rows)
+                distances.append(hit_distances)
+        if len(self.delta_ids):
+            delta = distance_matrix(lats, lons, self.delta_lat, self.delta_lon)
+            rows.append(np.tile(self.delta_rows, len(delta)))
+            distances.append(delta.ravel())
+        rows, distances = self._merge(rows, distances)
+        return rows[:k], distances[:k]
+
+    def stats(self):
+        nbytes = self.lat.nbytes + self.lon.nbytes + self.rows.nbytes
+        if self.tree is not None:
+            nbytes += sum(array.nbytes for array in self.tree.get_arrays())
+        return {
+            "places": len(self.ids) + len(self.delta_ids) - len(self.removed),
+            "tree_places": len(self.ids),
+            "delta_places": len(self.delta_ids),
+            "removed_places": len(self.removed),
+            "bytes": int(nbytes),
+            "build_seconds": round(self.build_seconds, 4),
+        }
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # one temp file per process, every worker may save the same index at once
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        joblib.dump(self, temp_path)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path):
+        return joblib.load(path)
+
+
+# -------------------
+# Snapshot integration
+# -------------------
+
+INDEX_PATH = os.path.join(DATA_DIR, "spatial_index.joblib")
+
+
+def _place_coordinates(snapshot):
+    places_df = snapshot.places
+    lat, lon = coordinates(places_df)
+    return places_df["places_id"].to_numpy(dtype=object), lat, lon
+
+
+def build_spatial_index(snapshot):
+    ids, lat, lon = _place_coordinates(snapshot)
+    if os.path.exists(INDEX_PATH):
+        try:
+            index = SpatialIndex.load(INDEX_PATH)
+            if index.fingerprint == fingerprint(ids, lat, lon):
+                return index
+        except Exception as error:
+            print(f"Could not load spatial index: {error}")
+    index = SpatialIndex.build(ids, lat, lon)
+    # a failed save only costs the next worker a rebuild, the snapshot is still published
+    try:
+        index.save(INDEX_PATH)
+    except OSError as error:
+        print(f"Could not save spatial index: {error}")
+    return index
+
+
+def update_spatial_index(index, snapshot):
+    changed = snapshot.changed("places")
+    if not changed:
+        return index
+    ids, lat, lon = _place_coordinates(snapshot)
+    return index.update(ids, lat, lon, changed)
+
+
+register_derived("spatial_index", build_spatial_index, update_spatial_index)
@@ -0,0 +1,65 @@
+# latency of auto trip generation and route quality of 2-opt over nearest neighbour
+# usage: python -m benchmarks.bench_auto_trip [--places 50000] [--trips 50] [--stops 8]
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+
+os.environ.setdefault("BENA_DATA_DIR", tempfile.mkdtemp(prefix="bena-trip-"))
+
+from app.data_snapshot import LocalSource, SnapshotStore, set_store
+from app.auto_create_trip_model import generate_trip, nearest_neighbour_route, two_opt, route_length
+from app.geo import distance_matrix
+from benchmarks.synthetic import make_tables, TAGS
+
+
+def percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return f"p50 {np.percentile(ms, 50):6.1f}ms  p99 {np.percentile(ms, 99):6.1f}ms  max {ms.max():6.1f}ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark auto trip generation")
+    parser.add_argument("--places", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--trips", type=int, default=50)
+    parser.add_argument("--stops", type=int, default=8)
+    args = parser.parse_args()
+
+    tables, users = make_tables(args.places, args.users)
+    store = SnapshotStore(LocalSource(tables))
+    start = time.perf_counter()
+    store.refresh(full=True)
+    print(f"{args.places} places, snapshot and models built in {time.perf_counter() - start:.1f}s")
+    set_store(store)
+
+    rng = np.random.default_rng(0)
+    place_ids = [place["places_id"] for place in tables["places"]]
+    requests = {
+        "seed place": [{"place_id": place_ids[i]} for i in rng.integers(len(place_ids), size=args.trips)],
+        "bookmarks": [{"user_id": users[i]} for i in rng.integers(len(users), size=args.trips)],
+        "theme": [{"theme": " ".join(rng.choice(TAGS, size=2, replace=False))} for _ in range(args.trips)],
+    }
+    for name, kwargs_list in requests.items():
+        seconds, lengths = [], []
+        for kwargs in kwargs_list:
+            start = time.perf_counter()
+            trip = generate_trip(stops=args.stops, **kwargs)
+            seconds.append(time.perf_counter() - start)
+            lengths.append(len(trip))
+        print(f"{name:<11} {percentiles(seconds)}  stops {np.mean(lengths):.1f}")
+
+    # route quality on random stop sets
+    greedy, improved = [], []
+    for _ in range(200):
+        lat, lon = rng.uniform(29.9, 30.2, args.stops), rng.uniform(31.1, 31.5, args.stops)
+        distances = distance_matrix(lat, lon, lat, lon)
+        route = nearest_neighbour_route(distances)
+        greedy.append(route_length(route, distances))
+        improved.append(route_length(two_opt(route, distances), distances))
+    print(f"route length  nearest neighbour {np.mean(greedy):.2f}km  with 2-opt {np.mean(improved):.2f}km")
+
+
+if __name__ == "__main__":
+    main()
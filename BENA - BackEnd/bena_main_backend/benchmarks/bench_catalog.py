@@ -0,0 +1,49 @@
+# memory of the place catalogue against the pandas frame, and id lookups against the row scan
+# usage: python -m benchmarks.bench_catalog [--places 50000] [--lookups 1000]
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault("BENA_DATA_DIR", tempfile.mkdtemp(prefix="bena-catalog-"))
+
+from app.place_catalog import PlaceCatalog, CATALOG_PATH, pa
+from benchmarks.synthetic import make_places
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the place catalogue")
+    parser.add_argument("--places", type=int, default=50000)
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+
+    places_df = pd.DataFrame(make_places(args.places))
+    start = time.perf_counter()
+    catalog = PlaceCatalog.build(places_df)
+    build = time.perf_counter() - start
+    catalog.save(CATALOG_PATH)
+    start = time.perf_counter()
+    mapped = PlaceCatalog.load(CATALOG_PATH)
+    load = time.perf_counter() - start
+    frame_bytes = places_df.memory_usage(index=True, deep=True).sum()
+    print(f"{args.places} places  {'arrow' if pa is not None else 'numpy'} file  build {build * 1000:.0f}ms  "
+          f"mapped load {load * 1000:.0f}ms")
+    print(f"pandas frame {frame_bytes / 2 ** 20:.1f}MB  catalogue {mapped.stats()['bytes'] / 2 ** 20:.1f}MB")
+
+    rng = np.random.default_rng(0)
+    place_ids = places_df["places_id"].to_numpy()[rng.integers(args.places, size=args.lookups)]
+    start = time.perf_counter()
+    for place_id in place_ids:
+        places_df[places_df["places_id"] == place_id].index[0]
+    scan = (time.perf_counter() - start) / args.lookups
+    start = time.perf_counter()
+    for place_id in place_ids:
+        mapped.row(place_id)
+    lookup = (time.perf_counter() - start) / args.lookups
+    print(f"id lookup  row scan {scan * 1e6:.1f}us  hash map {lookup * 1e6:.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# end to end staleness of changes replayed through the changefeed into a warm snapshot store, against reloading
+# and rebuilding every table for each change as a full refresh does
+# usage: python -m benchmarks.bench_changefeed [--places 20000] [--users 2000] [--rate 200] [--seconds 10]
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+
+os.environ.setdefault("BENA_DATA_DIR", tempfile.mkdtemp(prefix="bena-changefeed-"))
+
+from app.data_snapshot import DATA_DIR, LocalSource, SnapshotStore, set_store
+from app.changefeed import Change, Changefeed, ReplayFeed, write_replay
+from app.metrics import STAGE_SECONDS
+# registers the models and indexes on the snapshots
+import app.recommendation_model
+import app.search_places_model
+from benchmarks.synthetic import TAGS, make_ids, make_tables
+
+# share of the replayed changes per kind
+MIX = {"place_update": 0.15, "place_insert": 0.03, "place_delete": 0.02, "bookmark": 0.4, "interaction": 0.3, "tripstep": 0.1}
+
+
+def make_changes(tables, users, count, rate, rng):
+    # a stream of changes over the synthetic tables, commit times spaced at `rate` changes per second
+    places = tables["places"]
+    place_ids = [place["places_id"] for place in places]
+    trip_ids = [trip["trip_id"] for trip in tables["trips"]]
+    new_ids = iter(make_ids(rng, 4 * count))
+    kinds = rng.choice(list(MIX), size=count, p=list(MIX.values()))
+    start = time.time()
+    changes = []
+    for i, kind in enumerate(kinds):
+        commit_time = start + i / rate
+        stamp = f"2025-01-01T00:00:{i / rate:09.6f}+00:00"
+        if kind == "place_update":
+            place = dict(places[rng.integers(len(places))], updated_at=stamp)
+            # moved, retagged or renamed
+            choice = rng.integers(3)
+            if choice == 0:
+                place["latitude"] += float(rng.normal(0, 0.002))
+            elif choice == 1:
+                place["tags"] = ", ".join(rng.choice(TAGS, size=2, replace=False))
+            else:
+                place["name"] = place["name"] + " (renamed)"
+            change = Change("places", "UPDATE", place["places_id"], place, commit_time)
+        elif kind == "place_insert":
+            place = dict(places[rng.integers(len(places))], places_id=next(new_ids), updated_at=stamp)
+            place_ids.append(place["places_id"])
+            change = Change("places", "INSERT", place["places_id"], place, commit_time)
+        elif kind == "place_delete":
+            change = Change("places", "DELETE", place_ids[rng.integers(len(place_ids))], None, commit_time)
+        elif kind == "bookmark":
+            row = {"bookmark_id": next(new_ids), "user_id": users[rng.integers(len(users))],
+                   "place_id": place_ids[rng.integers(len(place_ids))]}
+            change = Change("bookmarks", "INSERT", row["bookmark_id"], row, commit_time)
+        elif kind == "interaction":
+            row = {"id": 10 ** 9 + i, "user_id": users[rng.integers(len(users))],
+                   "place_id": place_ids[rng.integers(len(place_ids))], "overall": "above"}
+            change = Change("interactions", "INSERT", row["id"], row, commit_time)
+        else:
+            row = {"step_id": next(new_ids), "trip_id": trip_ids[rng.integers(len(trip_ids))],
+                   "place_id": place_ids[rng.integers(len(place_ids))], "step_num": 9}
+            change = Change("tripstep", "INSERT", row["step_id"], row, commit_time)
+        changes.append(change)
+    return changes
+
+
+def stage_totals(prefix):
+    # (seconds, count) per stage whose name starts with prefix
+    totals = {}
+    for key, (counts, total, count) in STAGE_SECONDS.values.items():
+        name = dict(key)["stage"]
+        if name.startswith(prefix):
+            totals[name] = (total, count)
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the changefeed")
+    parser.add_argument("--places", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=200, help="changes per second")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--batch-delay", type=float, default=0.5)
+    args = parser.parse_args()
+
+    tables, users = make_tables(args.places, args.users)
+    for place in tables["places"]:
+        place["updated_at"] = "2024-01-01T00:00:00+00:00"
+    store = SnapshotStore(LocalSource(tables), full_refresh_every=0)
+    set_store(store)
+    start = time.perf_counter()
+    store.refresh(full=True)
+    full_seconds = time.perf_counter() - start
+    print(f"{args.places} places, {args.users} users  full reload and rebuild {full_seconds:.2f}s")
+
+    rng = np.random.default_rng(0)
+    path = os.path.join(DATA_DIR, "changes.jsonl")
+    write_replay(path, make_changes(tables, users, int(args.rate * args.seconds), args.rate, rng))
+    before = stage_totals("derived.")
+    changefeed = Changefeed(store, ReplayFeed(path, speed=1), batch_size=args.batch_size, batch_delay=args.batch_delay)
+    start = time.perf_counter()
+    changefeed.start()
+    changefeed.wait()
+    seconds = time.perf_counter() - start
+    changefeed.stop()
+    report = changefeed.report()
+    print(f"replayed {report['applied'] + report['superseded']} changes at {args.rate:.0f}/s in {seconds:.2f}s, "
+          f"{report['batches']} batches, snapshot version {store.get().version}")
+    print(f"staleness  p50 {report['staleness_p50_seconds']:.3f}s  p95 {report['staleness_p95_seconds']:.3f}s  "
+          f"max {report['staleness_max_seconds']:.3f}s")
+    # every model should have been patched, a build here means a fall back to rebuilding it
+    for name, (total, count) in sorted(stage_totals("derived.").items()):
+        total, count = total - before.get(name, (0, 0))[0], count - before.get(name, (0, 0))[1]
+        if count:
+            print(f"  {name:<42} {count:4d} x {total / count * 1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
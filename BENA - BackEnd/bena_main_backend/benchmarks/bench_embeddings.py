@@ -0,0 +1,75 @@
+# recall and latency of the IVF embedding index against exact search over every place
+# usage: python -m benchmarks.bench_embeddings [--places 50000] [--queries 200] [--k 10]
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault("BENA_DATA_DIR", tempfile.mkdtemp(prefix="bena-embed-"))
+
+from app.embedding_index import EmbeddingIndex, embed_query, NPROBE
+from app.search_index import search_text
+from benchmarks.synthetic import make_places, TAGS
+
+
+def percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return f"p50 {np.percentile(ms, 50):6.2f}ms  p99 {np.percentile(ms, 99):6.2f}ms"
+
+
+def recall(index, queries, k, nprobe):
+    # share of the exact top k the approximate search returns, and the approximate query times
+    found, seconds = [], []
+    for vector in queries:
+        exact, _ = index.exact_search(vector, k=k)
+        start = time.perf_counter()
+        approximate, _ = index.search(vector, k=k, nprobe=nprobe)
+        seconds.append(time.perf_counter() - start)
+        found.append(len(np.intersect1d(exact, approximate)) / max(1, len(exact)))
+    return float(np.mean(found)), seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the embedding index")
+    parser.add_argument("--places", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    places_df = pd.DataFrame(make_places(args.places))
+    ids, texts = places_df["places_id"].astype(str).tolist(), search_text(places_df)
+    index = EmbeddingIndex.build(ids, texts)
+    print(f"{args.places} places  {index.stats()}")
+
+    directory = os.path.join(os.environ["BENA_DATA_DIR"], "bench-embeddings")
+    index.save(directory)
+    start = time.perf_counter()
+    loaded = EmbeddingIndex.load(directory)
+    print(f"memory-mapped load {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    rng = np.random.default_rng(0)
+    # half the queries are places' own texts (recommendation profiles), half free text searches
+    queries = [loaded.vectors_of_rows([row])[0] for row in rng.integers(args.places, size=args.queries // 2)]
+    queries += [embed_query(" ".join(rng.choice(TAGS, size=2, replace=False))) for _ in range(args.queries - len(queries))]
+
+    exact_seconds = []
+    for vector in queries:
+        start = time.perf_counter()
+        loaded.exact_search(vector, k=args.k)
+        exact_seconds.append(time.perf_counter() - start)
+    print(f"exact         {percentiles(exact_seconds)}")
+    for nprobe in sorted({1, 4, NPROBE, 16, 32}):
+        found, seconds = recall(loaded, queries, args.k, nprobe)
+        print(f"nprobe {nprobe:<6} {percentiles(seconds)}  recall@{args.k} {found:.3f}")
+
+    # incremental update of 1% of the places
+    changed = set(rng.choice(ids, size=max(1, args.places // 100), replace=False).tolist())
+    start = time.perf_counter()
+    updated = loaded.update(ids, texts, changed)
+    print(f"update of {len(changed)} places {(time.perf_counter() - start) * 1000:.1f}ms  {updated.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# compares the row-wise haversine apply with the vectorized geo module
+# usage: python -m benchmarks.bench_geo [places ...]
+import sys
+import time
+import numpy as np
+import pandas as pd
+from app.geo import coordinates, min_distance
+from benchmarks.synthetic import make_places
+
+BOOKMARKS = 5
+
+
+def legacy_haversine_distance(lat1, lon1, lat2, lon2):
+    R = 6371  # Radius of Earth in kilometers
+    lat1, lat2, lon1, lon2 = map(np.radians, [lat1, lat2, lon1, lon2])
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+
+def legacy_min_distance(places_df, bookmarked_places_coords):
+    # the per row path the recommenders used before
+    def min_distance_to_bookmarked(lat, lon):
+        distances = [legacy_haversine_distance(lat, lon, b_lat, b_lon) for b_lat, b_lon in bookmarked_places_coords]
+        return min(distances) if distances else float('inf')
+
+    return places_df.apply(lambda row: min_distance_to_bookmarked(row["latitude"], row["longitude"]), axis=1).values
+
+
+def timed(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run(sizes):
+    for size in sizes:
+        places_df = pd.DataFrame(make_places(size))
+        bookmarks = places_df.sample(BOOKMARKS, random_state=0)
+        bookmarked_places_coords = bookmarks[["latitude", "longitude"]].values
+        legacy_seconds, expected = timed(lambda: legacy_min_distance(places_df, bookmarked_places_coords), 1)
+        fast_seconds, result = timed(lambda: min_distance(*coordinates(places_df), *coordinates(bookmarks)), 5)
+        error = np.abs(result - expected).max()
+        print(
+            f"places={size:>7} bookmarks={BOOKMARKS} row-wise={legacy_seconds * 1000:9.1f}ms "
+            f"vectorized={fast_seconds * 1000:7.2f}ms speedup={legacy_seconds / fast_seconds:7.0f}x max_error={error * 1000:.2f}m"
+        )
+
+
+if __name__ == "__main__":
+    run([int(size) for size in sys.argv[1:]] or [10_000, 100_000])
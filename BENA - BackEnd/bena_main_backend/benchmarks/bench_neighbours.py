@@ -0,0 +1,70 @@
+# build and update time of the precomputed neighbour tables, and near lookups against the spatial index query
+# usage: python -m benchmarks.bench_neighbours [--places 100000] [--changes 20] [--lookups 2000]
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+
+os.environ.setdefault("BENA_DATA_DIR", tempfile.mkdtemp(prefix="bena-neighbours-"))
+
+from app.data_snapshot import LocalSource, SnapshotStore, set_store
+from app.geo import coordinates
+from app.neighbour_tables import NeighbourTables, _place_coordinates
+# registers the spatial index on the snapshots
+from app.spatial_index import SpatialIndex
+from benchmarks.synthetic import make_tables
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the neighbour tables")
+    parser.add_argument("--places", type=int, default=100000)
+    parser.add_argument("--changes", type=int, default=20)
+    parser.add_argument("--lookups", type=int, default=2000)
+    args = parser.parse_args()
+
+    tables, users = make_tables(args.places, 100)
+    for place in tables["places"]:
+        place["updated_at"] = "2024-01-01"
+    source = LocalSource(tables)
+    store = SnapshotStore(source, full_refresh_every=0, warm=False)
+    snapshot = store.refresh(full=True)
+    set_store(store)
+    similarity = snapshot.derived("similarity_index")
+    ids, lat, lon = _place_coordinates(snapshot)
+    start = time.perf_counter()
+    neighbours = NeighbourTables.build(ids, lat, lon, similarity)
+    print(f"{args.places} places  build {time.perf_counter() - start:.2f}s  {neighbours.stats()}")
+
+    # move a few places and look at the cost of patching the tables
+    rng = np.random.default_rng(0)
+    moved = [dict(tables["places"][row]) for row in rng.choice(args.places, size=args.changes, replace=False)]
+    for place in moved:
+        place["latitude"] += 0.005
+        place["updated_at"] = "2025-01-01"
+    source.upsert("places", moved)
+    snapshot = store.refresh()
+    ids, lat, lon = _place_coordinates(snapshot)
+    similarity = snapshot.derived("similarity_index")
+    start = time.perf_counter()
+    updated = neighbours.update(ids, lat, lon, similarity, {place["places_id"] for place in moved})
+    print(f"{args.changes} places moved  update {time.perf_counter() - start:.3f}s  {'patched' if updated is not None else 'rebuild needed'}")
+
+    spatial_index = snapshot.derived("spatial_index")
+    lat, lon = coordinates(snapshot.places)
+    rows = rng.integers(0, len(ids), size=args.lookups)
+    for radius in (0.5, 1, 5):
+        start = time.perf_counter()
+        for row in rows:
+            found, distances = spatial_index.query_radius(lat[row], lon[row], radius)
+            found[found != row][:5]
+        query = (time.perf_counter() - start) / args.lookups
+        start = time.perf_counter()
+        covered = sum(updated.near(row, radius, 5) is not None for row in rows)
+        lookup = (time.perf_counter() - start) / args.lookups
+        print(f"radius {radius:>4}km  spatial query {query * 1e6:8.1f}us  table lookup {lookup * 1e6:6.1f}us  "
+              f"covered {covered / args.lookups:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# latency and peak allocation per request of the recommenders against the old copy, score column and sort approach
+# usage: python -m benchmarks.bench_recommend [--places 50000] [--users 2000] [--requests 100] [--length 10]
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+os.environ.setdefault("BENA_DATA_DIR", tempfile.mkdtemp(prefix="bena-recommend-"))
+
+from app.data_snapshot import LocalSource, SnapshotStore, set_store
+from app.geo import coordinates, min_distance
+from app.recommendation_model import update_dataframes, recommend_places_content_based, recommend_places_hybrid, recommend_places_collaborative
+from benchmarks.synthetic import make_tables
+
+
+# -------------------
+# The recommenders before, copying places_df per request and sorting every row
+# -------------------
+
+def legacy_places(places_df):
+    places_df = places_df.copy()
+    places_df["tags"] = places_df["tags"].fillna("")
+    return places_df
+
+
+def legacy_content_based(user_id, places_df, bookmarks_df, similarity, n):
+    places_df = legacy_places(places_df)
+    bookmarked_places = bookmarks_df[bookmarks_df["user_id"] == user_id]["place_id"].tolist()
+    places_df["score"] = similarity.scores(bookmarked_places)
+    places_df.loc[places_df["tags"].str.contains("Not available yet", case=False, na=False), "score"] = 0.1
+    recommendations = places_df.sort_values(by="score", ascending=False)
+    recommendations = recommendations[~recommendations["places_id"].isin(bookmarked_places)]
+    return recommendations.head(n)
+
+
+def legacy_hybrid(user_id, places_df, bookmarks_df, similarity, cooccurrence, n):
+    places_df = legacy_places(places_df)
+    bookmarked_places = bookmarks_df[bookmarks_df["user_id"] == user_id]["place_id"].tolist()
+    places_df["content_score"] = similarity.scores(bookmarked_places)
+    places_df.loc[places_df["tags"].str.contains("Not available yet", case=False, na=False), "content_score"] = 0.1
+    bookmarked_places_df = places_df[places_df["places_id"].isin(bookmarked_places)]
+    places_df["distance_to_bookmarked"] = min_distance(*coordinates(places_df), *coordinates(bookmarked_places_df))
+    places_df["proximity_score"] = 1 - (places_df["distance_to_bookmarked"] / places_df["distance_to_bookmarked"].max())
+    places_df["collaborative_score"] = cooccurrence.scores([user_id])[0]
+    places_df["hybrid_score"] = 0.6 * places_df["content_score"] + 0.4 * places_df["proximity_score"] + 0.3 * places_df["collaborative_score"]
+    recommendations = places_df[~places_df["places_id"].isin(bookmarked_places)]
+    return recommendations.sort_values(by="hybrid_score", ascending=False).head(n)
+
+
+def legacy_collaborative(user_id, places_df, cooccurrence, n):
+    places_df = legacy_places(places_df)
+    visited_rows = cooccurrence.user_places(user_id)
+    places_df["collaborative_score"] = cooccurrence.scores([user_id])[0]
+    recommendations = places_df.drop(index=places_df.index[visited_rows])
+    recommendations = recommendations[recommendations["collaborative_score"] > 0]
+    return recommendations.sort_values(by="collaborative_score", ascending=False).head(n)
+
+
+def measure(function, users):
+    # (p50 ms, p99 ms, mean peak MB) of function(user) over the users
+    seconds, peaks = [], []
+    for user in users:
+        tracemalloc.start()
+        start = time.perf_counter()
+        function(user)
+        seconds.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    ms = np.array(seconds) * 1000
+    return np.percentile(ms, 50), np.percentile(ms, 99), np.mean(peaks) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recommendation latency and allocations")
+    parser.add_argument("--places", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--length", type=int, default=10)
+    args = parser.parse_args()
+
+    tables, users = make_tables(args.places, args.users)
+    store = SnapshotStore(LocalSource(tables))
+    store.refresh(full=True)
+    set_store(store)
+    places_df, bookmarks_df, interactions_df, similarity, spatial_index, cooccurrence, embeddings, catalog = update_dataframes()
+    users = list(np.random.default_rng(0).choice(users, size=args.requests))
+    n = args.length
+    print(f"{args.places} places, {args.requests} requests per method, tracemalloc on (slows both sides)")
+
+    cases = {
+        "content_based": (
+            lambda user: legacy_content_based(user, places_df, bookmarks_df, similarity, n),
+            lambda user: recommend_places_content_based(user, places_df, similarity, bookmarks_df, catalog, n=n),
+        ),
+        "hybrid": (
+            lambda user: legacy_hybrid(user, places_df, bookmarks_df, similarity, cooccurrence, n),
+            lambda user: recommend_places_hybrid(user, places_df, bookmarks_df, similarity, catalog, n=n, cooccurrence=cooccurrence),
+        ),
+        "collaborative": (
+            lambda user: legacy_collaborative(user, places_df, cooccurrence, n),
+            lambda user: recommend_places_collaborative(user, places_df, cooccurrence, n=n),
+        ),
+    }
+    for method, (legacy, current) in cases.items():
+        for name, function in (("before", legacy), ("after", current)):
+            p50, p99, peak = measure(function, users)
+            print(f"{method:<14} {name:<7} p50 {p50:7.2f}ms  p99 {p99:7.2f}ms  peak {peak:6.2f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# encoding time and payload size of recommendation responses, to_dict with every column and the standard json
+# encoder against the compact fields built from the numpy columns and the fast encoder, plain and gzipped
+# usage: python -m benchmarks.bench_responses [--places 20000] [--length 10] [--repeat 2000]
+import json
+import gzip
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from app.responses import records, dumps, orjson, PLACE_FIELDS
+from benchmarks.synthetic import make_places
+
+
+def result_frame(places_df, length, rng):
+    # a hybrid recommendation result, places rows with the scratch score columns
+    result = places_df.iloc[rng.choice(len(places_df), size=length, replace=False)].copy()
+    for column in ["content_score", "distance_to_bookmarked", "proximity_score", "collaborative_score", "hybrid_score"]:
+        result[column] = rng.random(length).astype(np.float32)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark response serialisation")
+    parser.add_argument("--places", type=int, default=20000)
+    parser.add_argument("--length", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    places_df = pd.DataFrame(make_places(args.places))
+    places_df["created_at"] = "2024-01-01T00:00:00+00:00"
+    rng = np.random.default_rng(0)
+    frames = [result_frame(places_df, args.length, rng) for _ in range(50)]
+    cases = {
+        "to_dict + json, every column": lambda frame: json.dumps({"recommendations": frame.to_dict(orient="records")}).encode(),
+        "records + encoder, every column": lambda frame: dumps({"recommendations": records(frame)}),
+        "records + encoder, compact fields": lambda frame: dumps({"recommendations": records(frame, "compact", extra=["hybrid_score"])}),
+    }
+    print(f"{args.length} rows per response, encoder {'orjson' if orjson is not None else 'json'}, "
+          f"compact fields {PLACE_FIELDS + ['hybrid_score']}")
+    for name, encode in cases.items():
+        start = time.perf_counter()
+        for i in range(args.repeat):
+            body = encode(frames[i % len(frames)])
+        seconds = (time.perf_counter() - start) / args.repeat
+        print(f"{name:<36} {seconds * 1e6:8.1f}us  {len(body):6d} bytes  gzip {len(gzip.compress(body, 5)):6d} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# recall and latency of the n-gram search index against the full fuzz.partial_ratio scan
+# usage: python -m benchmarks.bench_search [places ...]
+import sys
+import time
+import numpy as np
+import pandas as pd
+from fuzzywuzzy import fuzz
+from app.search_index import SearchIndex, search_text
+from benchmarks.synthetic import make_places, TAGS
+
+N = 10
+MIN_SCORE = 50
+QUERIES = 30
+
+
+def legacy_smart_search(places_df, query, n=N, min_score=MIN_SCORE):
+    # the per row scan smart_search did before the index
+    places_df = places_df.copy()
+    places_df["search_field"] = (
+        places_df["name"].fillna("") + " " + 
+        places_df["tags"].fillna("") +
+        places_df["arabic_name"].fillna("") +
+        places_df["address"].fillna("")
+    )
+    places_df["similarity_score"] = places_df["search_field"].apply(
+        lambda text: fuzz.partial_ratio(query.lower(), text.lower())
+    )
+    results = places_df[places_df["similarity_score"] >= min_score]
+    return results.sort_values(by="similarity_score", ascending=False).head(n)
+
+
+def make_queries(places, rng):
+    queries = []
+    for _ in range(QUERIES):
+        place = places[rng.integers(len(places))]
+        kind = rng.integers(4)
+        if kind == 0:
+            queries.append(place["name"])
+        elif kind == 1:
+            queries.append(place["arabic_name"])
+        elif kind == 2:
+            queries.append(str(rng.choice(TAGS)))
+        else:
+            # a typo in the middle of the name
+            name = place["name"]
+            middle = len(name) // 2
+            queries.append(name[:middle] + name[middle + 1:])
+    return queries
+
+
+def run(sizes):
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        places = make_places(size)
+        places_df = pd.DataFrame(places)
+        start = time.perf_counter()
+        index = SearchIndex.build(places_df["places_id"].tolist(), search_text(places_df))
+        build_ms = (time.perf_counter() - start) * 1000
+        legacy_ms, index_ms, id_recall, score_recall = [], [], [], []
+        for query in make_queries(places, rng):
+            start = time.perf_counter()
+            expected = legacy_smart_search(places_df, query)
+            legacy_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            rows, scores = index.search(query, n=N, min_score=MIN_SCORE)
+            index_ms.append((time.perf_counter() - start) * 1000)
+            if expected.empty:
+                continue
+            found = set(places_df["places_id"].iloc[rows])
+            id_recall.append(len(found & set(expected["places_id"])) / len(expected))
+            # ties make the exact ids arbitrary, the score profile of the top n is what users see
+            expected_scores = sorted(expected["similarity_score"], reverse=True)
+            score_recall.append(np.mean([found >= expected for found, expected in zip(sorted(scores, reverse=True), expected_scores)] + [0] * (len(expected_scores) - len(scores))))
+        print(
+            f"places={size:>7} build={build_ms:8.1f}ms "
+            f"scan p50={np.median(legacy_ms):8.1f}ms index p50={np.median(index_ms):6.2f}ms "
+            f"id recall@{N}={np.mean(id_recall):.2f} score recall@{N}={np.mean(score_recall):.2f}"
+        )
+
+
+if __name__ == "__main__":
+    run([int(size) for size in sys.argv[1:]] or [10_000])
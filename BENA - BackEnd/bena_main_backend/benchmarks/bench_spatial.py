@@ -0,0 +1,47 @@
+# radius and k-nearest query latency of the spatial index against a full scan
+# usage: python -m benchmarks.bench_spatial [places ...]
+import sys
+import time
+import numpy as np
+import pandas as pd
+from app.geo import coordinates, haversine_distance, min_distance
+from app.spatial_index import SpatialIndex
+from benchmarks.synthetic import make_places
+
+QUERIES = 200
+RADIUS = 1
+BOOKMARKS = 5
+N = 10
+
+
+def per_query_ms(function, queries):
+    start = time.perf_counter()
+    for query in queries:
+        function(query)
+    return (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def run(sizes):
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        places_df = pd.DataFrame(make_places(size))
+        lat, lon = coordinates(places_df)
+        start = time.perf_counter()
+        index = SpatialIndex.build(places_df["places_id"], lat, lon)
+        build_ms = (time.perf_counter() - start) * 1000
+        points = rng.integers(0, size, size=QUERIES)
+        anchors = [rng.integers(0, size, size=BOOKMARKS) for _ in range(QUERIES)]
+
+        scan_radius = per_query_ms(lambda row: np.flatnonzero(haversine_distance(lat[row], lon[row], lat, lon) <= RADIUS), points)
+        index_radius = per_query_ms(lambda row: index.query_radius(lat[row], lon[row], RADIUS), points)
+        scan_knn = per_query_ms(lambda rows: np.argpartition(min_distance(lat, lon, lat[rows], lon[rows]), N)[:N], anchors)
+        index_knn = per_query_ms(lambda rows: index.query_knn_multi(lat[rows], lon[rows], N), anchors)
+        print(
+            f"places={size:>7} build={build_ms:7.1f}ms "
+            f"radius({RADIUS}km) scan={scan_radius:6.3f}ms index={index_radius:6.3f}ms "
+            f"knn({BOOKMARKS} anchors) scan={scan_knn:6.3f}ms index={index_knn:6.3f}ms"
+        )
+
+
+if __name__ == "__main__":
+    run([int(size) for size in sys.argv[1:]] or [10_000, 100_000])
@@ -0,0 +1,69 @@
+# worker startup time: importing the app must not touch the database, and readiness follows the first snapshot
+# usage: python -m benchmarks.bench_startup [--places 20000] [--latency 0.02] [--max-import-seconds 10]
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+os.environ.setdefault("BENA_DATA_DIR", tempfile.mkdtemp(prefix="bena-startup-"))
+
+# an address nothing listens on, any database call during import fails or hangs
+UNREACHABLE = {"SUPABASE_URL": "http://127.0.0.1:9", "SUPABASE_KEY": "unused"}
+IMPORT = "import time; start = time.perf_counter(); import app.main; print(time.perf_counter() - start)"
+
+
+def time_import(repeat):
+    # seconds to import app.main in a fresh interpreter
+    env = dict(os.environ, **UNREACHABLE)
+    seconds = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", IMPORT], env=env, capture_output=True, text=True, timeout=120)
+        if result.returncode != 0:
+            raise SystemExit(f"importing app.main failed:\n{result.stderr}")
+        seconds.append(float(result.stdout.strip().splitlines()[-1]))
+    return seconds
+
+
+def time_ready(places, latency):
+    # seconds from lifespan start until /health/ready answers 200, against the stub backend
+    from fastapi.testclient import TestClient
+    from app.data_snapshot import AsyncSupabaseSource, SnapshotStore, set_store
+    from app.main import app
+    from benchmarks.stub_backend import StubBackend
+    from benchmarks.synthetic import make_tables
+
+    tables, users = make_tables(places, max(1, places // 20))
+    source = AsyncSupabaseSource(url="http://stub", key="stub", transport=StubBackend(tables, latency).async_transport)
+    set_store(SnapshotStore(source))
+    start = time.perf_counter()
+    with TestClient(app) as client:
+        started = time.perf_counter() - start
+        assert client.get("/health/live").status_code == 200
+        while client.get("/health/ready").status_code != 200:
+            time.sleep(0.01)
+        ready = time.perf_counter() - start
+    source.close()
+    return started, ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure worker startup and readiness time")
+    parser.add_argument("--places", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-import-seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    seconds = time_import(args.repeat)
+    print(f"import app.main   median {np.median(seconds) * 1000:.0f}ms  max {max(seconds) * 1000:.0f}ms  (database unreachable)")
+    started, ready = time_ready(args.places, args.latency)
+    print(f"{args.places} places   accepting requests after {started * 1000:.0f}ms, ready after {ready * 1000:.0f}ms")
+    if max(seconds) > args.max_import_seconds:
+        raise SystemExit(f"import took {max(seconds):.2f}s, more than {args.max_import_seconds}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# round trips and latency of trip creation against a local fake supabase client
+# usage: python -m benchmarks.bench_trip_writes [--latency 0.02] [--steps 20] [--trips 200]
+import time
+import argparse
+from datetime import datetime
+from app import dbcom
+from benchmarks.fake_supabase import FakeSupabase
+from benchmarks.synthetic import make_places
+
+
+def legacy_create_trip(supabase, user_id, title, steps, description="no description", status="planned"):
+    # the per step insert loop create_trip used before the bulk write path
+    new_trip = {"user_id": user_id, "title": title, "description": description, "status": status}
+    created_trip = supabase.table("trips").insert(new_trip).execute()
+    trip_id = created_trip.data[0]["trip_id"]
+    for step in steps:
+        new_step = {"trip_id": trip_id, "place_id": step["place_id"], "step_num": steps.index(step)}
+        supabase.table("tripstep").insert(new_step).execute()
+    return new_trip
+
+
+def measure(client, run):
+    client.round_trips = 0
+    start = time.perf_counter()
+    run()
+    return client.round_trips, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark trip creation round trips")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--trips", type=int, default=200)
+    args = parser.parse_args()
+
+    places = make_places(max(args.steps, 50))
+    steps = [{"place_id": place["places_id"], "name": place["name"]} for place in places[:args.steps]]
+    user_id = "bench-user"
+    client = FakeSupabase(latency=args.latency)
+    dbcom.set_supabase(client)
+    print(f"{args.steps} steps per trip, {args.latency * 1000:.0f}ms round trips")
+
+    trips, ms = measure(client, lambda: legacy_create_trip(client, user_id, "Legacy", steps))
+    print(f"legacy create_trip          {trips:>4} round trips  {ms:8.1f}ms")
+    trips, ms = measure(client, lambda: dbcom.create_trip(user_id, "Bulk", datetime.now(), datetime.now(), steps))
+    print(f"create_trip                 {trips:>4} round trips  {ms:8.1f}ms")
+    trips, ms = measure(client, lambda: dbcom.create_trip(user_id, "Keyed", None, None, steps, idempotency_key="bench-1"))
+    print(f"create_trip with key        {trips:>4} round trips  {ms:8.1f}ms")
+    trips, ms = measure(client, lambda: dbcom.create_trip(user_id, "Keyed", None, None, steps, idempotency_key="bench-1"))
+    print(f"create_trip key replayed    {trips:>4} round trips  {ms:8.1f}ms")
+
+    many = [{"user_id": user_id, "title": f"Import {i}", "start_date": None, "end_date": None, "steps": steps} for i in range(args.trips)]
+    trips, ms = measure(client, lambda: [legacy_create_trip(client, user_id, trip["title"], steps) for trip in many[:10]])
+    print(f"legacy x{args.trips:<5}               {trips * args.trips // 10:>4} round trips  {ms * args.trips / 10:8.1f}ms  (extrapolated from 10)")
+    trips, ms = measure(client, lambda: dbcom.create_trips(many))
+    print(f"create_trips x{args.trips:<5}         {trips:>4} round trips  {ms:8.1f}ms")
+
+    # a failed step insert is cleaned up and retried without leaving a trip behind
+    before = len(client.tables["trips"])
+    client.fail("insert", "tripstep")
+    dbcom.RETRY_DELAY = 0
+    trips, ms = measure(client, lambda: dbcom.create_trip(user_id, "Retried", None, None, steps))
+    print(f"create_trip one failure     {trips:>4} round trips  {ms:8.1f}ms  trips added: {len(client.tables['trips']) - before}")
+
+
+if __name__ == "__main__":
+    main()
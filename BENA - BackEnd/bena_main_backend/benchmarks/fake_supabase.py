@@ -0,0 +1,117 @@
+# a local stand-in for the supabase python client, every execute() is one simulated round trip
+import time
+import uuid
+from types import SimpleNamespace
+
+
+class FakeQuery:
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.action = "select"
+        self.columns = "*"
+        self.rows = None
+        self.filters = []
+        self.order_by = None
+        self.window = None
+
+    def select(self, columns="*"):
+        self.columns = columns
+        return self
+
+    def insert(self, rows):
+        self.action, self.rows = "insert", rows if isinstance(rows, list) else [rows]
+        return self
+
+    def upsert(self, rows, on_conflict=None):
+        self.action, self.rows = "upsert", rows if isinstance(rows, list) else [rows]
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and str(row[column]) > str(value))
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by = (column, desc)
+        return self
+
+    def range(self, start, end):
+        self.window = (start, end)
+        return self
+
+    def execute(self):
+        return SimpleNamespace(data=self.client.execute(self))
+
+
+class FakeSupabase:
+    # tables of row dicts, with optional failures injected per (action, table)
+    def __init__(self, tables=None, keys=None, latency=0.0):
+        self.tables = {name: list(rows) for name, rows in (tables or {}).items()}
+        # columns filled with a new uuid when an insert leaves them out
+        self.keys = keys or {"trips": "trip_id", "tripstep": "step_id"}
+        self.latency = latency
+        self.round_trips = 0
+        self.failures = {}
+        # ordered copies of tables for paginated reads, dropped on every write to the table
+        self._sorted = {}
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def fail(self, action, table, times=1):
+        self.failures[(action, table)] = times
+
+    def execute(self, query):
+        self.round_trips += 1
+        time.sleep(self.latency)
+        if self.failures.get((query.action, query.table)):
+            self.failures[(query.action, query.table)] -= 1
+            raise ConnectionError(f"injected {query.action} failure on {query.table}")
+        rows = self.tables.setdefault(query.table, [])
+        key = self.keys.get(query.table)
+        if query.action != "select":
+            self._sorted = {name: value for name, value in self._sorted.items() if name[0] != query.table}
+        if query.action in ("insert", "upsert"):
+            new_rows = [dict(row) for row in query.rows]
+            for row in new_rows:
+                if key is not None and row.get(key) is None:
+                    row[key] = str(uuid.uuid4())
+            if key is not None:
+                existing = {row[key] for row in rows}
+                if query.action == "insert" and any(row[key] in existing for row in new_rows):
+                    raise ValueError(f"duplicate key in {query.table}")
+                replaced = {row[key] for row in new_rows}
+                rows[:] = [row for row in rows if row[key] not in replaced]
+            rows.extend(new_rows)
+            return new_rows
+        if query.action == "select" and query.order_by is not None:
+            # sort once per table version so paging through a large table stays linear
+            column, desc = query.order_by
+            ordered = self._sorted.get((query.table, column, desc))
+            if ordered is None:
+                ordered = self._sorted[(query.table, column, desc)] = sorted(rows, key=lambda row: str(row.get(column)), reverse=desc)
+            rows = ordered
+        matched = [row for row in rows if all(match(row) for match in query.filters)] if query.filters else rows
+        if query.action == "delete":
+            deleted = {id(row) for row in matched}
+            self.tables[query.table] = [row for row in rows if id(row) not in deleted]
+            return matched
+        if query.window is not None:
+            matched = matched[query.window[0]:query.window[1] + 1]
+        if query.columns != "*":
+            columns = query.columns.split(",")
+            matched = [{column: row.get(column) for column in columns} for row in matched]
+        return list(matched)
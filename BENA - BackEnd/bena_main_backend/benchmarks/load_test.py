@@ -0,0 +1,127 @@
+# snapshot loading and concurrent request load against a local stub of the supabase api
+# usage: python -m benchmarks.load_test [--places 5000] [--users 500] [--latency 0.02] [--concurrency 32] [--requests 400]
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+import httpx
+import numpy as np
+
+os.environ.setdefault("BENA_DATA_DIR", tempfile.mkdtemp(prefix="bena-load-"))
+
+from fastapi import FastAPI
+from app.data_snapshot import SupabaseSource, AsyncSupabaseSource, SnapshotStore, set_store
+from app.recommendation_model import recommend_places
+from app.main import app, validate_recommendation_params
+from benchmarks.stub_backend import StubBackend
+from benchmarks.synthetic import make_tables
+
+
+class SequentialSource:
+    # hides fetch_many so the store fetches one table after another like before
+    def __init__(self, source):
+        self.source = source
+
+    def fetch(self, **request):
+        return self.source.fetch(**request)
+
+
+def legacy_app(stub):
+    # the old request path: a blocking handler that pulls its tables on every request
+    legacy = FastAPI()
+    client = httpx.Client(base_url="http://stub/rest/v1", transport=stub.transport)
+
+    @legacy.get("/recommend/{user_id}")
+    def read_item(user_id: str, method: str = None, length: int = None):
+        method, length, warnings = validate_recommendation_params(method, length)
+        for table in ("places", "bookmarks", "interactions"):
+            client.get(f"/{table}", params={"select": "*", "limit": 1000, "offset": 0})
+        recommendations = recommend_places(user_id=user_id, n=length, method=method)
+        return {"recommendations": recommendations.to_dict(orient="records"), "method": method, "length": length, "warnings": warnings}
+
+    return legacy
+
+
+def time_loads(source, repeat=3):
+    # seconds for a full load and for an incremental refresh with nothing changed
+    full, changes = [], []
+    for _ in range(repeat):
+        store = SnapshotStore(source, warm=False)
+        start = time.perf_counter()
+        store.refresh(full=True)
+        full.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        store.refresh()
+        changes.append(time.perf_counter() - start)
+    return round(min(full) * 1000, 1), round(min(changes) * 1000, 1)
+
+
+async def run_load(target, paths, concurrency, total):
+    latencies, statuses = [], {}
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(paths[i % len(paths)])
+
+    async def worker(client):
+        while not queue.empty():
+            path = queue.get_nowait()
+            start = time.perf_counter()
+            response = await client.get(path)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    transport = httpx.ASGITransport(app=target)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=120) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {
+        "requests_per_second": round(total / elapsed, 1),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 1),
+        "statuses": statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the request path against a stub backend")
+    parser.add_argument("--places", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=400)
+    args = parser.parse_args()
+
+    tables, users = make_tables(args.places, args.users)
+    stub = StubBackend(tables, latency=args.latency)
+    concurrent = AsyncSupabaseSource(url="http://stub", key="stub", transport=stub.async_transport)
+    print(f"{args.places} places, {args.users} users, {args.latency * 1000:.0f}ms round trips")
+
+    sequential_full, sequential_changes = time_loads(SequentialSource(concurrent))
+    concurrent_full, concurrent_changes = time_loads(concurrent)
+    print(f"snapshot load     sequential full {sequential_full}ms / refresh {sequential_changes}ms   "
+          f"concurrent full {concurrent_full}ms / refresh {concurrent_changes}ms")
+
+    store = SnapshotStore(concurrent)
+    store.refresh(full=True)
+    set_store(store)
+    rng = np.random.default_rng(0)
+    recommend = [f"/recommend/{user}?method={method}" for user in rng.choice(users, 50) for method in ("content_based", "hybrid")]
+    mixed = recommend + [f"/search/places/{tables['places'][i]['name']}" for i in rng.integers(args.places, size=20)]
+    mixed += [f"/search/places/near/{tables['places'][i]['places_id']}" for i in rng.integers(args.places, size=20)]
+    mixed += [f"/share/trip/{trip['trip_id']}" for trip in tables["trips"][:20]]
+
+    for name, target, paths in (
+        ("legacy /recommend", legacy_app(stub), recommend),
+        ("async /recommend", app, recommend),
+        ("async mixed", app, mixed),
+    ):
+        result = asyncio.run(run_load(target, paths, args.concurrency, args.requests))
+        print(f"{name:<18} {result}")
+    concurrent.close()
+
+
+if __name__ == "__main__":
+    main()
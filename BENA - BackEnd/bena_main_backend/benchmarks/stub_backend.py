@@ -0,0 +1,54 @@
+# an in-memory stand-in for the supabase REST api with a fixed round trip latency
+import time
+import asyncio
+import httpx
+
+
+class StubBackend:
+    # serves select, limit/offset, order and gt/in filters over lists of row dicts
+    def __init__(self, tables, latency=0.02):
+        self.tables = tables
+        self.latency = latency
+        self.requests = 0
+
+    def _rows(self, request):
+        self.requests += 1
+        table = request.url.path.rsplit("/", 1)[-1]
+        rows = self.tables.get(table, [])
+        params = request.url.params
+        for column, value in params.multi_items():
+            if column in ("select", "limit", "offset", "order"):
+                continue
+            operator, operand = value.split(".", 1)
+            if operator == "gt":
+                rows = [row for row in rows if row.get(column) is not None and str(row[column]) > operand]
+            elif operator == "in":
+                wanted = {item.strip('"') for item in operand.strip("()").split(",")}
+                rows = [row for row in rows if str(row.get(column)) in wanted]
+        if "order" in params:
+            column = params["order"].split(".")[0]
+            rows = sorted(rows, key=lambda row: str(row.get(column)))
+        offset = int(params.get("offset", 0))
+        if "limit" in params:
+            rows = rows[offset:offset + int(params["limit"])]
+        select = params.get("select", "*")
+        if select != "*":
+            columns = select.split(",")
+            rows = [{column: row.get(column) for column in columns} for row in rows]
+        return httpx.Response(200, json=rows)
+
+    async def handle_async(self, request):
+        await asyncio.sleep(self.latency)
+        return self._rows(request)
+
+    def handle(self, request):
+        time.sleep(self.latency)
+        return self._rows(request)
+
+    @property
+    def async_transport(self):
+        return httpx.MockTransport(self.handle_async)
+
+    @property
+    def transport(self):
+        return httpx.MockTransport(self.handle)
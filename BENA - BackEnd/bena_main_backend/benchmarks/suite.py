@@ -0,0 +1,225 @@
+# benchmark suite over the backend hot paths at several catalogue sizes, served from a local fake supabase client.
+# results are written as JSON, --compare flags cases whose p50 got slower than a previous run
+# usage: python -m benchmarks.suite [--places 1000 10000 100000] [--requests 200] [--threads 8]
+#                                   [--output results.json] [--compare baseline.json] [--tolerance 0.2]
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+import contextlib
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+os.environ.setdefault("BENA_DATA_DIR", tempfile.mkdtemp(prefix="bena-suite-"))
+
+from app import dbcom
+from app.data_snapshot import SupabaseSource, SnapshotStore, set_store
+from app.recommendation_model import compute_recommendations
+from app.search_places_model import smart_search, find_places_near_place_id
+from benchmarks.fake_supabase import FakeSupabase
+from benchmarks.synthetic import make_tables, TAGS, ARABIC_TAGS
+
+RECOMMEND_METHODS = ["content_based", "near_bookmarks", "hybrid", "collaborative", "semantic", "random"]
+# calls traced with tracemalloc per case, tracing slows every allocation so it runs apart from the timed calls
+TRACED_CALLS = 10
+LENGTH = 10
+
+
+def percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+    }
+
+
+def peak_rss_mb():
+    # high-water mark of the whole process, kilobytes on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def measure(function, calls, threads):
+    # latency percentiles of sequential calls, throughput with `threads` concurrent callers, and peak allocation
+    seconds = []
+    for args in calls:
+        start = time.perf_counter()
+        function(*args)
+        seconds.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda args: function(*args), calls))
+    throughput = len(calls) / (time.perf_counter() - start)
+    tracemalloc.start()
+    for args in calls[:TRACED_CALLS]:
+        function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "requests": len(calls),
+        **percentiles(seconds),
+        "throughput_per_second": round(throughput, 1),
+        "peak_alloc_mb": round(peak / 2 ** 20, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def search_queries(places, rng, count):
+    # names, arabic names, english and arabic tags and misspelled names
+    queries = []
+    for _ in range(count):
+        place = places[rng.randrange(len(places))]
+        kind = rng.randrange(5)
+        if kind == 0:
+            queries.append(place["name"])
+        elif kind == 1:
+            queries.append(place["arabic_name"])
+        elif kind == 2:
+            queries.append(rng.choice(TAGS))
+        elif kind == 3:
+            queries.append(rng.choice(ARABIC_TAGS))
+        else:
+            name = place["name"]
+            cut = rng.randrange(1, len(name))
+            queries.append(name[:cut] + name[cut + 1:])
+    return queries
+
+
+def run_scale(n_places, n_users, requests, threads, latency, seed=0):
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    tables, users = make_tables(n_places, n_users, seed=seed)
+    generate = time.perf_counter() - start
+    client = FakeSupabase(tables, latency=latency)
+    dbcom.set_supabase(client)
+
+    store = SnapshotStore(SupabaseSource(client), warm=False)
+    start = time.perf_counter()
+    snapshot = store.refresh(full=True)
+    load = time.perf_counter() - start
+    start = time.perf_counter()
+    snapshot.warm()
+    warm = time.perf_counter() - start
+    set_store(store)
+    result = {
+        "places": n_places,
+        "users": n_users,
+        "rows": {table: len(rows) for table, rows in tables.items()},
+        "setup": {
+            "generate_seconds": round(generate, 3),
+            "snapshot_load_seconds": round(load, 3),
+            "models_build_seconds": round(warm, 3),
+            "round_trips": client.round_trips,
+            "peak_rss_mb": peak_rss_mb(),
+        },
+        "cases": {},
+    }
+
+    place_ids = [place["places_id"] for place in tables["places"]]
+    bookmarked_users = sorted({bookmark["user_id"] for bookmark in tables["bookmarks"]})
+    cases = {
+        f"recommend.{method}": (
+            lambda user, method=method: compute_recommendations(user, LENGTH, method),
+            [(rng.choice(bookmarked_users),) for _ in range(requests)],
+        )
+        for method in RECOMMEND_METHODS
+    }
+    cases["smart_search"] = (smart_search, [(query,) for query in search_queries(tables["places"], rng, requests)])
+    cases["near"] = (
+        lambda place_id, radius: find_places_near_place_id(place_id, radius=radius, n=5),
+        [(rng.choice(place_ids), rng.choice([0.5, 1, 2, 5])) for _ in range(requests)],
+    )
+    cases["create_trip"] = (
+        lambda user, steps: dbcom.create_trip(user, "Benchmark trip", None, None, steps),
+        [(rng.choice(users), [{"place_id": place_id} for place_id in rng.sample(place_ids, min(5, n_places))]) for _ in range(requests)],
+    )
+    # the models print a line for every user without bookmarks and every trip created
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, (function, calls) in cases.items():
+            result["cases"][name] = measure(function, calls, threads)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    # cases whose p50 grew by more than `tolerance` against the baseline run at the same size
+    previous = {(run["places"], name): case for run in baseline["runs"] for name, case in run["cases"].items()}
+    regressions = []
+    for run in results["runs"]:
+        for name, case in run["cases"].items():
+            before = previous.get((run["places"], name))
+            if before is None or not before["p50_ms"]:
+                continue
+            ratio = case["p50_ms"] / before["p50_ms"]
+            flag = "REGRESSION" if ratio > 1 + tolerance else ""
+            print(f"{run['places']:>8} {name:<26} p50 {before['p50_ms']:9.3f}ms -> {case['p50_ms']:9.3f}ms  x{ratio:5.2f} {flag}")
+            if flag:
+                regressions.append((run["places"], name, round(ratio, 2)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend hot paths on synthetic data")
+    parser.add_argument("--places", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--users-per-place", type=float, default=0.1)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake supabase round trip")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="a previous results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "arguments": vars(args),
+        },
+        "runs": [],
+    }
+    for n_places in args.places:
+        n_users = max(100, int(n_places * args.users_per_place))
+        print(f"{n_places} places, {n_users} users ...", flush=True)
+        run = run_scale(n_places, n_users, args.requests, args.threads, args.latency)
+        results["runs"].append(run)
+        print(f"  setup {run['setup']}")
+        for name, case in run["cases"].items():
+            print(f"  {name:<26} p50 {case['p50_ms']:9.3f}ms  p99 {case['p99_ms']:9.3f}ms  "
+                  f"{case['throughput_per_second']:9.1f}/s  peak {case['peak_alloc_mb']:8.3f}MB")
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
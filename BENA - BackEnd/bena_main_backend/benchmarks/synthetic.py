@@ -0,0 +1,131 @@
+# synthetic data for the benchmarks, vectorized so 1M places build in seconds
+import uuid
+import numpy as np
+
+# rough bounding box of greater Cairo
+CAIRO_LAT = (29.90, 30.20)
+CAIRO_LON = (31.10, 31.50)
+# (lat, lon, spread in degrees) of the areas most places cluster around:
+# downtown, zamalek, giza pyramids, old cairo, khan el khalili, heliopolis, maadi
+HOTSPOTS = [
+    (30.045, 31.236, 0.010), (30.061, 31.219, 0.006), (29.977, 31.132, 0.012), (30.006, 31.230, 0.008),
+    (30.048, 31.262, 0.005), (30.091, 31.322, 0.015), (29.960, 31.257, 0.012),
+]
+# share of places around a hotspot, the rest are spread over the whole box
+HOTSPOT_SHARE = 0.7
+TAGS = [
+    "museum", "history", "pharaonic", "islamic", "coptic", "mosque", "church", "market",
+    "shopping", "restaurant", "cafe", "nile", "view", "park", "garden", "art", "gallery",
+    "nightlife", "family", "kids", "street food", "bazaar", "fortress", "palace",
+]
+# the same tags in arabic, aligned with TAGS
+ARABIC_TAGS = [
+    "متحف", "تاريخ", "فرعوني", "إسلامي", "قبطي", "مسجد", "كنيسة", "سوق",
+    "تسوق", "مطعم", "مقهى", "النيل", "إطلالة", "منتزه", "حديقة", "فن", "معرض",
+    "سهر", "عائلي", "أطفال", "أكل شارع", "بازار", "قلعة", "قصر",
+]
+# share of tags written in arabic
+ARABIC_TAG_SHARE = 0.25
+MAX_TAGS = 4
+NAMES = ["Museum", "Cafe", "Garden", "Mosque", "Palace", "Market", "Gallery", "Park", "Tower", "Bazaar"]
+ARABIC_NAMES = ["متحف", "مقهى", "حديقة", "مسجد", "قصر", "سوق", "معرض", "منتزه", "برج", "بازار"]
+# rows per block while drawing tags, bounds the scratch matrix
+BLOCK = 100000
+
+
+def make_ids(rng, n):
+    raw = rng.bytes(16 * n)
+    return [str(uuid.UUID(bytes=raw[16 * i:16 * i + 16])) for i in range(n)]
+
+
+def make_coordinates(rng, n):
+    # most places around a hotspot, clipped to the Cairo box
+    spot = rng.integers(0, len(HOTSPOTS), size=n)
+    centres = np.array(HOTSPOTS)[spot]
+    lat = rng.normal(centres[:, 0], centres[:, 2])
+    lon = rng.normal(centres[:, 1], centres[:, 2])
+    spread = rng.random(n) >= HOTSPOT_SHARE
+    lat[spread] = rng.uniform(*CAIRO_LAT, size=spread.sum())
+    lon[spread] = rng.uniform(*CAIRO_LON, size=spread.sum())
+    return np.clip(lat, *CAIRO_LAT), np.clip(lon, *CAIRO_LON)
+
+
+def make_tags(rng, n):
+    # 1 to MAX_TAGS distinct tags per place, some of them in arabic
+    counts = rng.integers(1, MAX_TAGS + 1, size=n)
+    tags = []
+    for start in range(0, n, BLOCK):
+        size = min(BLOCK, n - start)
+        picks = np.argsort(rng.random((size, len(TAGS)), dtype=np.float32), axis=1)[:, :MAX_TAGS]
+        arabic = rng.random((size, MAX_TAGS)) < ARABIC_TAG_SHARE
+        for row in range(size):
+            count = counts[start + row]
+            tags.append(", ".join(
+                ARABIC_TAGS[tag] if in_arabic else TAGS[tag] for tag, in_arabic in zip(picks[row, :count], arabic[row, :count])
+            ))
+    return tags
+
+
+def make_places(n, seed=0):
+    # places table rows with Cairo coordinates and a few english and arabic tags each
+    rng = np.random.default_rng(seed)
+    ids = make_ids(rng, n)
+    lat, lon = make_coordinates(rng, n)
+    kinds = rng.integers(0, len(NAMES), size=n)
+    streets = rng.integers(1, 200, size=n)
+    tags = make_tags(rng, n)
+    return [
+        {
+            "places_id": ids[i],
+            "name": f"{NAMES[kinds[i]]} {i}",
+            "arabic_name": f"{ARABIC_NAMES[kinds[i]]} {i}",
+            "address": f"{streets[i]} Street {i % 500}, Cairo",
+            "tags": tags[i],
+            "latitude": float(lat[i]),
+            "longitude": float(lon[i]),
+        }
+        for i in range(n)
+    ]
+
+
+def popular_rows(rng, n_places, size):
+    # place rows drawn with a long tail, a few places are far more popular than the rest
+    rank = rng.permutation(n_places)
+    weights = np.cumsum(1.0 / (np.arange(n_places) + 10))
+    return rank[np.searchsorted(weights, rng.random(size) * weights[-1])]
+
+
+def make_tables(n_places, n_users, bookmarks_per_user=5, seed=0, steps_per_trip=4):
+    # places, bookmarks, interactions, trips and tripstep rows for n_users users, one trip each
+    # a separate stream from make_places so user ids never repeat place ids
+    rng = np.random.default_rng([seed, 1])
+    places = make_places(n_places, seed)
+    place_ids = [place["places_id"] for place in places]
+    users = make_ids(rng, n_users)
+
+    bookmarks = []
+    k = min(bookmarks_per_user, n_places)
+    picks = popular_rows(rng, n_places, n_users * k).reshape(n_users, k)
+    bookmark_ids = iter(make_ids(rng, n_users * k))
+    for user, rows in zip(users, picks):
+        # a place drawn twice is bookmarked once
+        for row in dict.fromkeys(rows.tolist()):
+            bookmarks.append({"bookmark_id": next(bookmark_ids), "user_id": user, "place_id": place_ids[row]})
+
+    interactions = [
+        {"id": i, "user_id": user, "place_id": place_ids[row], "overall": "above"}
+        for i, (user, row) in enumerate(zip(users, popular_rows(rng, n_places, n_users)))
+    ]
+
+    trips, tripstep = [], []
+    steps = min(steps_per_trip, n_places)
+    trip_ids = make_ids(rng, n_users)
+    step_ids = iter(make_ids(rng, n_users * steps))
+    picks = popular_rows(rng, n_places, n_users * steps).reshape(n_users, steps)
+    for i, (user, trip_id, rows) in enumerate(zip(users, trip_ids, picks)):
+        trips.append({"trip_id": trip_id, "user_id": user, "title": f"Trip {i}", "status": "planned"})
+        for step_num, row in enumerate(dict.fromkeys(rows.tolist())):
+            tripstep.append({"step_id": next(step_ids), "trip_id": trip_id, "place_id": place_ids[row], "step_num": step_num})
+
+    tables = {"places": places, "bookmarks": bookmarks, "interactions": interactions, "trips": trips, "tripstep": tripstep}
+    return tables, users
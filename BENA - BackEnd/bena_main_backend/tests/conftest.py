@@ -0,0 +1,91 @@
+# shared fixtures: synthetic tables served from memory, with the data directory moved out of the repo
+import os
+import tempfile
+import pytest
+
+# read by app.data_snapshot on import, so it has to be set before any app module is loaded
+os.environ.setdefault("BENA_DATA_DIR", tempfile.mkdtemp(prefix="bena-tests-"))
+
+from app.data_snapshot import DERIVED, LocalSource, SnapshotStore, set_store
+from benchmarks.synthetic import make_tables
+
+# registers the models and indexes on the snapshots
+import app.recommendation_model
+import app.search_places_model
+
+PLACES = 2000
+USERS = 200
+STAMP = "2024-01-01T00:00:00+00:00"
+LATER = "2024-01-02T00:00:00+00:00"
+
+
+@pytest.fixture
+def tables():
+    tables, users = make_tables(PLACES, USERS)
+    for place in tables["places"]:
+        place["updated_at"] = STAMP
+    return tables
+
+
+@pytest.fixture
+def users(tables):
+    return sorted({bookmark["user_id"] for bookmark in tables["bookmarks"]})
+
+
+@pytest.fixture
+def source(tables):
+    return LocalSource(tables)
+
+
+@pytest.fixture
+def store(source):
+    # the process wide store, as the models read it through get_snapshot
+    store = SnapshotStore(source, full_refresh_every=0)
+    set_store(store)
+    store.refresh(full=True)
+    yield store
+    set_store(None)
+
+
+def place_changes(tables):
+    # a few places moved, retagged (one with a word no place had), renamed, inserted and deleted
+    places = tables["places"]
+    upserted = []
+    for place in places[:3]:
+        upserted.append(dict(place, latitude=place["latitude"] + 0.01, updated_at=LATER))
+    for place, tags in zip(places[3:6], ["planetarium, museum", "garden", ""]):
+        upserted.append(dict(place, tags=tags, updated_at=LATER))
+    for place in places[6:9]:
+        upserted.append(dict(place, name=place["name"] + " renamed", updated_at=LATER))
+    for i, place in enumerate(places[9:12]):
+        upserted.append(dict(place, places_id=f"new-place-{i}", longitude=place["longitude"] - 0.02, updated_at=LATER))
+    deleted = [place["places_id"] for place in places[12:15]]
+    return upserted, deleted
+
+
+@pytest.fixture(params=["refresh", "apply_changes"])
+def changed_places(request, store, source, tables):
+    # (previous, next) snapshots, the places changes read back by a refresh or pushed by a changefeed
+    previous = store.get()
+    upserted, deleted = place_changes(tables)
+    if request.param == "refresh":
+        source.upsert("places", upserted)
+        source.delete("places", deleted)
+        snapshot = store.refresh()
+    else:
+        snapshot = store.apply_changes({"places": (upserted, deleted)})
+    assert snapshot.version == previous.version + 1
+    return previous, snapshot
+
+
+@pytest.fixture
+def patched(changed_places):
+    # name -> the value the next snapshot's registered update derives from the previous one, never a fallback build
+    previous, snapshot = changed_places
+
+    def patch(name):
+        build, update = DERIVED[name]
+        value = update(previous.derived(name), snapshot)
+        assert value is not None, f"{name} fell back to a full build"
+        return value
+    return patch
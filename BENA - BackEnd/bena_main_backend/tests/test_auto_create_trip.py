@@ -0,0 +1,30 @@
+from app.auto_create_trip_model import generate_trip, theme_scores
+
+
+def test_trips_skip_unavailable_places(store, tables):
+    # every other place closed, the seed's neighbours among them
+    places = tables["places"]
+    closed = [dict(place, tags=place["tags"] + ", Not available yet") for place in places[1::2]]
+    store.apply_changes({"places": (closed, [])})
+    trip = generate_trip(place_id=places[0]["places_id"], stops=8, hours=24)
+    assert len(trip) > 1
+    assert not trip["tags"].str.contains("not available yet", case=False).any()
+
+
+def test_theme_trips_only_keep_matching_places(store):
+    trip = generate_trip(theme="islamic history", stops=6, hours=24)
+    assert len(trip) > 1
+    assert trip["tags"].str.contains("islamic|history").all()
+    assert trip["step_num"].tolist() == list(range(len(trip)))
+
+
+def test_themes_without_any_tags(store, tables):
+    # no place has tags, the vectorizer has no vocabulary to match a theme against
+    untagged = [dict(place, tags="") for place in tables["places"]]
+    store.apply_changes({"places": (untagged, [])})
+    similarity = store.get().derived("similarity_index")
+    assert similarity.vectorizer is None
+    assert not theme_scores(similarity, "islamic history").any()
+    assert generate_trip(theme="islamic history").empty
+    # a seed place still gets a trip of its neighbours
+    assert len(generate_trip(place_id=tables["places"][0]["places_id"], theme="islamic history", hours=24)) > 1
@@ -0,0 +1,24 @@
+import numpy as np
+from app.autocomplete import AutocompleteIndex
+
+
+def test_update_matches_a_full_build(changed_places, patched):
+    previous, snapshot = changed_places
+    index = patched("autocomplete")
+    full = AutocompleteIndex.build(snapshot.places)
+    assert sorted(zip(index.terms, index.rows)) == sorted(zip(full.terms, full.rows))
+    assert list(index.terms) == sorted(index.terms)
+    popularity = snapshot.derived("place_popularity")
+    for prefix in ["m", "museum", "museum 1", "planetarium", "garden", "cafe 6", "renamed", "مت"]:
+        np.testing.assert_array_equal(index.complete(prefix, popularity), full.complete(prefix, popularity))
+
+
+def test_changed_places_are_completed_by_their_new_names(changed_places, patched, tables):
+    previous, snapshot = changed_places
+    index = patched("autocomplete")
+    popularity = snapshot.derived("place_popularity")
+    renamed = tables["places"][6]["name"] + " renamed"
+    rows = index.complete(renamed, popularity)
+    assert snapshot.places["places_id"].iloc[rows].tolist() == [tables["places"][6]["places_id"]]
+    deleted = index.complete(tables["places"][13]["name"], popularity)
+    assert tables["places"][13]["places_id"] not in snapshot.places["places_id"].iloc[deleted].tolist()
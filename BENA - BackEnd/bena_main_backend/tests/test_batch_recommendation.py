@@ -0,0 +1,50 @@
+# the batch job must rank like the single-user endpoints it is served in place of
+import numpy as np
+import pytest
+from app.batch_recommendation import RecommendationStore, score_users
+from app.recommendation_model import SCORE_COLUMNS, compute_recommendations
+
+N = 10
+# distances are float32 haversines in the batch and float64 ones from the spatial index, in km
+TOLERANCE = {"content_based": 1e-5, "hybrid": 1e-5, "collaborative": 1e-5, "near_bookmarks": 1e-3}
+
+
+@pytest.mark.parametrize("method", sorted(TOLERANCE))
+def test_batch_scores_match_single_user(store, users, method):
+    # places tied on score may come in another order, so the scores are compared rank by rank
+    users = users[:50] + ["user-without-bookmarks"]
+    batch = score_users(store.get(), users, method=method, n=N, workers=1)
+    for user_id in users:
+        single = compute_recommendations(user_id, n=N, method=method)
+        expected = single[SCORE_COLUMNS[method]].to_numpy(dtype=np.float64) if len(single) else np.zeros(0)
+        place_ids, scores = batch[user_id]
+        assert len(place_ids) == len(expected), user_id
+        np.testing.assert_allclose(scores, expected, rtol=TOLERANCE[method], atol=TOLERANCE[method])
+
+
+def test_batch_workers_match_one_process(store, users):
+    snapshot = store.get()
+    assert score_users(snapshot, users, n=N, workers=2) == score_users(snapshot, users, n=N, workers=1)
+
+
+def test_result_store_drops_stale_results(store, source, tables, tmp_path):
+    results = RecommendationStore(str(tmp_path / "recommendations.sqlite"))
+    store.add_listener(results.on_snapshot)
+    bookmark = tables["bookmarks"][0]
+    owner, other = bookmark["user_id"], next(row["user_id"] for row in tables["bookmarks"] if row["user_id"] != bookmark["user_id"])
+    results.put_many("hybrid", N, {owner: (["a"], [1.0]), other: (["b"], [1.0])})
+
+    # a bookmark only changes its owner's results
+    store.apply_changes({"bookmarks": ([], [bookmark["bookmark_id"]])})
+    assert results.get(owner, "hybrid", N) is None
+    assert results.get(other, "hybrid", N) == (["b"], [1.0])
+
+    # a place changes everyone's
+    place = dict(tables["places"][0], name="Renamed")
+    store.apply_changes({"places": ([place], [])})
+    assert results.get(other, "hybrid", N) is None
+
+    # and so does a full reload
+    results.put_many("hybrid", N, {other: (["b"], [1.0])})
+    store.refresh(full=True)
+    assert results.get(other, "hybrid", N) is None
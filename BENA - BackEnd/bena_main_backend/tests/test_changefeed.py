@@ -0,0 +1,44 @@
+import pytest
+from app.changefeed import PollFeed
+from app.data_snapshot import LocalSource, SnapshotStore, latest_time
+
+# 11:30 UTC, later than the 10:00 UTC stamp that sorts after it as a string
+LATEST = "2024-01-01T09:30:00-02:00"
+EARLIER = "2024-01-01T10:00:00.5Z"
+
+
+@pytest.fixture
+def source(tables):
+    tables["places"][0]["updated_at"] = LATEST
+    tables["places"][1]["updated_at"] = EARLIER
+    return LocalSource(tables)
+
+
+def test_latest_time_compares_times():
+    assert latest_time([EARLIER, None, LATEST, "not a time"]) == LATEST
+    assert latest_time([None, ""]) is None
+
+
+def test_refresh_watermark_skips_rows_it_already_has(source):
+    store = SnapshotStore(source, full_refresh_every=0, warm=False)
+    first = store.refresh(full=True)
+    assert store._watermarks["places"] == ("updated_at", LATEST)
+    assert store.refresh() is first
+
+
+def test_poll_watermark_advances_by_time(source, tables):
+    store = SnapshotStore(source, full_refresh_every=0, warm=False)
+    snapshot = store.refresh(full=True)
+    known = {"places": set(snapshot.places["places_id"])}
+    watermarks = {"places": latest_time(snapshot.places["updated_at"])}
+    feed = PollFeed(source, tables=("places",))
+    assert feed.poll(source, known, watermarks) == []
+
+    later = dict(tables["places"][2], updated_at="2024-01-01T13:00:00+01:00")
+    latest = dict(tables["places"][3], updated_at="2024-01-01T12:30:00.25Z")
+    source.upsert("places", [later, latest])
+    changes = feed.poll(source, known, watermarks)
+    assert sorted(change.key for change in changes) == sorted([later["places_id"], latest["places_id"]])
+    assert all(change.operation == "UPDATE" for change in changes)
+    assert watermarks["places"] == latest["updated_at"]
+    assert feed.poll(source, known, watermarks) == []
@@ -0,0 +1,29 @@
+import numpy as np
+from app.cooccurrence_index import MAX_STALE_SHARE, build_cooccurrence_index
+
+
+def stale_rows(matrix, row_of):
+    nonempty = np.diff(matrix.indptr) > 0
+    return matrix.shape[0] - sum(1 for row in row_of.values() if nonempty[row])
+
+
+def test_updates_match_a_full_build_and_drop_empty_rows(store, tables, users):
+    # trips deleted and bookmarks moved a few at a time, every snapshot patched from the one before
+    trips, bookmarks = tables["trips"], tables["bookmarks"]
+    places = [place["places_id"] for place in tables["places"]]
+    for round in range(20):
+        deleted_trips = [trip["trip_id"] for trip in trips[round * 3:round * 3 + 3]]
+        steps = [step["step_id"] for step in tables["tripstep"] if step["trip_id"] in deleted_trips]
+        moved = [dict(bookmark, place_id=places[round]) for bookmark in bookmarks[round * 2:round * 2 + 2]]
+        snapshot = store.apply_changes({"trips": ([], deleted_trips), "tripstep": ([], steps), "bookmarks": (moved, [])})
+        index = snapshot.derived("cooccurrence_index")
+        assert stale_rows(index.baskets, index.basket_row) <= MAX_STALE_SHARE * index.baskets.shape[0]
+        assert stale_rows(index.history, index.user_row) <= MAX_STALE_SHARE * index.history.shape[0]
+        if index.factors is not None:
+            assert index.factors[0].shape[0] == index.history.shape[0]
+
+    full = build_cooccurrence_index(snapshot)
+    assert abs(index.counts - full.counts).max() == 0
+    np.testing.assert_array_equal(index.frequency, full.frequency)
+    for user_id in users:
+        assert sorted(index.user_places(user_id)) == sorted(full.user_places(user_id))
@@ -0,0 +1,108 @@
+import pandas as pd
+from app.data_snapshot import TABLE_KEYS, SnapshotStore, LocalSource
+
+LATER = "2024-01-02T00:00:00+00:00"
+
+
+def sorted_frame(frame, key):
+    # the frame's rows in key order with its columns sorted, to compare tables whatever order they were merged in
+    return frame.sort_values(key).reset_index(drop=True)[sorted(frame.columns)]
+
+
+def assert_same_tables(snapshot, source):
+    # every table of the snapshot holds exactly the source's rows, merged frames may infer other column dtypes
+    fresh = SnapshotStore(source, full_refresh_every=0, warm=False).get()
+    for table, key in TABLE_KEYS.items():
+        pd.testing.assert_frame_equal(sorted_frame(snapshot.tables[table], key), sorted_frame(fresh.tables[table], key),
+                                      check_dtype=False)
+
+
+def test_full_refresh_loads_every_table(store, tables):
+    snapshot = store.get()
+    assert snapshot.version == 1
+    assert snapshot.changes is None
+    assert snapshot.changed("places") is None
+    for table, key in TABLE_KEYS.items():
+        assert set(snapshot.tables[table][key]) == {row[key] for row in tables[table]}
+
+
+def test_refresh_without_changes_keeps_the_snapshot(store):
+    snapshot = store.get()
+    assert store.refresh() is snapshot
+
+
+def test_refresh_picks_up_inserts_updates_and_deletes(store, source, tables):
+    places = tables["places"]
+    updated = dict(places[0], name="Renamed", updated_at=LATER)
+    inserted = dict(places[1], places_id="new-place", updated_at=LATER)
+    source.upsert("places", [updated, inserted])
+    source.delete("places", [places[2]["places_id"]])
+    source.delete("bookmarks", [tables["bookmarks"][0]["bookmark_id"]])
+    # tables without a watermark only show inserts and deletes by their keys
+    step = dict(tables["tripstep"][0], step_id="new-step")
+    source.upsert("tripstep", [step])
+    previous = store.get()
+
+    snapshot = store.refresh()
+    assert snapshot.version == previous.version + 1
+    assert snapshot.changes["places"] == ({updated["places_id"], "new-place"}, {places[2]["places_id"]})
+    assert snapshot.changed("bookmarks") == {tables["bookmarks"][0]["bookmark_id"]}
+    assert snapshot.changed("tripstep") == {"new-step"}
+    assert snapshot.changed("interactions") == set()
+    assert snapshot.places.set_index("places_id").loc[updated["places_id"], "name"] == "Renamed"
+    assert_same_tables(snapshot, source)
+    # the previous snapshot is never modified
+    assert places[2]["places_id"] in set(previous.places["places_id"])
+
+
+def test_refresh_reports_the_owners_of_changed_rows(store, source, tables):
+    bookmark = tables["bookmarks"][0]
+    source.delete("bookmarks", [bookmark["bookmark_id"]])
+    previous = store.get()
+    snapshot = store.refresh()
+    assert snapshot.changed_values("bookmarks", "user_id", previous) == {bookmark["user_id"]}
+
+
+def test_apply_changes_merges_rows_and_deletes(store, source, tables):
+    places = tables["places"]
+    updated = dict(places[0], tags="rooftop, view", updated_at=LATER)
+    bookmark = {"bookmark_id": "new-bookmark", "user_id": "someone", "place_id": places[0]["places_id"]}
+    changes = {
+        "places": ([updated], [places[1]["places_id"]]),
+        "bookmarks": ([bookmark], []),
+        # tables the store does not hold and empty changes are ignored
+        "unknown": ([{"id": 1}], []),
+        "interactions": ([], []),
+    }
+    snapshot = store.apply_changes(changes)
+    assert snapshot.changes == {
+        "places": ({updated["places_id"]}, {places[1]["places_id"]}),
+        "bookmarks": ({"new-bookmark"}, set()),
+    }
+    # the same rows written to the source give the same tables on a full load
+    source.upsert("places", [updated])
+    source.delete("places", [places[1]["places_id"]])
+    source.upsert("bookmarks", [bookmark])
+    assert_same_tables(snapshot, source)
+
+
+def test_apply_changes_without_changes_keeps_the_snapshot(store):
+    snapshot = store.get()
+    assert store.apply_changes({"places": ([], [])}) is snapshot
+
+
+def test_listeners_see_every_published_snapshot(store, source, tables):
+    seen = []
+    store.add_listener(lambda snapshot, previous: seen.append((snapshot.version, previous.version)))
+    source.delete("interactions", [tables["interactions"][0]["id"]])
+    store.refresh()
+    store.apply_changes({"interactions": ([], [tables["interactions"][1]["id"]])})
+    store.refresh(full=True)
+    assert seen == [(2, 1), (3, 2), (4, 3)]
+
+
+def test_get_loads_the_first_snapshot():
+    store = SnapshotStore(LocalSource({"places": [{"places_id": "a", "name": "A"}]}), tables=["places"], warm=False)
+    assert not store.ready
+    assert store.get().places["places_id"].tolist() == ["a"]
+    assert store.ready
@@ -0,0 +1,64 @@
+import pytest
+import app.data_snapshot as data_snapshot
+import app.dbcom as dbcom
+from app.dbcom import create_trip, create_trips
+from benchmarks.fake_supabase import FakeSupabase
+
+
+@pytest.fixture
+def supabase(monkeypatch):
+    supabase = FakeSupabase({"places": [{"places_id": "louvre", "name": "Louvre"}]})
+    monkeypatch.setattr(dbcom, "_supabase", supabase)
+    monkeypatch.setattr(dbcom, "RETRY_DELAY", 0.0)
+    return supabase
+
+
+def trip(user_id="user", title="Paris", idempotency_key=None, steps=None):
+    steps = steps if steps is not None else [{"place_id": "louvre"}, {"place_id": "orsay"}]
+    return {"user_id": user_id, "title": title, "start_date": None, "end_date": None, "steps": steps, "idempotency_key": idempotency_key}
+
+
+def test_replayed_keys_return_the_stored_trip(supabase):
+    first = create_trip(**trip(idempotency_key="key"))
+    replay = create_trip(**trip(title="Paris again", idempotency_key="key"))
+    assert replay == first
+    assert len(supabase.tables["trips"]) == 1
+    assert len(supabase.tables["tripstep"]) == 2
+    # the same key in one import creates its trip once
+    trips = create_trips([trip(idempotency_key="other"), trip(idempotency_key="other")])
+    assert trips[0] == trips[1]
+    assert len(supabase.tables["trips"]) == 2
+
+
+def test_keys_are_scoped_to_their_user(supabase):
+    mine = create_trip(**trip(user_id="me", idempotency_key="key"))
+    yours = create_trip(**trip(user_id="you", idempotency_key="key"))
+    assert mine["trip_id"] != yours["trip_id"]
+    assert len(supabase.tables["trips"]) == 2
+
+
+def test_failed_writes_leave_nothing_behind(supabase):
+    # the steps fail once, the retry writes every trip exactly once
+    supabase.fail("insert", "tripstep")
+    create_trips([trip(), trip()])
+    assert len(supabase.tables["trips"]) == 2
+    assert len(supabase.tables["tripstep"]) == 4
+    # out of attempts, the trips written before the failure are removed again
+    supabase.fail("insert", "tripstep")
+    with pytest.raises(ConnectionError):
+        create_trips([trip()], attempts=1)
+    assert len(supabase.tables["trips"]) == 2
+    assert len(supabase.tables["tripstep"]) == 4
+
+
+def test_default_titles_never_load_the_snapshot(supabase, monkeypatch):
+    monkeypatch.setattr(data_snapshot, "_store", None)
+    assert create_trip(**trip(title=""))["title"] == "Trip to Louvre"
+    assert create_trip(**trip(title="", steps=[{"place_id": "orsay", "name": "Orsay"}]))["title"] == "Trip to Orsay"
+    assert create_trip(**trip(title="", steps=[{"place_id": "unknown"}]))["title"] == dbcom.DEFAULT_TITLE
+    assert data_snapshot._store is None
+
+
+def test_default_titles_read_a_loaded_snapshot(supabase, store, tables):
+    place = tables["places"][0]
+    assert create_trip(**trip(title="", steps=[{"place_id": place["places_id"]}]))["title"] == "Trip to " + place["name"]
@@ -0,0 +1,43 @@
+import pytest
+from fastapi.testclient import TestClient
+from app.data_snapshot import SnapshotStore, set_store
+from app.main import app
+
+
+@pytest.fixture
+def loading(source):
+    # a process wide store that has not loaded its first snapshot yet
+    store = SnapshotStore(source, full_refresh_every=0)
+    set_store(store)
+    yield store
+    set_store(None)
+
+
+@pytest.fixture
+def client():
+    # without the lifespan, the tests decide when the store loads
+    return TestClient(app)
+
+
+def test_live_answers_while_loading(loading, client):
+    assert client.get("/health/live").json() == {"status": "alive"}
+
+
+def test_ready_once_the_first_snapshot_is_loaded(loading, client):
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["status"] == "loading"
+    assert client.get("/health/freshness").json()["snapshot_version"] is None
+
+    loading.refresh(full=True)
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready", "snapshot_version": 1}
+
+
+def test_freshness_reports_the_served_snapshot(store, tables, client):
+    store.apply_changes({"places": ([dict(tables["places"][0], name="Renamed")], [])})
+    freshness = client.get("/health/freshness").json()
+    assert freshness["snapshot_version"] == 2
+    assert 0 <= freshness["snapshot_age_seconds"] < 60
+    assert freshness["changefeed"] is None
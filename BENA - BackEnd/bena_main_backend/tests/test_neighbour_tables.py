@@ -0,0 +1,18 @@
+import numpy as np
+from app.neighbour_tables import NeighbourTables, _place_coordinates
+
+
+def test_update_matches_a_full_build(changed_places, patched):
+    previous, snapshot = changed_places
+    tables = patched("neighbour_tables")
+    ids, lat, lon = _place_coordinates(snapshot)
+    full = NeighbourTables.build(ids, lat, lon, snapshot.derived("similarity_index"))
+    assert tables.ids.tolist() == full.ids.tolist()
+    # rows tied on distance or score may be listed in another order
+    np.testing.assert_allclose(tables.near_distances, full.near_distances, rtol=1e-5)
+    np.testing.assert_allclose(tables.similar_scores, full.similar_scores, rtol=1e-5, atol=1e-6)
+    for row in range(len(ids)):
+        # the neighbours strictly closer than the farthest kept one are the same places
+        farthest = full.near_distances[row][-1] - 1e-4
+        assert (set(tables.near_rows[row][tables.near_distances[row] < farthest])
+                == set(full.near_rows[row][full.near_distances[row] < farthest]))
@@ -0,0 +1,17 @@
+import numpy as np
+from app.place_catalog import TEXT_COLUMNS, PlaceCatalog
+
+
+def test_update_matches_a_full_build(changed_places, patched):
+    previous, snapshot = changed_places
+    catalog = patched("place_catalog")
+    full = PlaceCatalog.build(snapshot.places)
+    assert catalog.ids.tolist() == full.ids.tolist()
+    assert catalog.row_of == full.row_of
+    np.testing.assert_array_equal(catalog.lat, full.lat)
+    np.testing.assert_array_equal(catalog.lon, full.lon)
+    # tag codes differ, the vocabulary of a patched catalogue keeps its old order
+    assert [catalog.tags(row) for row in range(len(full))] == [full.tags(row) for row in range(len(full))]
+    np.testing.assert_array_equal(catalog.unavailable, full.unavailable)
+    for column in TEXT_COLUMNS:
+        assert catalog.texts[column].tolist() == full.texts[column].tolist()
@@ -0,0 +1,49 @@
+import time
+import asyncio
+import threading
+import pytest
+from fastapi import HTTPException
+import app.request_executor as request_executor
+from app.request_executor import run_in_executor, in_flight
+
+
+def test_requests_past_the_pending_limit_are_turned_away(monkeypatch):
+    monkeypatch.setattr(request_executor, "MAX_PENDING", 1)
+    release = threading.Event()
+
+    async def scenario():
+        running = asyncio.ensure_future(run_in_executor("search", release.wait))
+        await asyncio.sleep(0.05)
+        assert in_flight() == 1
+        with pytest.raises(HTTPException) as rejected:
+            await run_in_executor("search", time.sleep, 0)
+        release.set()
+        return rejected.value, await running
+
+    rejected, result = asyncio.run(scenario())
+    assert rejected.status_code == 503
+    assert result is True
+    assert in_flight() == 0
+
+
+def test_slow_requests_time_out_and_free_their_slot_when_done(monkeypatch):
+    monkeypatch.setitem(request_executor.TIMEOUTS, "search", 0.05)
+    release = threading.Event()
+
+    async def scenario():
+        with pytest.raises(HTTPException) as timed_out:
+            await run_in_executor("search", release.wait)
+        # the work still holds its slot until it really ends
+        assert in_flight() == 1
+        release.set()
+        await asyncio.sleep(0.05)
+        return timed_out.value
+
+    assert asyncio.run(scenario()).status_code == 504
+    assert in_flight() == 0
+
+
+def test_writes_are_never_timed_out():
+    # a bulk import answers once it is written, a 504 would invite a retry of a write still running
+    assert request_executor.TIMEOUTS["trips_bulk"] is None
+    assert asyncio.run(run_in_executor("trips_bulk", lambda: time.sleep(0.1) or "written")) == "written"
@@ -0,0 +1,67 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+import app.responses as responses
+from app.responses import choose_encoding, dumps, records
+from app.main import app
+
+# the place columns the mobile client reads: search items, category carousels and place cards
+CLIENT_FIELDS = ["places_id", "name", "image", "description", "city", "rating", "latitude", "longitude"]
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({
+        "places_id": ["a", "b"], "name": ["Citadel", "Museum"], "image": ["a.jpg", None], "description": ["Fort", "Art"],
+        "city": ["Cairo", "Giza"], "rating": [4.5, np.nan], "latitude": [30.0, 30.1], "longitude": [31.2, 31.3],
+        "created_at": ["2024-01-01", "2024-01-02"], "hybrid_score": np.array([0.9, 0.5], dtype=np.float32),
+        "content_score": np.array([0.8, 0.4], dtype=np.float32),
+    })
+
+
+def test_default_payload_keeps_every_column(frame):
+    rows = records(frame)
+    assert list(rows[0]) == list(frame.columns)
+    assert rows[1]["image"] is None and rows[1]["rating"] is None
+
+
+def test_compact_fields_keep_the_client_columns(frame):
+    rows = records(frame, "compact", extra=["hybrid_score"])
+    assert set(CLIENT_FIELDS) <= set(rows[0])
+    assert "hybrid_score" in rows[0]
+    assert "created_at" not in rows[0] and "content_score" not in rows[0]
+
+
+def test_named_fields(frame):
+    assert records(frame, "name, rating,unknown,name") == [{"name": "Citadel", "rating": 4.5}, {"name": "Museum", "rating": None}]
+    assert records(frame, "*") == records(frame)
+
+
+def test_non_finite_floats_are_null_without_orjson(monkeypatch):
+    monkeypatch.setattr(responses, "orjson", None)
+    payload = {"scores": [float("nan"), np.float32("inf"), 0.5], "name": "قلعة"}
+    assert json.loads(dumps(payload)) == {"scores": [None, None, 0.5], "name": "قلعة"}
+
+
+def test_encoding_choice(monkeypatch):
+    monkeypatch.setattr(responses, "brotli", None)
+    assert choose_encoding("gzip, br", 10) is None
+    assert choose_encoding("gzip, br", 4096) == "gzip"
+    assert choose_encoding("gzip;q=0, identity", 4096) is None
+    assert choose_encoding("*", 4096) == "gzip"
+
+
+def test_etags_answer_repeated_queries_with_304(store):
+    client = TestClient(app)
+    response = client.get("/search/places/museum", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    etag = response.headers["ETag"]
+    assert response.json()["search_results"]
+    again = client.get("/search/places/museum", headers={"If-None-Match": etag})
+    assert again.status_code == 304 and again.content == b""
+    # the compact schema is another payload with another tag
+    compact = client.get("/search/places/museum", params={"fields": "compact"}, headers={"If-None-Match": etag})
+    assert compact.status_code == 200 and compact.headers["ETag"] != etag
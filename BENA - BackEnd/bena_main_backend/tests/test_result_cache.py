@@ -0,0 +1,63 @@
+import pytest
+import app.result_cache as result_cache
+from app.result_cache import ResultCache, SqliteBackend, get_result_cache
+from app.recommendation_model import recommend_places
+
+
+@pytest.fixture
+def cache(store, monkeypatch):
+    # a process wide cache subscribed to this test's store
+    monkeypatch.setattr(result_cache, "_cache", None)
+    return get_result_cache()
+
+
+def test_bookmark_changes_drop_their_owners_results(cache, store, tables):
+    bookmark = tables["bookmarks"][0]
+    owner = bookmark["user_id"]
+    other = next(row["user_id"] for row in tables["bookmarks"] if row["user_id"] != owner)
+    before = recommend_places(owner, n=5, method="content_based")
+    recommend_places(other, n=5, method="content_based")
+    assert recommend_places(owner, n=5, method="content_based") is before
+    assert cache.hits == 1
+
+    store.apply_changes({"bookmarks": ([], [bookmark["bookmark_id"]])})
+    assert cache.get((owner, "content_based", 5)) is None
+    assert cache.get((other, "content_based", 5)) is not None
+    # the owner's next request is computed again from the new bookmarks
+    assert recommend_places(owner, n=5, method="content_based") is not before
+
+
+def test_place_changes_drop_every_result(cache, store, tables):
+    recommend_places(tables["bookmarks"][0]["user_id"], n=5)
+    store.apply_changes({"places": ([dict(tables["places"][0], name="Renamed")], [])})
+    assert cache.stats()["entries"] == 0
+
+
+def test_results_of_older_snapshots_are_not_served(cache, store, tables):
+    # a request that read snapshot N finishes after N+1 was published and its cache cleared
+    user_id = tables["bookmarks"][0]["user_id"]
+    started = store.get().created_at
+    store.apply_changes({"bookmarks": ([], [tables["bookmarks"][0]["bookmark_id"]])})
+    cache.set((user_id, "hybrid", 5), "computed on N", started)
+    assert cache.get((user_id, "hybrid", 5)) is None
+    assert cache.stale == 1
+    # other users' results of the older snapshot still hold
+    cache.set(("someone else", "hybrid", 5), "computed on N", started)
+    assert cache.get(("someone else", "hybrid", 5)) == "computed on N"
+
+
+def test_workers_sharing_sqlite_keep_each_others_invalidations(tmp_path):
+    # the worker ahead published the snapshot of time 2.0, the other one is still computing on the one of 1.0
+    path = str(tmp_path / "result_cache.sqlite")
+    ahead, behind = ResultCache(SqliteBackend(path)), ResultCache(SqliteBackend(path))
+    ahead.invalidate_users({"user"}, at=2.0)
+    behind.set(("user", "hybrid", 5), "older", 1.0)
+    behind.set(("other", "hybrid", 5), "older", 1.0)
+    assert ahead.get(("user", "hybrid", 5)) is None
+    assert ahead.get(("other", "hybrid", 5)) == "older"
+    ahead.set(("user", "hybrid", 5), "newer", 2.0)
+    assert behind.get(("user", "hybrid", 5)) == "newer"
+    # a full clear covers every user
+    behind.clear(at=3.0)
+    ahead.set(("other", "hybrid", 5), "older", 2.0)
+    assert behind.get(("other", "hybrid", 5)) is None
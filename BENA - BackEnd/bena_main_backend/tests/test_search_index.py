@@ -0,0 +1,22 @@
+from app.search_index import build_search_index
+
+
+def test_update_matches_a_full_build(changed_places, patched, tables):
+    previous, snapshot = changed_places
+    index = patched("search_index")
+    full = build_search_index(snapshot)
+    # renamed, deleted and retagged places, whole shortlists so the candidate cut can't pick different ties
+    queries = [tables["places"][6]["name"] + " renamed", tables["places"][7]["name"], tables["places"][13]["name"],
+               "planetarium", "garden", "museum 1", "street 12"]
+    for query in queries:
+        rows, scores = index.search(query, n=20, limit=len(full.ids))
+        full_rows, full_scores = full.search(query, n=20, limit=len(full.ids))
+        assert rows.tolist() == full_rows.tolist()
+        assert scores.tolist() == full_scores.tolist()
+
+
+def test_deleted_places_are_not_found(changed_places, patched, tables):
+    previous, snapshot = changed_places
+    index = patched("search_index")
+    rows, scores = index.search(tables["places"][13]["name"], n=5)
+    assert tables["places"][13]["places_id"] not in snapshot.places["places_id"].iloc[rows].tolist()
@@ -0,0 +1,37 @@
+import time
+import numpy as np
+import app.similarity_index as similarity_index
+from app.similarity_index import SimilarityIndex, top_k_rows
+
+
+def test_update_matches_top_k_of_the_patched_vectors(changed_places, patched):
+    previous, snapshot = changed_places
+    index = patched("similarity_index")
+    ids, tags = snapshot.places["places_id"].tolist(), snapshot.places["tags"].fillna("").tolist()
+    assert index.ids.tolist() == ids
+    assert index.tags == tags
+    assert "planetarium" in index.vectorizer.vocabulary_
+    # unchanged places keep their vectors, changed ones are transformed with the same weights
+    np.testing.assert_allclose(index.tag_matrix.toarray(), index.vectorizer.transform(tags).toarray(), rtol=1e-5, atol=1e-6)
+    # and the neighbour lists are the top k of every row, ties at the k-th place may pick different places
+    full = SimilarityIndex._assemble(*top_k_rows(index.tag_matrix, np.arange(len(ids)), index.k), len(ids))
+    for row in range(len(ids)):
+        expected = np.sort(full.getrow(row).data)[::-1]
+        np.testing.assert_allclose(np.sort(index.matrix.getrow(row).data)[::-1], expected, rtol=1e-5, atol=1e-6)
+    assert index.fit_id == previous.derived("similarity_index").fit_id
+
+
+def test_patched_indexes_are_saved_once_per_interval(changed_places, monkeypatch):
+    previous, snapshot = changed_places
+    saved = []
+    monkeypatch.setattr(similarity_index, "_save", saved.append)
+    # the first patch of a process is saved whatever the monotonic clock reads
+    monkeypatch.setattr(similarity_index, "_saved_at", None)
+    similarity_index.update_similarity_index(previous.derived("similarity_index"), snapshot)
+    assert len(saved) == 1
+    monkeypatch.setattr(similarity_index, "_saved_at", time.monotonic())
+    similarity_index.update_similarity_index(previous.derived("similarity_index"), snapshot)
+    assert len(saved) == 1
+    monkeypatch.setattr(similarity_index, "_saved_at", time.monotonic() - similarity_index.SAVE_INTERVAL)
+    similarity_index.update_similarity_index(previous.derived("similarity_index"), snapshot)
+    assert len(saved) == 2
@@ -0,0 +1,36 @@
+import numpy as np
+from app.spatial_index import SpatialIndex, _place_coordinates
+from app.recommendation_model import compute_recommendations
+
+
+def test_update_matches_a_full_build(changed_places, patched):
+    previous, snapshot = changed_places
+    index = patched("spatial_index")
+    ids, lat, lon = _place_coordinates(snapshot)
+    full = SpatialIndex.build(ids, lat, lon)
+    # around the changed places and a few others
+    points = list(range(0, 30)) + [len(ids) - 1, len(ids) - 2, len(ids) - 3]
+    for row in points:
+        rows, distances = index.query_knn(lat[row], lon[row], 15)
+        full_rows, full_distances = full.query_knn(lat[row], lon[row], 15)
+        np.testing.assert_allclose(distances, full_distances, atol=1e-3)
+        rows, distances = index.query_radius(lat[row], lon[row], 0.5)
+        full_rows, full_distances = full.query_radius(lat[row], lon[row], 0.5)
+        assert sorted(rows.tolist()) == sorted(full_rows.tolist())
+    # deleted places are never returned
+    rows, distances = index.query_knn_multi(lat, lon, len(ids))
+    assert sorted(rows.tolist()) == list(range(len(ids)))
+
+
+def test_queries_without_points_find_nothing(changed_places, patched):
+    # both the tree and the buffer of patched places
+    for index in (changed_places[0].derived("spatial_index"), patched("spatial_index")):
+        for rows, distances in (index.query_knn_multi([], [], 5), index.query_radius_multi([], [], 1.0)):
+            assert len(rows) == 0 and len(distances) == 0
+
+
+def test_near_bookmarks_without_coordinates(store, tables):
+    place = dict(tables["places"][0], places_id="no-coordinates", latitude=None, longitude=None)
+    bookmark = {"bookmark_id": "no-coordinates-bookmark", "user_id": "lost-user", "place_id": "no-coordinates"}
+    store.apply_changes({"places": ([place], []), "bookmarks": ([bookmark], [])})
+    assert compute_recommendations("lost-user", method="near_bookmarks").empty